@@ -0,0 +1,713 @@
+"""
+JSON API, mounted under /api/v1
+
+Entries, accounts and categories each have a batch endpoint that takes a
+list of create, update and delete operations:
+
+    POST /api/v1/entries/batch
+    {"operations": [
+        {"op": "create", "category_id": 3, "amount": "12.50", "description": "Tea"},
+        {"op": "update", "id": 41, "amount": "13.00"},
+        {"op": "delete", "id": 40}
+    ]}
+
+Updates only change the fields they name. Every operation is validated on
+its own, then all the valid ones are applied in a single transaction with
+one statement per kind of operation, split into chunks binding at most the
+999 variables older SQLite allows. The response has one result per
+operation, in order:
+
+    {"index": 0, "status": "created", "id": 97}
+    {"index": 1, "status": "error", "error": "amount must be a number"}
+
+An invalid operation is reported and skipped without holding up the rest.
+
+GET /api/v1/changes?since=<cursor> returns what changed after a cursor, see
+sync.py.
+
+GET /api/v1/entries/search?q=coffee&start=2020-01-01&end=2020-12-31&category=3
+returns the entries whose descriptions match, best first, see search.py.
+
+GET /api/v1/reports/trends?start=2020-01&end=2020-12&window=3 returns budget
+vs. actual per category for each month in the range, see reports.py. With
+background=1 it queues the report as a job and answers 202 with the job.
+
+GET /api/v1/jobs/<id> returns a background job's status, progress and, once
+it has succeeded, result; POST /api/v1/jobs/<id>/retry queues a failed job
+again, see jobs.py.
+
+The API uses the same session cookie as the site, so log in through /login
+first.
+"""
+from abc import ABC, abstractmethod
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from flask import Blueprint, jsonify, request, session
+from functools import wraps
+from sqlalchemy import bindparam, select
+
+from helpers import parse_date
+from instrumentation import query_budget
+from jobs import enqueue, job_status, retry
+from models import (
+    db,
+    Account,
+    Category,
+    Entry,
+    Job,
+    MonthlyCategoryTotal,
+    RecurringEntry,
+    from_cents,
+    to_cents,
+)
+from reference import account_types, category_types
+from archive import archived_years, route_entries
+from balances import refresh_balances
+from caching import bump_data_version
+from database import MAX_VARIABLES, chunked
+from reports import get_trends, parse_trend_args, trends_json
+from search import DEFAULT_LIMIT as DEFAULT_SEARCH_LIMIT, search_entries
+from rollups import add_delta, apply_deltas
+from sync import DEFAULT_LIMIT, get_changes, record_deletes
+
+MAX_OPERATIONS = 1000
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+
+class OperationError(Exception):
+    """An operation that can't be applied, reported back in its result"""
+
+
+def error_response(message, code):
+    return jsonify({"error": message}), code
+
+
+def api_login_required(f):
+    """Like helpers.login_required, but answers 401 instead of redirecting"""
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get("user_id") is None:
+            return error_response("Log in through /login first", 401)
+
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+def parse_integer(value, field):
+    if isinstance(value, bool):
+        raise OperationError(f"{field} must be an integer")
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise OperationError(f"{field} must be an integer")
+
+
+def parse_amount(value, field):
+    if value is None or isinstance(value, bool):
+        raise OperationError(f"{field} is required")
+
+    try:
+        amount = Decimal(str(value))
+    except InvalidOperation:
+        raise OperationError(f"{field} must be a number")
+
+    if not amount.is_finite():
+        raise OperationError(f"{field} must be a number")
+
+    # amounts are stored in whole cents
+    return from_cents(to_cents(amount))
+
+
+def parse_text(value, field, required=False):
+    if value is None or value == "":
+        if required:
+            raise OperationError(f"{field} is required")
+        return value
+
+    if not isinstance(value, str):
+        raise OperationError(f"{field} must be a string")
+
+    return value
+
+
+def parse_datetime(value, field):
+    if value is None or isinstance(value, datetime):
+        return value
+
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise OperationError(f"{field} must be an ISO 8601 date and time")
+
+
+class Batch(ABC):
+    """
+    Apply a list of operations to one of the user's tables
+
+    Subclasses name the client-writable fields, turn an operation into
+    column values in validate() and keep derived data in step in applied().
+    """
+
+    model = None
+    fields = ()
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.table = self.model.__table__
+        self.name = self.table.name
+        self.now = datetime.utcnow()
+
+    def prepare(self):
+        """Load whatever validate() checks against, once per batch"""
+
+    @abstractmethod
+    def validate(self, operation, row):
+        """Return the column values for a create, or an update of row"""
+
+    def blocked_deletes(self, rows):
+        """Return {id: reason} for rows that can't be deleted"""
+
+        return {}
+
+    def applied(self, created, updated, deleted):
+        """
+        Called inside the transaction with the new rows as dicts (with ids),
+        (old row, new values) pairs for updates and the deleted rows
+        """
+
+    def merge(self, operation, row):
+        """The operation's fields laid over the row's current values"""
+
+        return {
+            field: operation[field]
+            if field in operation
+            else (row[field] if row is not None else None)
+            for field in self.fields
+        }
+
+    def load(self, ids):
+        if not ids:
+            return {}
+
+        rows = {}
+        chunks = chunked(ids, MAX_VARIABLES - 1)
+        with query_budget(len(chunks)):
+            for chunk in chunks:
+                for row in db.session.execute(
+                    select([self.table])
+                    .where(self.table.c.user_id == self.user_id)
+                    .where(self.table.c.id.in_(chunk))
+                ):
+                    rows[row.id] = row
+
+        return rows
+
+    def run(self, operations):
+        results = [None] * len(operations)
+
+        targets = set()
+        for operation in operations:
+            if isinstance(operation, dict) and operation.get("op") != "create":
+                try:
+                    targets.add(parse_integer(operation.get("id"), "id"))
+                except OperationError:
+                    pass
+
+        existing = self.load(targets)
+        self.prepare()
+
+        creates, updates, deletes = [], [], []
+        seen = set()
+        for index, operation in enumerate(operations):
+            try:
+                if not isinstance(operation, dict):
+                    raise OperationError("operations must be objects")
+
+                op = operation.get("op")
+                if op == "create":
+                    creates.append((index, self.validate(operation, None)))
+                    continue
+                if op not in ("update", "delete"):
+                    raise OperationError("op must be create, update or delete")
+
+                row_id = parse_integer(operation.get("id"), "id")
+                row = existing.get(row_id)
+                if row is None:
+                    raise OperationError(f"{self.name} {row_id} not found")
+                if row_id in seen:
+                    raise OperationError(f"{self.name} {row_id} appears more than once")
+
+                if op == "update":
+                    updates.append((index, row, self.validate(operation, row)))
+                else:
+                    deletes.append((index, row))
+                seen.add(row_id)
+            except OperationError as e:
+                results[index] = {"index": index, "status": "error", "error": str(e)}
+
+        blocked = self.blocked_deletes([row for _, row in deletes])
+        for index, row in deletes:
+            if row.id in blocked:
+                results[index] = {
+                    "index": index,
+                    "status": "error",
+                    "error": blocked[row.id],
+                }
+        deletes = [(index, row) for index, row in deletes if row.id not in blocked]
+
+        try:
+            created = self.insert([values for _, values in creates])
+            self.update([(row, values) for _, row, values in updates])
+            self.delete([row for _, row in deletes])
+            self.applied(
+                created,
+                [(row, values) for _, row, values in updates],
+                [row for _, row in deletes],
+            )
+            if created or updates or deletes:
+                bump_data_version([self.user_id])
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+        for (index, _), values in zip(creates, created):
+            results[index] = {"index": index, "status": "created", "id": values["id"]}
+        for index, row, _ in updates:
+            results[index] = {"index": index, "status": "updated", "id": row.id}
+        for index, row in deletes:
+            results[index] = {"index": index, "status": "deleted", "id": row.id}
+
+        return results
+
+    def insert(self, rows):
+        if not rows:
+            return []
+
+        rows = [
+            dict(
+                values,
+                user_id=self.user_id,
+                created_date=self.now,
+                modified_date=self.now,
+            )
+            for values in rows
+        ]
+        # SQLite numbers the rows of one multi-row INSERT consecutively, in
+        # order, so they end at the id of the last row it inserted
+        chunks = chunked(rows, MAX_VARIABLES // len(rows[0]))
+        with query_budget(len(chunks)):
+            for chunk in chunks:
+                insert = self.table.insert().values(chunk)
+                last_id = db.session.execute(insert).lastrowid
+                for row_id, values in enumerate(chunk, last_id - len(chunk) + 1):
+                    values["id"] = row_id
+
+        return rows
+
+    def update(self, updates):
+        if not updates:
+            return
+
+        # the SET clause comes from the keys of the parameters
+        db.session.execute(
+            self.table.update().where(self.table.c.id == bindparam("key_id")),
+            [
+                dict(values, key_id=row.id, modified_date=self.now)
+                for row, values in updates
+            ],
+        )
+
+    def delete(self, rows):
+        if not rows:
+            return
+
+        row_ids = [row.id for row in rows]
+        record_deletes(self.user_id, self.name, row_ids)
+        chunks = chunked(row_ids, MAX_VARIABLES)
+        with query_budget(len(chunks)):
+            for chunk in chunks:
+                db.session.execute(
+                    self.table.delete().where(self.table.c.id.in_(chunk))
+                )
+
+
+class EntryBatch(Batch):
+    model = Entry
+    fields = ("description", "amount", "category_id", "effective_date")
+
+    def prepare(self):
+        self.category_ids = {
+            category_id
+            for (category_id,) in db.session.query(Category.id).filter(
+                Category.user_id == self.user_id
+            )
+        }
+
+    def validate(self, operation, row):
+        values = self.merge(operation, row)
+
+        values["description"] = parse_text(values["description"], "description")
+        values["amount"] = parse_amount(values["amount"], "amount")
+
+        values["category_id"] = parse_integer(values["category_id"], "category_id")
+        if values["category_id"] not in self.category_ids:
+            raise OperationError(f"category {values['category_id']} not found")
+
+        values["effective_date"] = (
+            parse_datetime(values["effective_date"], "effective_date") or self.now
+        )
+
+        return values
+
+    def applied(self, created, updated, deleted):
+        deltas = {}
+
+        for values in created:
+            add_delta(
+                deltas,
+                self.user_id,
+                values["category_id"],
+                values["effective_date"],
+                values["amount"],
+            )
+        for row, values in updated:
+            add_delta(
+                deltas,
+                row.user_id,
+                row.category_id,
+                row.effective_date,
+                -row.amount,
+                -1,
+            )
+            add_delta(
+                deltas,
+                self.user_id,
+                values["category_id"],
+                values["effective_date"],
+                values["amount"],
+            )
+        for row in deleted:
+            add_delta(
+                deltas,
+                row.user_id,
+                row.category_id,
+                row.effective_date,
+                -row.amount,
+                -1,
+            )
+
+        apply_deltas(deltas)
+
+
+class AccountBatch(Batch):
+    model = Account
+    fields = ("name", "description", "account_type_id", "initial_amount")
+
+    def validate(self, operation, row):
+        values = self.merge(operation, row)
+
+        values["name"] = parse_text(values["name"], "name", required=True)
+        values["description"] = parse_text(values["description"], "description")
+        values["initial_amount"] = parse_amount(
+            0 if values["initial_amount"] is None else values["initial_amount"],
+            "initial_amount",
+        )
+
+        account_type = account_types.by_id(values["account_type_id"])
+        if not account_type:
+            raise OperationError("account_type_id must be an account type")
+        values["account_type_id"] = account_type.id
+
+        # a new account has no entries yet
+        if row is None:
+            values["balance"] = values["initial_amount"]
+
+        return values
+
+    def applied(self, created, updated, deleted):
+        refresh_chunked_balances(
+            row.id
+            for row, values in updated
+            if row.initial_amount != values["initial_amount"]
+        )
+
+    def blocked_deletes(self, rows):
+        if not rows:
+            return {}
+
+        in_use = set()
+        chunks = chunked([row.id for row in rows], MAX_VARIABLES)
+        with query_budget(len(chunks)):
+            for chunk in chunks:
+                in_use.update(
+                    account_id
+                    for (account_id,) in db.session.query(Category.account_id)
+                    .filter(Category.account_id.in_(chunk))
+                    .distinct()
+                )
+
+        return {
+            account_id: f"account {account_id} still has categories"
+            for account_id in sorted(in_use)
+        }
+
+
+class CategoryBatch(Batch):
+    model = Category
+    fields = (
+        "name",
+        "description",
+        "budget_amount",
+        "category_type_id",
+        "account_id",
+    )
+
+    def prepare(self):
+        self.account_ids = {
+            account_id
+            for (account_id,) in db.session.query(Account.id).filter(
+                Account.user_id == self.user_id
+            )
+        }
+
+    def validate(self, operation, row):
+        values = self.merge(operation, row)
+
+        values["name"] = parse_text(values["name"], "name", required=True)
+        values["description"] = parse_text(values["description"], "description")
+        values["budget_amount"] = parse_amount(
+            0 if values["budget_amount"] is None else values["budget_amount"],
+            "budget_amount",
+        )
+
+        category_type = category_types.by_id(values["category_type_id"])
+        if not category_type:
+            raise OperationError("category_type_id must be a category type")
+        values["category_type_id"] = category_type.id
+
+        values["account_id"] = parse_integer(values["account_id"], "account_id")
+        if values["account_id"] not in self.account_ids:
+            raise OperationError(f"account {values['account_id']} not found")
+
+        return values
+
+    def blocked_deletes(self, rows):
+        if not rows:
+            return {}
+
+        chunks = chunked([row.id for row in rows], MAX_VARIABLES)
+
+        def in_use(entity):
+            return {
+                category_id
+                for chunk in chunks
+                for (category_id,) in db.session.query(entity.category_id)
+                .filter(entity.category_id.in_(chunk))
+                .distinct()
+            }
+
+        # archived entries still point at their categories; each archive is
+        # read as it's attached, as attaching more than ATTACHED_ARCHIVES
+        # detaches the ones attached first
+        with query_budget(len(chunks) * (1 + len(archived_years()))):
+            used = in_use(Entry)
+            for source in route_entries():
+                used |= in_use(source.entity)
+
+        return {
+            category_id: f"category {category_id} still has entries"
+            for category_id in sorted(used)
+        }
+
+    def applied(self, created, updated, deleted):
+        chunks = chunked([row.id for row in deleted], MAX_VARIABLES)
+        with query_budget(2 * len(chunks)):
+            for chunk in chunks:
+                MonthlyCategoryTotal.query.filter(
+                    MonthlyCategoryTotal.category_id.in_(chunk)
+                ).delete(synchronize_session=False)
+                RecurringEntry.query.filter(
+                    RecurringEntry.category_id.in_(chunk)
+                ).delete(synchronize_session=False)
+
+        # categories moved to another account, or between income and expense
+        moved = [
+            (row.account_id, values["account_id"])
+            for row, values in updated
+            if row.account_id != values["account_id"]
+            or row.category_type_id != values["category_type_id"]
+        ]
+        refresh_chunked_balances(
+            {account_id for accounts in moved for account_id in accounts}
+            | {row.account_id for row in deleted}
+        )
+
+
+def refresh_chunked_balances(account_ids):
+    """refresh_balances() for any number of accounts"""
+
+    chunks = chunked(account_ids, MAX_VARIABLES)
+    with query_budget(len(chunks)):
+        for chunk in chunks:
+            refresh_balances(chunk)
+
+
+def run_batch(batch_class):
+    body = request.get_json(silent=True)
+    operations = body.get("operations") if isinstance(body, dict) else None
+
+    if not isinstance(operations, list):
+        return error_response('Send a JSON object with an "operations" list', 400)
+
+    if len(operations) > MAX_OPERATIONS:
+        return error_response(
+            f"Send at most {MAX_OPERATIONS} operations per batch", 413
+        )
+
+    results = batch_class(session["user_id"]).run(operations)
+    statuses = [result["status"] for result in results]
+
+    return jsonify(
+        {
+            "results": results,
+            "created": statuses.count("created"),
+            "updated": statuses.count("updated"),
+            "deleted": statuses.count("deleted"),
+            "errors": statuses.count("error"),
+        }
+    )
+
+
+@api.route("/entries/batch", methods=["POST"])
+@api_login_required
+@query_budget(11)
+def batch_entries():
+    return run_batch(EntryBatch)
+
+
+@api.route("/accounts/batch", methods=["POST"])
+@api_login_required
+@query_budget(11)
+def batch_accounts():
+    return run_batch(AccountBatch)
+
+
+@api.route("/categories/batch", methods=["POST"])
+@api_login_required
+@query_budget(11)
+def batch_categories():
+    return run_batch(CategoryBatch)
+
+
+@api.route("/entries/search")
+@api_login_required
+@query_budget(1)
+def search():
+    try:
+        start_date = parse_date(request.args.get("start"))
+        end_date = parse_date(request.args.get("end"))
+    except ValueError:
+        return error_response("Dates must be formatted as YYYY-MM-DD", 400)
+
+    results = search_entries(
+        session["user_id"],
+        request.args.get("q"),
+        start_date=start_date,
+        end_date=end_date,
+        category_id=request.args.get("category", type=int),
+        limit=request.args.get("limit", DEFAULT_SEARCH_LIMIT, type=int),
+    )
+
+    return jsonify(
+        {
+            "entries": [
+                {
+                    "id": entry.id,
+                    "category_id": entry.category_id,
+                    "category": entry.category.name,
+                    "amount": str(entry.amount),
+                    "description": entry.description,
+                    "effective_date": entry.effective_date.isoformat()
+                    if entry.effective_date
+                    else None,
+                    "score": score,
+                }
+                for entry, score in results
+            ]
+        }
+    )
+
+
+@api.route("/changes")
+@api_login_required
+@query_budget(4)
+def changes():
+    try:
+        return jsonify(
+            get_changes(
+                session["user_id"],
+                cursor=request.args.get("since"),
+                limit=request.args.get("limit", DEFAULT_LIMIT, type=int),
+            )
+        )
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+
+@api.route("/reports/trends")
+@api_login_required
+@query_budget(2)
+def trends():
+    try:
+        start, end, window = parse_trend_args(request.args)
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+    if request.args.get("background"):
+        job_id = enqueue(
+            "trends_report",
+            {
+                "start": start.strftime("%Y-%m"),
+                "end": end.strftime("%Y-%m"),
+                "window": window,
+            },
+            user_id=session["user_id"],
+        )
+        return job_response(job_id, 202)
+
+    try:
+        trends = get_trends(session["user_id"], start, end, window)
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+    return jsonify(trends_json(trends))
+
+
+def job_response(job_id, code=200):
+    job = Job.query.filter_by(id=job_id, user_id=session["user_id"]).scalar()
+    if not job:
+        return error_response(f"job {job_id} not found", 404)
+
+    return jsonify(job_status(job)), code, {"Location": f"/api/v1/jobs/{job.id}"}
+
+
+@api.route("/jobs/<int:job_id>")
+@api_login_required
+@query_budget(1)
+def get_job(job_id):
+    return job_response(job_id)
+
+
+@api.route("/jobs/<int:job_id>/retry", methods=["POST"])
+@api_login_required
+@query_budget(2)
+def retry_job(job_id):
+    if not retry(job_id, session["user_id"]):
+        return error_response(f"job {job_id} not found or not failed", 409)
+
+    return job_response(job_id)
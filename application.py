@@ -1,24 +1,83 @@
+import click
 import os
 
-from datetime import datetime
-from dateutil import relativedelta
-from flask import Flask, redirect, render_template, request, session
-from flask_session import Session
+from datetime import date, datetime
+from flask import (
+    Flask,
+    Response,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    session,
+    stream_with_context,
+)
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
 from sqlalchemy.orm import joinedload
-from tempfile import mkdtemp
 from werkzeug.exceptions import default_exceptions, HTTPException, InternalServerError
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from constants import DB
-from helpers import apology, login_required, touch, usd
-from models import db, Account, AccountType, Category, CategoryType, Entry, User
+from api import api
+from balances import balances_as_of, refresh_balances, verify_balances
+from archive import archive_entries, vacuum_database
+from caching import bump_data_version, conditional, init_caching, set_cache_control
+from config import Config
+from database import configure_engine, engine_options
+from dashboard import get_dashboard
+from entries import DEFAULT_PAGE_SIZE, get_entries_page
+from instrumentation import init_instrumentation, query_budget
+from jobs import SUCCEEDED, JobWorkers, enqueue, job_file, job_status, start_workers
+from importer import (
+    DEFAULT_CHUNK_SIZE,
+    PARSERS,
+    import_entries,
+    parse_rules,
+    statement_format_for,
+)
+from exporter import FORMATS, export_rows
+from forecast import get_forecast
+from helpers import apology, login_required, parse_amount, parse_date, usd
+from migrations import stamp, upgrade
+from models import (
+    db,
+    Account,
+    AccountType,
+    Category,
+    CategoryType,
+    Entry,
+    Job,
+    MonthlyCategoryTotal,
+    RecurringEntry,
+    User,
+)
+from reference import (
+    account_types,
+    category_types,
+    invalidate_reference_types,
+    load_reference_types,
+)
+from recurring import FREQUENCIES, run_recurring, schedule, start_scheduler
+from reports import get_trends, parse_trend_args
+from rollups import (
+    add_delta,
+    apply_deltas,
+    apply_entry_delta,
+    rebuild,
+    verify,
+    year_month,
+)
+from search import DEFAULT_LIMIT as DEFAULT_SEARCH_LIMIT, search_entries
+from sessions import init_session
+from sync import record_deletes
+
+# registers the kinds of background job
+import tasks
 
 
 def create_app():
     # configure the app
     app = Flask(__name__)
+    app.config.from_object(Config)
 
     # ensure templates are auto-reloaded
     app.config["TEMPLATES_AUTO_RELOAD"] = True
@@ -26,21 +85,32 @@ def create_app():
     # custom filter
     app.jinja_env.filters["usd"] = usd
 
-    # configure session to use filesystem (instead of signed cookies)
-    app.config["SESSION_FILE_DIR"] = mkdtemp()
+    # configure server-side sessions (instead of signed cookies), stored in the
+    # db by default so every worker process shares them
     app.config["SESSION_PERMANENT"] = False
-    app.config["SESSION_TYPE"] = "filesystem"
+    app.config["SESSION_TYPE"] = os.environ.get("SESSION_TYPE", "sqlite")
 
-    # configure the db
-    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DB}"
-    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = True
+    # configure the db, tuning the engine and its connections from the config
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
     db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine, app.config)
+
+    init_session(app)
+
+    # time requests and their SQL, exposed at /metrics
+    init_instrumentation(app)
+
+    # ETags for the pages, and fingerprinted static file URLs
+    init_caching(app)
+
+    # JSON API under /api/v1
+    app.register_blueprint(api)
 
     return app
 
 
 app = create_app()
-Session(app)
 
 
 def initialize_db():
@@ -53,12 +123,24 @@ def initialize_db():
         print("    ----> Action cancelled")
         return
 
-    try:
-        os.remove(DB)
-    except:
-        pass
+    create_db()
+
+    print("    |")
+    print("    ----> Action completed")
+
+
+def create_db():
+    """Drop the database and recreate it with the reference types seeded"""
+
+    with app.app_context():
+        # close pooled connections so they don't keep the old database open
+        db.engine.dispose()
 
-    touch(DB)
+        for suffix in ["", "-wal", "-shm"]:
+            try:
+                os.remove(db.engine.url.database + suffix)
+            except:
+                pass
 
     chequing_account = AccountType(
         name="Chequing",
@@ -83,14 +165,193 @@ def initialize_db():
         db.session.add(income_category)
         db.session.add(expense_category)
         db.session.commit()
+        stamp()
+
+    invalidate_reference_types()
+
+
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    """Apply any pending schema migrations to the existing database"""
+
+    with app.app_context():
+        applied = upgrade()
 
     print("    |")
-    print("    ----> Action completed")
 
+    for version, description in applied:
+        print(f"    ----> Applied migration {version}: {description}")
+
+    if not applied:
+        print("    ----> Database is already up to date")
+
+
+@app.cli.command("rebuild-rollups")
+@click.option("--background", is_flag=True, help="Queue it as a job instead")
+def rebuild_rollups(background):
+    """Rebuild the monthly category rollups and balances from the raw entries"""
+
+    if background:
+        with app.app_context():
+            job_id = enqueue("rebuild_rollups")
+
+        print("    |")
+        print(f"    ----> Queued job {job_id}")
+        return
+
+    with app.app_context():
+        rollup_count = rebuild()
+        mismatches = verify()
+        balance_mismatches = verify_balances()
+
+    print("    |")
+    print(f"    ----> Rebuilt {rollup_count} monthly category totals")
+
+    for key, expected, actual in mismatches:
+        print(f"    ----> Mismatch for {key}: expected {expected}, found {actual}")
+
+    for account_id, expected, actual in balance_mismatches:
+        print(
+            f"    ----> Balance mismatch for account {account_id}: "
+            f"expected {expected}, found {actual}"
+        )
+
+    if mismatches or balance_mismatches:
+        raise SystemExit(1)
+
+
+@app.cli.command("archive-entries")
+@click.option("--keep-years", type=int, help="Years before this one to keep")
+@click.option("--vacuum", is_flag=True, help="Reclaim the space afterwards")
+def archive_old_entries(keep_years, vacuum):
+    """Move the entries of closed years out to per-year archive files"""
+
+    with app.app_context():
+        if keep_years is None:
+            keep_years = app.config["ARCHIVE_KEEP_YEARS"]
+        if keep_years < 1:
+            raise click.ClickException("Keep at least one year before this one")
+
+        moved = archive_entries(datetime(date.today().year - keep_years, 1, 1))
+        if vacuum:
+            vacuum_database()
+
+    print("    |")
+
+    for year, count in moved.items():
+        print(f"    ----> Archived {count} entries from {year}")
+
+    if not moved:
+        print("    ----> Nothing to archive")
+
+
+@app.cli.command("run-recurring")
+def run_recurring_entries():
+    """Add the entries that recurring entries have come due for"""
+
+    with app.app_context():
+        added = run_recurring()
+
+    print("    |")
+    print(f"    ----> Added {added} recurring entries")
+
+
+@app.cli.command("run-jobs")
+@click.option("--threads", type=int, help="Jobs to run at once")
+def run_jobs(threads):
+    """Run queued background jobs until stopped"""
+
+    workers = JobWorkers(app, threads or app.config["JOB_WORKERS"] or 1)
+
+    print("    |")
+    print(f"    ----> Running jobs on {workers.threads} threads")
+
+    workers.start().join()
+
+
+@app.cli.command("import-entries")
+@click.argument("username")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--default-category", required=True, help="Category name")
+@click.option("--rules", "rules_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--credit-category", help="Income category name for unmatched credits")
+@click.option("--format", "statement_format", type=click.Choice(list(PARSERS)))
+@click.option("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+def import_statement(
+    username,
+    path,
+    default_category,
+    rules_path,
+    credit_category,
+    statement_format,
+    chunk_size,
+):
+    """Import a CSV or OFX bank statement as a user's entries"""
+
+    statement_format = statement_format or statement_format_for(path)
+    if not statement_format:
+        raise click.ClickException("Pass --format for files without a .csv/.ofx name")
+
+    with app.app_context():
+        user = User.query.filter_by(username=username).scalar()
+        if not user:
+            raise click.ClickException(f"No user named {username}")
+
+        category = Category.query.filter_by(
+            user_id=user.id, name=default_category
+        ).first()
+        if not category:
+            raise click.ClickException(f"No category named {default_category}")
+
+        credit_category_id = None
+        if credit_category:
+            credit = Category.query.filter_by(
+                user_id=user.id,
+                name=credit_category,
+                category_type_id=category_types.by_name("Income").id,
+            ).first()
+            if not credit:
+                raise click.ClickException(
+                    f"No income category named {credit_category}"
+                )
+            credit_category_id = credit.id
+
+        try:
+            rules = []
+            if rules_path:
+                with open(rules_path) as rules_file:
+                    rules = parse_rules(user.id, rules_file.read())
+
+            with open(path, newline="", encoding="utf-8-sig") as statement:
+                imported, skipped = import_entries(
+                    user.id,
+                    PARSERS[statement_format](statement),
+                    category.id,
+                    rules=rules,
+                    credit_category_id=credit_category_id,
+                    chunk_size=chunk_size,
+                )
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+    print("    |")
+    print(f"    ----> Imported {imported} entries, skipped {skipped} invalid rows")
+
+
+@app.before_first_request
+def warm_caches():
+    load_reference_types()
+    start_scheduler(app)
+    start_workers(app)
 
-# ensure responses aren't cached
+
+# ensure responses aren't cached, unless they say how they may be with
+# set_cache_control(); static files are handled by caching.py, which runs after
 @app.after_request
 def after_request(response):
+    if getattr(response, "cache_control_set", False) or request.endpoint == "static":
+        return response
+
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Expires"] = 0
     response.headers["Pragma"] = "no-cache"
@@ -99,77 +360,26 @@ def after_request(response):
 
 @app.route("/")
 @login_required
+# the forecast is recomputed at most daily, with four statements of its own
+@query_budget(6)
+@conditional(daily=True)
 def index():
     with app.app_context():
-        user = User.query.filter_by(id=session["user_id"]).scalar()
-
-        today = datetime.today()
-        lower_date_bound = today.replace(day=1)
-        upper_date_bound = today + relativedelta.relativedelta(months=1, day=1)
-
-        expense_entries = (
-            db.session.query(
-                (Category.name).label("category_name"),
-                (Account.name).label("account_name"),
-                (Category.budget_amount).label("budget_amount"),
-                func.sum(Entry.amount).label("amount"),
-            )
-            .join(Entry.category)
-            .join(Category.account)
-            .join(Category.category_type)
-            .filter(Account.user_id == session["user_id"])
-            .filter(CategoryType.name == "Expense")
-            .filter(Entry.effective_date >= lower_date_bound)
-            .filter(Entry.effective_date < upper_date_bound)
-            .group_by(Category.id)
-        )
-
-        expense_amount = (
-            db.session.query(
-                func.sum(Entry.amount).label("amount"),
-            )
-            .join(Entry.category)
-            .join(Category.account)
-            .join(Category.category_type)
-            .filter(Account.user_id == session["user_id"])
-            .filter(CategoryType.name == "Expense")
-            .filter(Entry.effective_date >= lower_date_bound)
-            .filter(Entry.effective_date < upper_date_bound)
-            .first()
-        ).amount
-
-        income_amount = (
-            db.session.query(
-                func.sum(Entry.amount).label("amount"),
-            )
-            .join(Entry.category)
-            .join(Category.account)
-            .join(Category.category_type)
-            .filter(Account.user_id == session["user_id"])
-            .filter(CategoryType.name == "Income")
-            .filter(Entry.effective_date >= lower_date_bound)
-            .filter(Entry.effective_date < upper_date_bound)
-            .first()
-        ).amount
-
-        if not income_amount:
-            income_amount = 0
-
-        if not expense_amount:
-            expense_amount = 0
-
-        savings = income_amount - expense_amount
+        dashboard = get_dashboard(session["user_id"], year_month(datetime.today()))
+        forecast = get_forecast(session["user_id"])
+        db.session.commit()
 
     return render_template(
         "index.html",
-        username=user.username,
-        entries=expense_entries,
-        savings=savings,
-        income_amount=income_amount,
+        entries=dashboard["entries"],
+        savings=dashboard["savings"],
+        income_amount=dashboard["income_amount"],
+        forecast=forecast,
     )
 
 
 @app.route("/login", methods=["GET", "POST"])
+@query_budget(1)
 def login():
     """Log user in"""
 
@@ -189,16 +399,17 @@ def login():
 
         # Query database for username
         with app.app_context():
-            user = User.query.filter_by(username=request.form.get("username"))
+            user = User.query.filter_by(username=request.form.get("username")).first()
 
         # Ensure username exists and password is correct
-        if user.count() != 1 or not check_password_hash(
-            user.value("password"), request.form.get("password")
+        if user is None or not check_password_hash(
+            user.password, request.form.get("password")
         ):
             return apology("invalid username and/or password", 403)
 
-        # Remember which user has logged in
-        session["user_id"] = user.value("id")
+        # Remember which user has logged in, and their name for the navbar
+        session["user_id"] = user.id
+        session["username"] = user.username
 
         # Redirect user to home page
         return redirect("/")
@@ -209,6 +420,7 @@ def login():
 
 
 @app.route("/logout")
+@query_budget(0)
 def logout():
     """Log user out"""
 
@@ -220,6 +432,7 @@ def logout():
 
 
 @app.route("/register", methods=["GET", "POST"])
+@query_budget(6)
 def register():
     """Register user"""
 
@@ -270,11 +483,11 @@ def register():
     )
 
     with app.app_context():
-        chequing_account_type = AccountType.query.filter_by(name="Chequing").scalar()
-        savings_account_type = AccountType.query.filter_by(name="Savings").scalar()
+        chequing_account_type = account_types.by_name("Chequing")
+        savings_account_type = account_types.by_name("Savings")
 
-        income_category_type = CategoryType.query.filter_by(name="Income").scalar()
-        expense_category_type = CategoryType.query.filter_by(name="Expense").scalar()
+        income_category_type = category_types.by_name("Income")
+        expense_category_type = category_types.by_name("Expense")
 
     # setup default accounts and categoies
     chequing = Account(
@@ -284,7 +497,7 @@ def register():
         created_date=datetime.utcnow(),
         modified_date=datetime.utcnow(),
         user=user,
-        account_type=chequing_account_type,
+        account_type_id=chequing_account_type.id,
     )
 
     savings = Account(
@@ -294,7 +507,7 @@ def register():
         created_date=datetime.utcnow(),
         modified_date=datetime.utcnow(),
         user=user,
-        account_type=savings_account_type,
+        account_type_id=savings_account_type.id,
     )
 
     income = Category(
@@ -304,7 +517,7 @@ def register():
         created_date=datetime.utcnow(),
         modified_date=datetime.utcnow(),
         user=user,
-        category_type=income_category_type,
+        category_type_id=income_category_type.id,
         account=chequing,
     )
 
@@ -315,7 +528,7 @@ def register():
         created_date=datetime.utcnow(),
         modified_date=datetime.utcnow(),
         user=user,
-        category_type=expense_category_type,
+        category_type_id=expense_category_type.id,
         account=chequing,
     )
 
@@ -336,18 +549,15 @@ def register():
 
 @app.route("/add_account", methods=["GET", "POST"])
 @login_required
+@query_budget(2)
 def add_account():
     """
     Add account
     """
     if request.method == "GET":
-        user = User.query.filter_by(id=session["user_id"]).scalar()
-        account_types = AccountType.query.all()
-
         return render_template(
             "add_account.html",
-            username=user.username,
-            account_types=account_types,
+            account_types=account_types.all(),
         )
 
     # POST
@@ -355,7 +565,7 @@ def add_account():
     name = request.form.get("name")
     description = request.form.get("description")
     account_type_id = request.form.get("account_type")
-    initial_amount = request.form.get("initial_amount")
+    initial_amount = parse_amount(request.form.get("initial_amount"))
 
     if not name:
         return apology("Please provide an account name")
@@ -363,21 +573,26 @@ def add_account():
     if not description:
         return apology("Please provide an account descriptiona")
 
-    if not initial_amount:
+    if initial_amount is None:
         return apology("Please provide an initial amount")
 
+    account_type = account_types.by_id(account_type_id)
+    if not account_type:
+        return apology("Please provide an account type")
+
     with app.app_context():
-        account_type = AccountType.query.filter_by(id=account_type_id).scalar()
         account = Account(
             name=name,
             description=description,
             initial_amount=initial_amount,
+            balance=initial_amount,
             created_date=datetime.utcnow(),
             modified_date=datetime.utcnow(),
             user_id=session["user_id"],
-            account_type=account_type,
+            account_type_id=account_type.id,
         )
         db.session.add(account)
+        bump_data_version([session["user_id"]])
         db.session.commit()
 
     return redirect("/accounts")
@@ -385,6 +600,7 @@ def add_account():
 
 @app.route("/delete_account", methods=["POST"])
 @login_required
+@query_budget(6)
 def delete_account():
     """
     Delete account
@@ -392,8 +608,15 @@ def delete_account():
     account_id = request.form.get("delete")
 
     with app.app_context():
-        account = Account.query.filter_by(id=account_id).scalar()
+        account = Account.query.filter_by(
+            id=account_id, user_id=session["user_id"]
+        ).scalar()
+        if not account:
+            return apology("No such account", 404)
+
+        record_deletes(account.user_id, "account", [account.id])
         db.session.delete(account)
+        bump_data_version([account.user_id])
         db.session.commit()
 
     return redirect("/accounts")
@@ -401,6 +624,7 @@ def delete_account():
 
 @app.route("/edit_account", methods=["POST"])
 @login_required
+@query_budget(4)
 def edit_account():
     """
     Edit account
@@ -409,26 +633,35 @@ def edit_account():
     account_type_id = request.form.get("account_type")
     name = request.form.get("name")
     description = request.form.get("description")
-    initial_amount = request.form.get("initial_amount")
+    initial_amount = parse_amount(request.form.get("initial_amount"))
 
     if not name:
         return apology("Please provide an account name")
 
+    if initial_amount is None:
+        return apology("Please provide an initial amount")
+
+    account_type = account_types.by_id(account_type_id)
+    if not account_type:
+        return apology("Please provide an account type")
+
     with app.app_context():
         account = (
-            Account.query.options(joinedload("account_type"))
-            .filter(Account.id == account_id)
-            .filter(User.id == session["user_id"])
+            Account.query.filter(Account.id == account_id)
+            .filter(Account.user_id == session["user_id"])
             .scalar()
         )
-
-        account_type = AccountType.query.filter_by(id=account_type_id).scalar()
+        if not account:
+            return apology("No such account", 404)
 
         account.name = name
         account.description = description
-        account.account_type = account_type
+        account.account_type_id = account_type.id
         account.initial_amount = initial_amount
         account.modified_date = datetime.utcnow()
+        db.session.flush()
+        refresh_balances([account.id])
+        bump_data_version([account.user_id])
         db.session.commit()
 
     return redirect("/accounts")
@@ -436,27 +669,37 @@ def edit_account():
 
 @app.route("/accounts", methods=["GET", "POST"])
 @login_required
+@query_budget(5)
+@conditional()
 def manage_accounts():
     """
     Manage accounts
     """
     alert_message = ""
 
-    user = User.query.filter_by(id=session["user_id"]).scalar()
-
     if request.method == "GET":
+        try:
+            as_of = parse_date(request.args.get("as_of"))
+        except ValueError:
+            return apology("Dates must be formatted as YYYY-MM-DD")
+
         with app.app_context():
-            accounts = (
-                Account.query.options(joinedload("account_type"))
-                .filter(Account.user_id == session["user_id"])
-                .all()
-            )
+            accounts = Account.query.filter(Account.user_id == session["user_id"]).all()
+
+            # current balances are stored on the accounts, earlier ones are
+            # worked out from the monthly checkpoints
+            if as_of:
+                balances = balances_as_of(session["user_id"], as_of)
+            else:
+                balances = {account.id: account.balance for account in accounts}
 
         return render_template(
             "accounts.html",
-            username=user.username,
             alert_message=alert_message,
             accounts=accounts,
+            account_types=account_types,
+            balances=balances,
+            as_of=request.args.get("as_of", ""),
         )
 
     # POST
@@ -464,36 +707,31 @@ def manage_accounts():
     account_id = request.form.get("edit")
     with app.app_context():
         account = (
-            Account.query.options(joinedload("account_type"))
-            .filter(Account.user_id == session["user_id"])
+            Account.query.filter(Account.user_id == session["user_id"])
             .filter(Account.id == account_id)
             .scalar()
         )
-        account_types = AccountType.query.all()
 
     return render_template(
         "edit_account.html",
-        username=user.username,
         account=account,
-        account_types=account_types,
+        account_types=account_types.all(),
     )
 
 
 @app.route("/add_category", methods=["GET", "POST"])
 @login_required
+@query_budget(3)
 def add_category():
     """
     Add categories
     """
     if request.method == "GET":
-        user = User.query.filter_by(id=session["user_id"]).scalar()
-        category_types = CategoryType.query.all()
         accounts = Account.query.filter_by(user_id=session["user_id"]).all()
 
         return render_template(
             "add_category.html",
-            username=user.username,
-            category_types=category_types,
+            category_types=category_types.all(),
             accounts=accounts,
         )
 
@@ -508,9 +746,24 @@ def add_category():
     if not name:
         return apology("Please provide a category name")
 
+    if budget_amount:
+        budget_amount = parse_amount(budget_amount)
+        if budget_amount is None:
+            return apology("Please provide a valid budget amount")
+    else:
+        budget_amount = None
+
+    category_type = category_types.by_id(category_type_id)
+    if not category_type:
+        return apology("Please provide a category type")
+
     with app.app_context():
-        category_type = CategoryType.query.filter_by(id=category_type_id).scalar()
-        account = Account.query.filter_by(id=account_id).scalar()
+        account = Account.query.filter_by(
+            id=account_id, user_id=session["user_id"]
+        ).scalar()
+        if not account:
+            return apology("No such account", 404)
+
         category = Category(
             name=name,
             description=description,
@@ -518,10 +771,11 @@ def add_category():
             created_date=datetime.utcnow(),
             modified_date=datetime.utcnow(),
             user_id=session["user_id"],
-            category_type=category_type,
+            category_type_id=category_type.id,
             account=account,
         )
         db.session.add(category)
+        bump_data_version([session["user_id"]])
         db.session.commit()
 
     return redirect("/categories")
@@ -529,6 +783,7 @@ def add_category():
 
 @app.route("/delete_category", methods=["POST"])
 @login_required
+@query_budget(9)
 def delete_category():
     """
     Delete categories
@@ -536,8 +791,18 @@ def delete_category():
     category_id = request.form.get("delete")
 
     with app.app_context():
-        category = Category.query.filter_by(id=category_id).scalar()
+        category = Category.query.filter_by(
+            id=category_id, user_id=session["user_id"]
+        ).scalar()
+        if not category:
+            return apology("No such category", 404)
+
+        MonthlyCategoryTotal.query.filter_by(category_id=category.id).delete()
+        RecurringEntry.query.filter_by(category_id=category.id).delete()
+        refresh_balances([category.account_id])
+        record_deletes(category.user_id, "category", [category.id])
         db.session.delete(category)
+        bump_data_version([category.user_id])
         db.session.commit()
 
     return redirect("/categories")
@@ -545,6 +810,7 @@ def delete_category():
 
 @app.route("/edit_category", methods=["POST"])
 @login_required
+@query_budget(5)
 def edit_category():
     category_id = request.form.get("edit")
     category_type_id = request.form.get("category_type")
@@ -556,24 +822,53 @@ def edit_category():
     if not name:
         return apology("Please provide a category name")
 
+    if budget_amount:
+        budget_amount = parse_amount(budget_amount)
+        if budget_amount is None:
+            return apology("Please provide a valid budget amount")
+    else:
+        budget_amount = None
+
+    category_type = category_types.by_id(category_type_id)
+    if not category_type:
+        return apology("Please provide a category type")
+
     with app.app_context():
         category = (
-            Category.query.options(joinedload("category_type"))
-            .options(joinedload("account"))
+            Category.query.options(joinedload(Category.account))
             .filter(Category.id == category_id)
             .filter(Category.user_id == session["user_id"])
             .scalar()
         )
-
-        category_type = CategoryType.query.filter_by(id=category_type_id).scalar()
-        account = Account.query.filter_by(id=account_id).scalar()
+        if not category:
+            return apology("No such category", 404)
+
+        account = Account.query.filter_by(
+            id=account_id, user_id=session["user_id"]
+        ).scalar()
+        if not account:
+            return apology("No such account", 404)
+
+        moved = (
+            category.account_id != account.id
+            or category.category_type_id != category_type.id
+        )
+        previous_account_id = category.account_id
 
         category.name = name
         category.description = description
         category.budget_amount = budget_amount
-        category.category_type = category_type
+        category.category_type_id = category_type.id
         category.modified_date = datetime.utcnow()
         category.account = account
+
+        # the category's entries now count towards another balance, or the
+        # other way around
+        if moved:
+            db.session.flush()
+            refresh_balances({previous_account_id, account.id})
+
+        bump_data_version([category.user_id])
         db.session.commit()
 
     return redirect("/categories")
@@ -581,54 +876,51 @@ def edit_category():
 
 @app.route("/categories", methods=["GET", "POST"])
 @login_required
+@query_budget(3)
+@conditional()
 def manage_categories():
     """
     Manage expense categories
     """
     alert_message = ""
 
-    user = User.query.filter_by(id=session["user_id"]).scalar()
-
     if request.method == "GET":
         with app.app_context():
             categories = (
-                Category.query.options(joinedload("category_type"))
-                .options(joinedload("account"))
+                Category.query.options(joinedload(Category.account))
                 .filter(Category.user_id == session["user_id"])
                 .all()
             )
 
         return render_template(
             "categories.html",
-            username=user.username,
             alert_message=alert_message,
             categories=categories,
+            category_types=category_types,
         )
 
     if request.method == "POST":
         category_id = request.form.get("edit")
         with app.app_context():
             category = (
-                Category.query.options(joinedload("category_type"))
-                .options(joinedload("account"))
+                Category.query.options(joinedload(Category.account))
                 .filter(Category.user_id == session["user_id"])
                 .filter(Category.id == category_id)
                 .scalar()
             )
-            category_types = CategoryType.query.all()
             accounts = Account.query.filter_by(user_id=session["user_id"]).all()
 
         return render_template(
             "edit_category.html",
-            username=user.username,
             category=category,
-            category_types=category_types,
+            category_types=category_types.all(),
             accounts=accounts,
         )
 
 
 @app.route("/delete_entry", methods=["POST"])
 @login_required
+@query_budget(10)
 def delete_entry():
     """
     Delete entry
@@ -636,8 +928,20 @@ def delete_entry():
     entry_id = request.form.get("delete")
 
     with app.app_context():
-        entry = Entry.query.filter_by(id=entry_id).scalar()
+        entry = Entry.query.filter_by(id=entry_id, user_id=session["user_id"]).scalar()
+        if not entry:
+            return apology("No such entry", 404)
+
+        apply_entry_delta(
+            entry.user_id,
+            entry.category_id,
+            entry.effective_date,
+            -entry.amount,
+            count=-1,
+        )
+        record_deletes(entry.user_id, "entry", [entry.id])
         db.session.delete(entry)
+        bump_data_version([entry.user_id])
         db.session.commit()
 
     return redirect("/entries")
@@ -645,29 +949,39 @@ def delete_entry():
 
 @app.route("/add_entry", methods=["GET", "POST"])
 @login_required
+@query_budget(9)
 def add_entry():
     """
-    Add entries
+    Add entries, optionally repeating them on a schedule
     """
     if request.method == "GET":
-        user = User.query.filter_by(id=session["user_id"]).scalar()
         categories = Category.query.filter_by(user_id=session["user_id"]).all()
 
         return render_template(
-            "add_entry.html", username=user.username, categories=categories
+            "add_entry.html", categories=categories, frequencies=FREQUENCIES
         )
 
     # POST
 
     category = request.form.get("category")
-    amount = request.form.get("amount")
+    amount = parse_amount(request.form.get("amount"))
     description = request.form.get("description")
+    frequency = request.form.get("frequency")
+    interval = request.form.get("interval", 1, type=int)
 
-    if not amount:
+    if amount is None:
         return apology("Please provide an entry amount")
 
+    if frequency and (frequency not in FREQUENCIES or interval < 1):
+        return apology("Please choose how often the entry repeats")
+
     with app.app_context():
-        category = Category.query.filter_by(id=category).scalar()
+        category = Category.query.filter_by(
+            id=category, user_id=session["user_id"]
+        ).scalar()
+        if not category:
+            return apology("No such category", 404)
+
         entry = Entry(
             description=description,
             amount=amount,
@@ -678,41 +992,109 @@ def add_entry():
             category=category,
         )
         db.session.add(entry)
+        if frequency:
+            db.session.add(schedule(entry, frequency, interval))
+        apply_entry_delta(
+            entry.user_id, category.id, entry.effective_date, entry.amount
+        )
+        bump_data_version([entry.user_id])
         db.session.commit()
 
     return redirect("/entries")
 
 
+@app.route("/recurring")
+@login_required
+@query_budget(3)
+@conditional()
+def manage_recurring():
+    """
+    List recurring entries
+    """
+    with app.app_context():
+        recurring_entries = (
+            RecurringEntry.query.options(joinedload(RecurringEntry.category))
+            .filter(RecurringEntry.user_id == session["user_id"])
+            .order_by(RecurringEntry.next_date)
+            .all()
+        )
+
+    return render_template("recurring.html", recurring_entries=recurring_entries)
+
+
+@app.route("/delete_recurring", methods=["POST"])
+@login_required
+@query_budget(4)
+def delete_recurring():
+    """
+    Stop a recurring entry; the entries it already added are kept
+    """
+    recurring_id = request.form.get("delete")
+
+    with app.app_context():
+        RecurringEntry.query.filter_by(
+            id=recurring_id, user_id=session["user_id"]
+        ).delete()
+        bump_data_version([session["user_id"]])
+        db.session.commit()
+
+    return redirect("/recurring")
+
+
 @app.route("/edit_entry", methods=["POST"])
 @login_required
+@query_budget(9)
 def edit_entry():
     """
     Edit entry
     """
     entry_id = request.form.get("edit")
-    amount = request.form.get("amount")
+    amount = parse_amount(request.form.get("amount"))
     category = request.form.get("category")
     description = request.form.get("description")
     effective_date = datetime.strptime(
         request.form.get("effective_date"), "%Y-%m-%d %H:%M:%S.%f"
     )
 
-    if not amount:
+    if amount is None:
         return apology("Please provide an entry amount")
 
     with app.app_context():
         entry = (
-            Entry.query.options(joinedload("category"))
+            Entry.query.options(joinedload(Entry.category))
             .filter(Entry.id == entry_id)
-            .filter(User.id == session["user_id"])
+            .filter(Entry.user_id == session["user_id"])
             .scalar()
         )
+        if not entry:
+            return apology("No such entry", 404)
+
+        category = Category.query.filter_by(
+            id=category, user_id=session["user_id"]
+        ).scalar()
+        if not category:
+            return apology("No such category", 404)
+
+        # back the old values out of their rollup and balance, and add the new
+        # ones, in a single pass over the rollups
+        deltas = {}
+        add_delta(
+            deltas,
+            entry.user_id,
+            entry.category_id,
+            entry.effective_date,
+            -entry.amount,
+            count=-1,
+        )
+        add_delta(deltas, entry.user_id, category.id, effective_date, amount)
 
         entry.amount = amount
-        entry.category_id = category
+        entry.category_id = category.id
         entry.description = description
         entry.effective_date = effective_date
         entry.modified_date = datetime.utcnow()
+        apply_deltas(deltas)
+        bump_data_version([entry.user_id])
         db.session.commit()
 
     return redirect("/entries")
@@ -720,46 +1102,291 @@ def edit_entry():
 
 @app.route("/entries", methods=["GET", "POST"])
 @login_required
+@query_budget(8)
+@conditional()
 def manage_entries():
     """
     Manage entries
+
+    A page that reaches into archived years runs one more statement for each.
     """
     alert_message = ""
 
-    user = User.query.filter_by(id=session["user_id"]).scalar()
-
     if request.method == "GET":
+        try:
+            start_date = parse_date(request.args.get("start"))
+            end_date = parse_date(request.args.get("end"))
+            page_size = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+        except ValueError:
+            return apology("Dates must be formatted as YYYY-MM-DD")
+
+        category_id = request.args.get("category", type=int)
+        account_id = request.args.get("account", type=int)
+
         with app.app_context():
-            entries = (
-                Entry.query.options(joinedload("category"))
-                .filter(Entry.user_id == session["user_id"])
-                .order_by(Entry.effective_date.desc())
-                .all()
+            entries, next_cursor = get_entries_page(
+                session["user_id"],
+                cursor=request.args.get("cursor"),
+                page_size=page_size,
+                start_date=start_date,
+                end_date=end_date,
+                category_id=category_id,
+                account_id=account_id,
             )
-            # categories = Category.query.options(joinedload('category_type')).all()
-            # categories = Category.query.filter_by(user_id=session["user_id"]).all()
+            categories = Category.query.filter_by(user_id=session["user_id"]).all()
+            accounts = Account.query.filter_by(user_id=session["user_id"]).all()
+
+        # keep the filters when following the links to other pages
+        first_args = request.args.to_dict()
+        first_args.pop("cursor", None)
+
+        next_args = None
+        if next_cursor:
+            next_args = dict(first_args, cursor=next_cursor)
 
         return render_template(
             "entries.html",
-            username=user.username,
             alert_message=alert_message,
             entries=entries,
+            categories=categories,
+            accounts=accounts,
+            filters=request.args,
+            first_args=first_args,
+            next_args=next_args,
         )
 
     if request.method == "POST":
         entry_id = request.form.get("edit")
         with app.app_context():
             entry = (
-                Entry.query.options(joinedload("category"))
+                Entry.query.options(joinedload(Entry.category))
                 .filter(Entry.user_id == session["user_id"])
                 .filter(Entry.id == entry_id)
                 .scalar()
             )
-            categories = Category.query.all()
+            categories = Category.query.filter_by(user_id=session["user_id"]).all()
 
         return render_template(
             "edit_entry.html",
-            username=user.username,
             entry=entry,
             categories=categories,
         )
+
+
+@app.route("/search")
+@login_required
+@query_budget(2)
+def search():
+    """
+    Search entry descriptions
+    """
+    try:
+        start_date = parse_date(request.args.get("start"))
+        end_date = parse_date(request.args.get("end"))
+    except ValueError:
+        return apology("Dates must be formatted as YYYY-MM-DD")
+
+    with app.app_context():
+        results = search_entries(
+            session["user_id"],
+            request.args.get("q"),
+            start_date=start_date,
+            end_date=end_date,
+            category_id=request.args.get("category", type=int),
+            limit=request.args.get("limit", DEFAULT_SEARCH_LIMIT, type=int),
+        )
+        categories = Category.query.filter_by(user_id=session["user_id"]).all()
+
+    return render_template(
+        "search.html", results=results, categories=categories, filters=request.args
+    )
+
+
+@app.route("/import", methods=["GET", "POST"])
+@login_required
+@query_budget(4)
+def import_statement_entries():
+    """
+    Import entries from a bank statement, as a background job
+    """
+    income = category_types.by_name("Income")
+
+    if request.method == "GET":
+        categories = Category.query.filter_by(user_id=session["user_id"]).all()
+
+        return render_template(
+            "import_entries.html",
+            categories=categories,
+            income_categories=[
+                category
+                for category in categories
+                if category.category_type_id == income.id
+            ],
+        )
+
+    # POST
+
+    statement = request.files.get("statement")
+    category_id = request.form.get("category")
+    credit_category_id = request.form.get("credit_category")
+
+    if not statement or not statement.filename:
+        return apology("Please provide a statement file")
+
+    statement_format = statement_format_for(statement.filename)
+    if not statement_format:
+        return apology("Statements must be CSV or OFX files")
+
+    with app.app_context():
+        category = Category.query.filter_by(
+            id=category_id, user_id=session["user_id"]
+        ).scalar()
+        if not category:
+            return apology("Please provide a default category")
+
+        credit_category = None
+        if credit_category_id:
+            credit_category = Category.query.filter_by(
+                id=credit_category_id,
+                user_id=session["user_id"],
+                category_type_id=income.id,
+            ).scalar()
+            if not credit_category:
+                return apology("Credits must go to an income category")
+
+        # the job parses them again, this only checks them up front
+        try:
+            parse_rules(session["user_id"], request.form.get("rules"))
+        except ValueError as e:
+            return apology(str(e))
+
+        job_id = enqueue(
+            "import_statement",
+            {
+                "statement_format": statement_format,
+                "category_id": category.id,
+                "credit_category_id": credit_category and credit_category.id,
+                "rules": request.form.get("rules") or "",
+            },
+            user_id=session["user_id"],
+            files={"statement": statement.save},
+        )
+
+    return redirect(f"/jobs/{job_id}")
+
+
+@app.route("/export")
+@login_required
+@query_budget(1)
+def export_entries():
+    """
+    Export entries as CSV or NDJSON
+
+    The response is streamed as the rows are read, so the export is never held
+    in memory. It deliberately skips the app_context() block used elsewhere:
+    stream_with_context keeps the request, and its db session, alive until
+    the last row has been sent. With background=1 the export is written to a
+    file by a background job instead, to download from the job's page.
+    """
+    export_format = request.args.get("format", "csv")
+    if export_format not in FORMATS:
+        return apology("Exports must be csv or ndjson")
+
+    try:
+        start_date = parse_date(request.args.get("start"))
+        end_date = parse_date(request.args.get("end"))
+    except ValueError:
+        return apology("Dates must be formatted as YYYY-MM-DD")
+
+    if request.args.get("background"):
+        with app.app_context():
+            job_id = enqueue(
+                "export_entries",
+                {
+                    "export_format": export_format,
+                    "start": request.args.get("start"),
+                    "end": request.args.get("end"),
+                },
+                user_id=session["user_id"],
+            )
+
+        return redirect(f"/jobs/{job_id}")
+
+    generate, mimetype = FORMATS[export_format]
+    rows = export_rows(session["user_id"], start_date=start_date, end_date=end_date)
+
+    return Response(
+        stream_with_context(generate(rows)),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f"attachment; filename=entries.{export_format}"
+        },
+    )
+
+
+@app.route("/jobs/<int:job_id>")
+@login_required
+@query_budget(1)
+def show_job(job_id):
+    """
+    A background job's status, which the page polls until it finishes
+    """
+    with app.app_context():
+        job = Job.query.filter_by(id=job_id, user_id=session["user_id"]).scalar()
+
+    if not job:
+        return apology("No such job", 404)
+
+    return render_template("job.html", job=job_status(job))
+
+
+@app.route("/jobs/<int:job_id>/download")
+@login_required
+@query_budget(1)
+def download_job_file(job_id):
+    """
+    Download the file a finished export job wrote
+    """
+    with app.app_context():
+        job = Job.query.filter_by(id=job_id, user_id=session["user_id"]).scalar()
+
+    result = job_status(job)["result"] if job and job.status == SUCCEEDED else None
+    if not result or "filename" not in result:
+        return apology("No such export", 404)
+
+    response = send_file(
+        job_file(job.id, result["filename"]),
+        mimetype=result["mimetype"],
+        as_attachment=True,
+        attachment_filename=result["filename"],
+        cache_timeout=0,
+    )
+
+    # exports are the user's own data
+    return set_cache_control(response, "private, no-store")
+
+
+@app.route("/reports/trends")
+@login_required
+@query_budget(1)
+def trends_report():
+    """
+    Budget vs. actual per category over a range of months
+    """
+    try:
+        start, end, window = parse_trend_args(request.args)
+    except ValueError as e:
+        return apology(str(e))
+
+    try:
+        with app.app_context():
+            trends = get_trends(session["user_id"], start, end, window)
+    except ValueError as e:
+        return apology(str(e))
+
+    return render_template(
+        "trends.html",
+        trends=trends,
+        start=start.strftime("%Y-%m"),
+        end=end.strftime("%Y-%m"),
+    )
@@ -0,0 +1,293 @@
+"""
+Archives of entries from closed years
+
+`flask archive-entries` moves the entries of every year before the last
+ARCHIVE_KEEP_YEARS out of the entry table, into a SQLite file per year under
+ARCHIVE_DIR. The entry table then only holds recent years, so the dashboard,
+the forecasts, search and the first pages of the entries listing read a
+small table that stays in cache, and vacuuming and backing up the main
+database stay quick. The rollups and balances still count archived entries,
+so nothing built on them changes.
+
+Reads of entries by date always read the entry table, as entries of any
+date can still be added to it, and then the archives that route_entries()
+picks for the date range, one year at a time, so a listing that is
+satisfied by the recent entries never opens an archive. Archives are
+attached to a pooled connection the first time it reads from them; SQLite
+allows ten attached databases, so only the ATTACHED_ARCHIVES most recently
+used stay attached.
+
+Archived entries are read-only: edits and deletes only reach the entry
+table, and search only covers it. Entry ids are kept; the entry table
+AUTOINCREMENTs its ids, so an id that has been archived is never handed
+out again.
+"""
+import os
+import re
+import sqlite3
+
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import Column, Index, MetaData, Table, and_, exists, select, text
+from sqlalchemy.orm import aliased
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from caching import bump_data_version
+from models import db, Entry
+
+# at most this many archives stay attached to a connection at once
+ATTACHED_ARCHIVES = 8
+
+ARCHIVE_FILE = re.compile(r"^entry_(\d{4})\.db$")
+
+archive_metadata = MetaData()
+
+_archive_tables = {}
+_archived_years = (None, [])
+
+
+class Source(namedtuple("Source", ["entity", "table", "year"])):
+    """
+    Where to read entries from: an entity mapped like Entry, its table, and
+    the year of the archive, None for the entry table itself
+    """
+
+    __slots__ = ()
+
+    @property
+    def archived(self):
+        return self.year is not None
+
+
+def archive_directory():
+    """ARCHIVE_DIR, relative paths being taken from the database's directory"""
+
+    directory = current_app.config["ARCHIVE_DIR"]
+    if not os.path.isabs(directory):
+        database = os.path.abspath(db.engine.url.database)
+        directory = os.path.join(os.path.dirname(database), directory)
+
+    return directory
+
+
+def archived_years():
+    """The years that have an archive, oldest first"""
+
+    global _archived_years
+
+    directory = archive_directory()
+    try:
+        modified = os.stat(directory).st_mtime_ns
+    except FileNotFoundError:
+        return []
+
+    # the directory's mtime changes when an archive is added or removed
+    if _archived_years[0] != (directory, modified):
+        years = sorted(
+            int(match.group(1))
+            for match in map(ARCHIVE_FILE.match, os.listdir(directory))
+            if match
+        )
+        _archived_years = ((directory, modified), years)
+
+    return _archived_years[1]
+
+
+def archive_table(year):
+    """The entry table of a year's archive, without the foreign keys"""
+
+    table = _archive_tables.get(year)
+    if table is None:
+        columns = Entry.__table__.columns
+        table = Table(
+            "entry",
+            archive_metadata,
+            *[
+                Column(column.name, column.type, primary_key=column.primary_key)
+                for column in columns
+            ],
+            schema=f"archive_{year}",
+        )
+        Index(
+            "ix_entry_user_id_effective_date",
+            table.c.user_id,
+            table.c.effective_date,
+            table.c.category_id,
+            table.c.amount,
+        )
+        Index("ix_entry_user_id_modified_date", table.c.user_id, table.c.modified_date)
+        Index("ix_entry_category_id", table.c.category_id)
+        _archive_tables[year] = table
+
+    return table
+
+
+def archive_path(year):
+    """The file of a year's archive"""
+
+    return os.path.join(archive_directory(), f"entry_{year}.db")
+
+
+def create_archive(year):
+    """
+    Create a year's archive file, with its table and indexes, if it doesn't
+    exist yet
+
+    The file is built under another name and then moved into place, so no
+    reader ever finds an archive without its table.
+    """
+    path = archive_path(year)
+    if os.path.exists(path):
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    building = f"{path}.new"
+    if os.path.exists(building):
+        os.remove(building)
+
+    table = archive_table(year)
+    connection = sqlite3.connect(":memory:")
+    try:
+        connection.execute(f"ATTACH DATABASE ? AS {table.schema}", (building,))
+        for statement in [CreateTable(table)] + [
+            CreateIndex(index) for index in table.indexes
+        ]:
+            connection.execute(str(statement.compile(dialect=db.engine.dialect)))
+    finally:
+        connection.close()
+
+    os.replace(building, path)
+
+
+def attach(year):
+    """Attach a year's archive to the session's connection"""
+
+    connection = db.session.connection()
+    attached = connection.connection.info.setdefault("archives", OrderedDict())
+
+    if year in attached:
+        attached.move_to_end(year)
+        return
+
+    # ATTACH and DETACH aren't queries; running them on the raw connection
+    # keeps them out of the query budgets
+    cursor = connection.connection.cursor()
+    try:
+        while len(attached) >= ATTACHED_ARCHIVES:
+            oldest, _ = attached.popitem(last=False)
+            cursor.execute(f"DETACH DATABASE archive_{oldest}")
+
+        cursor.execute(f"ATTACH DATABASE ? AS archive_{year}", (archive_path(year),))
+    finally:
+        cursor.close()
+    attached[year] = True
+
+
+def _source(year=None):
+    if year is None:
+        return Source(Entry, Entry.__table__, None)
+
+    attach(year)
+    table = archive_table(year)
+    entity = aliased(Entry, table, name=f"archive_{year}_entry", adapt_on_names=True)
+
+    return Source(entity, table, year)
+
+
+def route_entries(start_date=None, end_date=None, newest_first=False):
+    """
+    Yield a Source for each archive a range of entries reaches into, in date
+    order; the end date is exclusive
+
+    The entry table may hold entries of any date, so it always has to be read
+    as well. Archives are attached as they are reached, so a caller that has
+    read enough can stop without touching the older ones.
+    """
+    years = [
+        year
+        for year in archived_years()
+        if (start_date is None or start_date < datetime(year + 1, 1, 1))
+        and (end_date is None or end_date > datetime(year, 1, 1))
+    ]
+
+    for year in reversed(years) if newest_first else years:
+        yield _source(year)
+
+
+def entry_sources():
+    """Yield a Source for the entry table and then for each archive"""
+
+    yield _source()
+    yield from route_entries()
+
+
+def archive_entries(before):
+    """
+    Move the entries dated before the start of a year into the archives
+
+    Returns {year: entries moved}. Each year is copied into its archive and
+    then deleted in one transaction, but SQLite only commits a transaction
+    across attached WAL databases atomically per file, so a failure can
+    leave entries in both. Running the archive again finishes the job: it
+    only deletes those, as they are identical to their archived copies. An
+    archived entry sharing an id with a different entry raises ValueError
+    rather than being replaced.
+    """
+    entry = Entry.__table__
+    columns = [column.name for column in entry.columns]
+
+    first = (
+        db.session.query(db.func.min(entry.c.effective_date))
+        .filter(entry.c.effective_date < before)
+        .scalar()
+    )
+    if first is None:
+        return {}
+
+    moved = {}
+    for year in range(first.year, before.year):
+        lower, upper = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+        in_year = (entry.c.effective_date >= lower) & (entry.c.effective_date < upper)
+        if not db.session.query(exists().where(in_year)).scalar():
+            continue
+
+        create_archive(year)
+        attach(year)
+        table = archive_table(year)
+
+        # both tables are named entry, so the archive needs an alias to tell
+        # them apart in a subquery
+        copy = table.alias(f"archive_{year}_entry")
+        archived = copy.c.id == entry.c.id
+        identical = and_(*[copy.c[name].op("IS")(entry.c[name]) for name in columns])
+        clash = db.session.query(
+            exists().where(in_year).where(exists().where(archived).where(~identical))
+        ).scalar()
+        if clash:
+            raise ValueError(f"Entries of {year} clash with ids in its archive")
+
+        db.session.execute(
+            table.insert().from_select(
+                columns,
+                select([entry.c[name] for name in columns])
+                .where(in_year)
+                .where(~exists().where(archived)),
+            )
+        )
+        moved[year] = db.session.execute(entry.delete().where(in_year)).rowcount
+        db.session.commit()
+
+    # listings mark archived entries, so cached pages are out of date
+    bump_data_version()
+    db.session.commit()
+
+    return moved
+
+
+def vacuum_database():
+    """Reclaim the space archived entries left in the main database"""
+
+    db.session.commit()
+    with db.engine.connect() as connection:
+        connection.execute(text("VACUUM main"))
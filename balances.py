@@ -0,0 +1,184 @@
+"""
+Account balances
+
+An account's balance is its initial amount, plus the entries in its income
+categories, less the entries in its expense categories. The current balance
+is stored on Account.balance and adjusted in the same transaction as every
+entry write, so listing balances costs nothing extra.
+
+Balances as of an earlier date use the monthly category rollups as month-end
+checkpoints: the months before the date come from the rollups, one row per
+category per month, and only the entries from the start of the date's month
+up to the date are read. A back-dated entry still only changes one rollup
+row, where stored month-end balances would each need rewriting.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from sqlalchemy import bindparam, case, func, select
+
+from archive import entry_sources, route_entries
+from instrumentation import query_budget
+from models import db, Account, Category, Entry, MonthlyCategoryTotal
+from reference import category_types
+
+
+def signed(amount):
+    """An amount as it counts towards its category's account balance"""
+
+    income = category_types.by_name("Income").id
+
+    return case([(Category.category_type_id == income, amount)], else_=-amount)
+
+
+def apply_balance_deltas(category_amounts):
+    """
+    Add a mapping of category_id -> amount of entry changes to the balances
+    of the categories' accounts, in the current session's transaction
+    """
+    category_amounts = {
+        category_id: amount
+        for category_id, amount in category_amounts.items()
+        if amount
+    }
+
+    if not category_amounts:
+        return
+
+    income = category_types.by_name("Income").id
+    account_deltas = defaultdict(Decimal)
+    for category_id, account_id, category_type_id in db.session.query(
+        Category.id, Category.account_id, Category.category_type_id
+    ).filter(Category.id.in_(category_amounts)):
+        amount = Decimal(str(category_amounts[category_id]))
+        account_deltas[account_id] += amount if category_type_id == income else -amount
+
+    table = Account.__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.id == bindparam("key_id"))
+        .values(
+            balance=table.c.balance + bindparam("delta", type_=table.c.balance.type),
+            modified_date=datetime.utcnow(),
+        ),
+        [
+            {"key_id": account_id, "delta": delta}
+            for account_id, delta in account_deltas.items()
+        ],
+    )
+
+
+def refresh_balances(account_ids=None):
+    """
+    Recompute balances from the initial amounts and the rollups
+
+    For changes that move whole categories between accounts or flip their
+    type, or change an initial amount. Every account when account_ids is None.
+    """
+    if account_ids is not None:
+        account_ids = [account_id for account_id in account_ids if account_id]
+        if not account_ids:
+            return
+
+    table = Account.__table__
+    totals = MonthlyCategoryTotal.__table__
+    contribution = (
+        select([func.coalesce(func.sum(signed(totals.c.amount)), 0)])
+        .select_from(totals.join(Category.__table__))
+        .where(Category.account_id == table.c.id)
+        .as_scalar()
+    )
+
+    statement = table.update().values(
+        balance=func.coalesce(table.c.initial_amount, 0) + contribution,
+        modified_date=datetime.utcnow(),
+    )
+    if account_ids is not None:
+        statement = statement.where(table.c.id.in_(account_ids))
+
+    db.session.execute(statement)
+
+
+def balances_as_of(user_id, as_of):
+    """Return {account_id: balance} for a user at the end of a date"""
+
+    month_start = datetime(as_of.year, as_of.month, 1)
+    until = datetime.combine(as_of, time()) + timedelta(days=1)
+
+    balances = {
+        account_id: Decimal(initial_amount or 0)
+        for account_id, initial_amount in db.session.query(
+            Account.id, Account.initial_amount
+        ).filter(Account.user_id == user_id)
+    }
+
+    def add(query):
+        for account_id, amount in query:
+            if account_id in balances:
+                balances[account_id] += Decimal(amount or 0)
+
+    def month_entries(entity):
+        return (
+            db.session.query(Category.account_id, func.sum(signed(entity.amount)))
+            .join(entity.category)
+            .filter(entity.user_id == user_id)
+            .filter(entity.effective_date >= month_start)
+            .filter(entity.effective_date < until)
+            .group_by(Category.account_id)
+        )
+
+    add(
+        db.session.query(
+            Category.account_id, func.sum(signed(MonthlyCategoryTotal.amount))
+        )
+        .join(MonthlyCategoryTotal.category)
+        .filter(MonthlyCategoryTotal.user_id == user_id)
+        .filter(MonthlyCategoryTotal.year_month < month_start.strftime("%Y-%m"))
+        .group_by(Category.account_id)
+    )
+
+    # the month may be archived, and may still have entries in the entry table
+    add(month_entries(Entry))
+    # a month is in at most one archive
+    with query_budget(1):
+        for source in route_entries(month_start, until):
+            add(month_entries(source.entity))
+
+    return balances
+
+
+def verify_balances():
+    """
+    Compare the stored balances against a full sum of the entries
+
+    Returns a list of (account_id, expected, actual) tuples for every mismatch.
+    """
+    expected = {
+        account_id: Decimal(initial_amount or 0)
+        for account_id, initial_amount in db.session.query(
+            Account.id, Account.initial_amount
+        )
+    }
+
+    for source in entry_sources():
+        entity = source.entity
+        for account_id, amount in (
+            db.session.query(Category.account_id, func.sum(signed(entity.amount)))
+            .join(entity.category)
+            .filter(entity.effective_date.isnot(None))
+            .group_by(Category.account_id)
+        ):
+            if account_id in expected:
+                expected[account_id] += Decimal(amount or 0)
+
+    actual = dict(db.session.query(Account.id, Account.balance))
+
+    return [
+        (
+            account_id,
+            round(expected[account_id], 2),
+            round(Decimal(actual[account_id]), 2),
+        )
+        for account_id in sorted(expected)
+        if round(expected[account_id], 2) != round(Decimal(actual[account_id]), 2)
+    ]
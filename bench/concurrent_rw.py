@@ -0,0 +1,182 @@
+"""
+Measure concurrent read/write throughput with and without the engine tuning
+
+    $ python -m bench.concurrent_rw --writers 4 --readers 4 --seconds 5
+
+Runs writer processes committing one entry per transaction (like add_entry)
+alongside reader processes summing a month of entries, first with a default
+SQLAlchemy engine and then with the pool and pragmas from config.Config, and
+reports operations per second and "database is locked" failures for each.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from config import Config
+from database import configure_engine, engine_options
+from models import db
+
+INSERT = text(
+    "INSERT INTO entry (description, amount, effective_date, created_date, "
+    "modified_date, user_id, category_id) "
+    "VALUES ('bench', :amount, :effective_date, :now, :now, :user_id, :category_id)"
+)
+
+MONTH_TOTAL = text(
+    "SELECT category_id, SUM(amount) FROM entry "
+    "WHERE user_id = :user_id AND effective_date >= :lower "
+    "AND effective_date < :upper GROUP BY category_id"
+)
+
+
+def tuned_config(path):
+    config = {key: getattr(Config, key) for key in dir(Config) if key.isupper()}
+    config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+
+    return config
+
+
+def make_engine(path, tuned):
+    if not tuned:
+        return create_engine(f"sqlite:///{path}")
+
+    config = tuned_config(path)
+    engine = create_engine(config["SQLALCHEMY_DATABASE_URI"], **engine_options(config))
+    configure_engine(engine, config)
+
+    return engine
+
+
+def seed(path, users, entries):
+    engine = create_engine(f"sqlite:///{path}")
+    db.Model.metadata.create_all(engine)
+    engine.dispose()
+
+    now = datetime(2020, 1, 1)
+    rng = random.Random(0)
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        "INSERT INTO user (id, username, email, password, created_date, "
+        "modified_date, data_version) VALUES (?, ?, ?, 'x', ?, ?, 0)",
+        [(i, f"user{i}", f"user{i}", now, now) for i in range(1, users + 1)],
+    )
+    connection.executemany(
+        "INSERT INTO entry (description, amount, effective_date, created_date, "
+        "modified_date, user_id, category_id) VALUES ('', ?, ?, ?, ?, ?, ?)",
+        (
+            (
+                rng.randrange(100, 50001),
+                now + timedelta(minutes=rng.randrange(3 * 365 * 24 * 60)),
+                now,
+                now,
+                rng.randrange(1, users + 1),
+                rng.randrange(1, 11),
+            )
+            for _ in range(entries)
+        ),
+    )
+    connection.commit()
+    connection.close()
+
+
+def worker(path, tuned, role, users, seconds, results):
+    engine = make_engine(path, tuned)
+    rng = random.Random(os.getpid())
+    operations = 0
+    locked = 0
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        user_id = rng.randrange(1, users + 1)
+        try:
+            if role == "writer":
+                with engine.begin() as connection:
+                    connection.execute(
+                        INSERT,
+                        amount=rng.randrange(100, 50001),
+                        effective_date=datetime.utcnow(),
+                        now=datetime.utcnow(),
+                        user_id=user_id,
+                        category_id=rng.randrange(1, 11),
+                    )
+            else:
+                lower = datetime(2020 + rng.randrange(3), rng.randrange(1, 13), 1)
+                with engine.connect() as connection:
+                    connection.execute(
+                        MONTH_TOTAL,
+                        user_id=user_id,
+                        lower=lower,
+                        upper=lower + timedelta(days=31),
+                    ).fetchall()
+            operations += 1
+        except OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            locked += 1
+
+    results.put((role, operations, locked))
+
+
+def run(path, tuned, args):
+    # reset the journal mode so the baseline really runs without WAL
+    if not tuned:
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode = DELETE")
+        connection.close()
+
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=worker,
+            args=(path, tuned, role, args.users, args.seconds, results),
+        )
+        for role in ["writer"] * args.writers + ["reader"] * args.readers
+    ]
+    for process in processes:
+        process.start()
+
+    totals = {"writer": [0, 0], "reader": [0, 0]}
+    for _ in processes:
+        role, operations, locked = results.get()
+        totals[role][0] += operations
+        totals[role][1] += locked
+
+    for process in processes:
+        process.join()
+
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--entries", type=int, default=200000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    seed(path, args.users, args.entries)
+
+    print(f"{args.writers} writers, {args.readers} readers, {args.seconds}s each\n")
+    for label, tuned in [("default engine", False), ("tuned engine", True)]:
+        totals = run(path, tuned, args)
+        print(label)
+        for role, (operations, locked) in totals.items():
+            print(
+                f"    {role}s {operations / args.seconds:10,.0f} ops/sec"
+                f"  {locked} locked errors"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Compare query plans and timings for the hot queries with and without the
+indexes declared in models.py
+
+    $ python -m bench.explain_indexes --entries 1000000
+
+Builds a throwaway SQLite database from the models, fills it with synthetic
+entries, then runs each query against the bare tables and again after the
+indexes have been created.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+
+from models import db
+
+QUERIES = {
+    "entries page": (
+        "SELECT id, description, amount, effective_date, category_id FROM entry "
+        "WHERE user_id = :user_id ORDER BY effective_date DESC LIMIT 50"
+    ),
+    "month by category": (
+        "SELECT category_id, SUM(amount) FROM entry "
+        "WHERE user_id = :user_id AND effective_date >= :lower "
+        "AND effective_date < :upper GROUP BY category_id"
+    ),
+    "entries by account": (
+        "SELECT COUNT(*), SUM(entry.amount) FROM entry "
+        "JOIN category ON entry.category_id = category.id "
+        "WHERE category.account_id = :account_id"
+    ),
+    "user categories": "SELECT id, name FROM category WHERE user_id = :user_id",
+    "user accounts": "SELECT id, name FROM account WHERE user_id = :user_id",
+}
+
+
+def build(path, users, entries):
+    """Create the schema and fill it with deterministic synthetic rows"""
+
+    engine = create_engine(f"sqlite:///{path}")
+    db.Model.metadata.create_all(engine)
+    engine.dispose()
+
+    rng = random.Random(0)
+    now = datetime(2020, 1, 1)
+    connection = sqlite3.connect(path)
+
+    connection.execute(
+        "INSERT INTO account_type VALUES (1, 'Chequing', ?, ?)", (now, now)
+    )
+    connection.executemany(
+        "INSERT INTO category_type VALUES (?, ?, ?, ?)",
+        [(1, "Income", now, now), (2, "Expense", now, now)],
+    )
+
+    categories = []
+    for user_id in range(1, users + 1):
+        connection.execute(
+            "INSERT INTO user (id, username, email, password, created_date, "
+            "modified_date, data_version) VALUES (?, ?, ?, 'x', ?, ?, 0)",
+            (user_id, f"user{user_id}", f"user{user_id}@example.com", now, now),
+        )
+        for account in range(2):
+            account_id = (user_id - 1) * 2 + account + 1
+            connection.execute(
+                "INSERT INTO account (id, name, description, initial_amount, balance, "
+                "created_date, modified_date, user_id, account_type_id) "
+                "VALUES (?, 'Account', '', 0, 0, ?, ?, ?, 1)",
+                (account_id, now, now, user_id),
+            )
+            for category in range(10):
+                category_id = len(categories) + 1
+                categories.append((category_id, user_id))
+                connection.execute(
+                    "INSERT INTO category (id, name, description, budget_amount, "
+                    "created_date, modified_date, user_id, category_type_id, "
+                    "account_id) VALUES (?, 'Category', '', 10000, ?, ?, ?, ?, ?)",
+                    (category_id, now, now, user_id, 1 + (category > 0), account_id),
+                )
+
+    def rows():
+        for entry_id in range(1, entries + 1):
+            category_id, user_id = rng.choice(categories)
+            effective_date = now + timedelta(minutes=rng.randrange(5 * 365 * 24 * 60))
+            # in cents
+            amount = rng.randrange(100, 50001)
+            yield (entry_id, "", amount, effective_date, now, now, user_id, category_id)
+
+    connection.executemany(
+        "INSERT INTO entry (id, description, amount, effective_date, created_date, "
+        "modified_date, user_id, category_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows(),
+    )
+    connection.commit()
+
+    return connection
+
+
+def run(connection, params, repeat):
+    results = {}
+    for name, query in QUERIES.items():
+        plan = connection.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            connection.execute(query, params).fetchall()
+        elapsed = (time.perf_counter() - start) / repeat
+        results[name] = ([row[-1] for row in plan], elapsed)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    connection = build(path, args.users, args.entries)
+
+    indexes = [
+        (name, sql)
+        for name, sql in connection.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"
+        )
+    ]
+    for name, _ in indexes:
+        connection.execute(f"DROP INDEX {name}")
+    connection.execute("ANALYZE")
+
+    params = {
+        "user_id": 1,
+        "account_id": 1,
+        "lower": datetime(2022, 6, 1),
+        "upper": datetime(2022, 7, 1),
+    }
+
+    before = run(connection, params, args.repeat)
+
+    for _, sql in indexes:
+        connection.execute(sql)
+    connection.execute("ANALYZE")
+
+    after = run(connection, params, args.repeat)
+
+    print(f"{args.entries} entries across {args.users} users\n")
+    for name in QUERIES:
+        (before_plan, before_time), (after_plan, after_time) = before[name], after[name]
+        print(name)
+        print(f"    before {before_time * 1000:9.3f} ms  {'; '.join(before_plan)}")
+        print(f"    after  {after_time * 1000:9.3f} ms  {'; '.join(after_plan)}")
+
+    connection.close()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Deterministic synthetic data for benchmarks
+
+    $ DATABASE_URL=sqlite:////tmp/bench.db python -m bench.generate \\
+        --users 10 --accounts 3 --categories 12 --entries 1000000
+
+Recreates the configured database and fills it with N users, each with M
+accounts, K categories spread across them and an equal share of the entries.
+The same arguments and seed always produce the same rows. Every user's
+password is PASSWORD. Rows are written with bulk executemany inserts, then
+the monthly rollups are rebuilt from them.
+"""
+import argparse
+import random
+import time
+
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
+
+from models import db, Account, Category, Entry, User
+from reference import account_types, category_types
+from rollups import rebuild
+
+PASSWORD = "password"
+
+CHUNK_SIZE = 10000
+
+DESCRIPTIONS = [
+    "Groceries",
+    "Coffee",
+    "Rent",
+    "Payroll",
+    "Hardware store",
+    "Pharmacy",
+    "Restaurant",
+    "Utilities",
+    "Transit",
+    "Bookstore",
+]
+
+
+def generate(users, accounts, categories, entries, years=5, seed=0):
+    """
+    Fill the current app's database; call inside an app context
+
+    Returns the list of generated usernames.
+    """
+    rng = random.Random(seed)
+    created = datetime(2020, 1, 1)
+    start = datetime.today().replace(
+        hour=0, minute=0, second=0, microsecond=0
+    ) - timedelta(days=365 * years)
+    span_minutes = int((datetime.today() - start).total_seconds() // 60)
+
+    # hashing is deliberately slow, so every user shares one hash
+    password = generate_password_hash(PASSWORD)
+    account_type_ids = [account_type.id for account_type in account_types.all()]
+    income = category_types.by_name("Income").id
+    expense = category_types.by_name("Expense").id
+
+    usernames = [f"user{user}" for user in range(1, users + 1)]
+    db.session.execute(
+        User.__table__.insert(),
+        [
+            {
+                "username": username,
+                "email": f"{username}@example.com",
+                "password": password,
+                "created_date": created,
+                "modified_date": created,
+            }
+            for username in usernames
+        ],
+    )
+    user_ids = [user.id for user in User.query.filter(User.username.in_(usernames))]
+
+    db.session.execute(
+        Account.__table__.insert(),
+        [
+            {
+                "name": f"Account {account}",
+                "description": "Generated account",
+                "initial_amount": rng.randrange(0, 5000),
+                "created_date": created,
+                "modified_date": created,
+                "user_id": user_id,
+                "account_type_id": account_type_ids[account % len(account_type_ids)],
+            }
+            for user_id in user_ids
+            for account in range(accounts)
+        ],
+    )
+    account_ids = {}
+    for account in Account.query.filter(Account.user_id.in_(user_ids)):
+        account_ids.setdefault(account.user_id, []).append(account.id)
+
+    # the first category of every user is income, the rest are expenses
+    db.session.execute(
+        Category.__table__.insert(),
+        [
+            {
+                "name": "Income" if category == 0 else f"Category {category}",
+                "description": "Generated category",
+                "budget_amount": rng.randrange(50, 1000),
+                "created_date": created,
+                "modified_date": created,
+                "user_id": user_id,
+                "category_type_id": income if category == 0 else expense,
+                "account_id": account_ids[user_id][category % accounts],
+            }
+            for user_id in user_ids
+            for category in range(categories)
+        ],
+    )
+    category_ids = {}
+    for category in Category.query.filter(Category.user_id.in_(user_ids)):
+        category_ids.setdefault(category.user_id, []).append(category.id)
+    db.session.commit()
+
+    chunk = []
+    for index in range(entries):
+        user_id = user_ids[index % len(user_ids)]
+        effective_date = start + timedelta(minutes=rng.randrange(span_minutes))
+        chunk.append(
+            {
+                "description": rng.choice(DESCRIPTIONS),
+                "amount": round(rng.uniform(1, 500), 2),
+                "effective_date": effective_date,
+                "created_date": effective_date,
+                "modified_date": effective_date,
+                "user_id": user_id,
+                "category_id": rng.choice(category_ids[user_id]),
+            }
+        )
+
+        if len(chunk) == CHUNK_SIZE:
+            db.session.execute(Entry.__table__.insert(), chunk)
+            db.session.commit()
+            chunk = []
+
+    if chunk:
+        db.session.execute(Entry.__table__.insert(), chunk)
+        db.session.commit()
+
+    rebuild()
+
+    return usernames
+
+
+def main():
+    from application import app, create_db
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--accounts", type=int, default=3)
+    parser.add_argument("--categories", type=int, default=12)
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    create_db()
+    with app.app_context():
+        generate(
+            args.users,
+            args.accounts,
+            args.categories,
+            args.entries,
+            years=args.years,
+            seed=args.seed,
+        )
+        print(f"generated {args.entries} entries in {db.engine.url}", end=" ")
+
+    print(f"in {time.perf_counter() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
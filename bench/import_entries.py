@@ -0,0 +1,124 @@
+"""
+Measure statement import throughput
+
+    $ python -m bench.import_entries --rows 100000
+
+Writes a synthetic CSV statement, imports it into a throwaway database with
+the same code path as `flask import-entries` and reports rows/sec.
+"""
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+from flask import Flask
+
+from importer import DEFAULT_CHUNK_SIZE, import_entries, parse_csv, parse_rules
+from models import db, Account, AccountType, Category, CategoryType, User
+
+
+def create_bench_app(path):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+
+    return app
+
+
+def seed():
+    now = datetime.utcnow()
+    user = User(
+        username="bench",
+        email="bench",
+        password="x",
+        created_date=now,
+        modified_date=now,
+    )
+    account_type = AccountType(name="Chequing", created_date=now, modified_date=now)
+    account = Account(
+        name="Chequing",
+        initial_amount=0,
+        created_date=now,
+        modified_date=now,
+        user=user,
+        account_type=account_type,
+    )
+    for name in ["Income", "Expense"]:
+        category_type = CategoryType(name=name, created_date=now, modified_date=now)
+        for category_name in (
+            [name, "Groceries", "Dining"] if name == "Expense" else [name]
+        ):
+            db.session.add(
+                Category(
+                    name=category_name,
+                    budget_amount=100,
+                    created_date=now,
+                    modified_date=now,
+                    user=user,
+                    category_type=category_type,
+                    account=account,
+                )
+            )
+    db.session.commit()
+
+    return user
+
+
+def write_statement(path, rows):
+    rng = random.Random(0)
+    start = datetime(2015, 1, 1)
+    payees = ["PAYROLL", "GROCER", "CAFE", "RESTAURANT", "HARDWARE", "PHARMACY"]
+
+    with open(path, "w", newline="") as statement:
+        writer = csv.writer(statement)
+        writer.writerow(["Date", "Description", "Amount"])
+        for _ in range(rows):
+            writer.writerow(
+                [
+                    (start + timedelta(days=rng.randrange(3650))).strftime("%Y-%m-%d"),
+                    f"{rng.choice(payees)} #{rng.randrange(1000)}",
+                    f"{rng.uniform(-500, 500):.2f}",
+                ]
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    statement_path = os.path.join(directory, "statement.csv")
+    write_statement(statement_path, args.rows)
+
+    app = create_bench_app(os.path.join(directory, "bench.db"))
+    with app.app_context():
+        db.create_all()
+        user = seed()
+        default_category = Category.query.filter_by(name="Expense").first()
+        rules = parse_rules(
+            user.id, "payroll = Income\ngrocer = Groceries\ncafe = Dining"
+        )
+
+        start = time.perf_counter()
+        with open(statement_path, newline="") as statement:
+            imported, skipped = import_entries(
+                user.id,
+                parse_csv(statement),
+                default_category.id,
+                rules=rules,
+                chunk_size=args.chunk_size,
+            )
+        elapsed = time.perf_counter() - start
+
+    print(f"imported {imported} rows ({skipped} skipped) in {elapsed:.2f} s")
+    print(f"{imported / elapsed:,.0f} rows/sec with chunks of {args.chunk_size}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+Benchmark the main routes against a generated database
+
+    $ python -m bench.routes --entries 1000000 --requests 200
+    $ python -m bench.routes --compare bench/results/<earlier run>.json
+
+Builds a fresh database in a temporary directory with bench.generate, then
+drives each route through the Flask test client as a logged in user and
+reports latency percentiles, SQL statements per request and peak Python
+memory per request (from tracemalloc, on a separate pass so the tracing
+overhead stays out of the timings). The results are written as JSON to
+bench/results/ so runs from different commits can be compared.
+
+The render cache is turned off, or the pages would be rendered once and
+then served from it, and the runs would time the cache rather than the
+views; --render-cache leaves it on to time cached pages instead.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime
+from sqlalchemy import event
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except:
+        return None
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def scenarios(app, client, username):
+    """
+    Return (name, request) pairs; each request makes one call on the client
+
+    The add/edit/delete scenario goes through all three write routes per
+    call, so every iteration leaves the database as it found it.
+    """
+    from models import Category, Entry
+
+    with app.app_context():
+        user_categories = Category.query.filter(
+            Category.user.has(username=username)
+        ).all()
+        category_ids = [category.id for category in user_categories]
+        user_id = user_categories[0].user_id
+
+    def add_edit_delete():
+        client.post(
+            "/add_entry",
+            data={"category": category_ids[0], "amount": "12.34", "description": "b"},
+        )
+        with app.app_context():
+            entry = (
+                Entry.query.filter_by(user_id=user_id).order_by(Entry.id.desc()).first()
+            )
+            entry_id, effective_date = entry.id, entry.effective_date
+        client.post(
+            "/edit_entry",
+            data={
+                "edit": entry_id,
+                "amount": "43.21",
+                "category": category_ids[-1],
+                "description": "bench",
+                "effective_date": effective_date.strftime("%Y-%m-%d %H:%M:%S.%f"),
+            },
+        )
+        client.post("/delete_entry", data={"delete": entry_id})
+
+    this_year = f"{datetime.today().year}-01-01"
+
+    return [
+        ("index", lambda: client.get("/")),
+        ("entries", lambda: client.get("/entries")),
+        ("entries_filtered", lambda: client.get(f"/entries?start={this_year}")),
+        ("categories", lambda: client.get("/categories")),
+        ("trends", lambda: client.get("/reports/trends")),
+        ("search", lambda: client.get("/search?q=coffee")),
+        (
+            "login",
+            lambda: client.post(
+                "/login", data={"username": username, "password": "password"}
+            ),
+        ),
+        ("add_edit_delete_entry", add_edit_delete),
+    ]
+
+
+def measure(app, request, repeat, warmup):
+    from models import db
+
+    counter = StatementCounter()
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", counter)
+
+    try:
+        for _ in range(warmup):
+            request()
+
+        counter.count = 0
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            request()
+            timings.append((time.perf_counter() - started) * 1000)
+        statements = counter.count / repeat
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
+
+    tracemalloc.start()
+    peaks = []
+    for _ in range(min(repeat, 10)):
+        tracemalloc.reset_peak()
+        request()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+
+    return {
+        "requests": repeat,
+        "p50_ms": round(percentile(timings, 0.50), 3),
+        "p90_ms": round(percentile(timings, 0.90), 3),
+        "p99_ms": round(percentile(timings, 0.99), 3),
+        "mean_ms": round(statistics.mean(timings), 3),
+        "sql_statements": round(statements, 2),
+        "peak_memory_kib": round(max(peaks) / 1024, 1),
+    }
+
+
+def compare(previous, current):
+    print(f"\ncompared with {previous.get('commit')} ({previous.get('created')})")
+    for name, stats in current["routes"].items():
+        before = previous["routes"].get(name)
+        if before is None:
+            continue
+        change = (stats["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100
+        print(
+            f"    {name:24} p50 {before['p50_ms']:9.2f} -> {stats['p50_ms']:9.2f} ms"
+            f" ({change:+.0f}%)  sql {before['sql_statements']:g} -> "
+            f"{stats['sql_statements']:g}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--accounts", type=int, default=3)
+    parser.add_argument("--categories", type=int, default=12)
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument(
+        "--render-cache",
+        action="store_true",
+        help="serve pages from the render cache after the first request",
+    )
+    parser.add_argument("--output", help="results file, default bench/results/")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    args = parser.parse_args()
+
+    # the app reads its database from the environment when it is imported
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    if not args.render_cache:
+        os.environ["RENDER_CACHE_MAX_BYTES"] = "0"
+        os.environ.pop("RENDER_CACHE_PATH", None)
+    sys.argv = sys.argv[:1]
+
+    from application import app, create_db
+    from bench.generate import generate
+
+    started = time.perf_counter()
+    create_db()
+    with app.app_context():
+        usernames = generate(
+            args.users, args.accounts, args.categories, args.entries, seed=args.seed
+        )
+    print(f"generated {args.entries} entries in {time.perf_counter() - started:.1f} s")
+
+    client = app.test_client()
+    client.post("/login", data={"username": usernames[0], "password": "password"})
+
+    results = {
+        "commit": git_commit(),
+        "created": datetime.utcnow().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "parameters": {
+            key: getattr(args, key)
+            for key in [
+                "users",
+                "accounts",
+                "categories",
+                "entries",
+                "seed",
+                "render_cache",
+            ]
+        },
+        "routes": {},
+    }
+
+    print(f"\n{'route':28}{'p50':>9}{'p90':>9}{'p99':>9}{'sql':>7}{'peak KiB':>10}")
+    for name, request in scenarios(app, client, usernames[0]):
+        stats = measure(app, request, args.requests, args.warmup)
+        results["routes"][name] = stats
+        print(
+            f"    {name:24}{stats['p50_ms']:9.2f}{stats['p90_ms']:9.2f}"
+            f"{stats['p99_ms']:9.2f}{stats['sql_statements']:7g}"
+            f"{stats['peak_memory_kib']:10.1f}"
+        )
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(
+            RESULTS_DIR,
+            f"{results['created'].replace(':', '')}-{results['commit'] or 'local'}.json",
+        )
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nwrote {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
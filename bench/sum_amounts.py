@@ -0,0 +1,130 @@
+"""
+Compare SUM throughput over amounts stored as NUMERIC(18, 2) and as cents
+
+    $ python -m bench.sum_amounts --entries 1000000
+
+Fills two copies of the entry amounts in a throwaway SQLite database, one
+with the decimal values the columns used to hold and one with whole cents,
+then times a full-table SUM and a SUM grouped by category over each, both
+through sqlite3 directly and through SQLAlchemy, which returns Decimals, and
+reading every amount through SQLAlchemy. Also reports the raw total SQLite
+returns, to show the floating point drift of the decimal column.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from decimal import Decimal
+from sqlalchemy import Column, Integer, MetaData, Numeric, Table, create_engine
+from sqlalchemy import func, select
+
+from models import Money
+
+metadata = MetaData()
+
+TABLES = {
+    "numeric": Table(
+        "entry_numeric",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("category_id", Integer, nullable=False),
+        Column("amount", Numeric(18, 2)),
+    ),
+    "cents": Table(
+        "entry_cents",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("category_id", Integer, nullable=False),
+        Column("amount", Money),
+    ),
+}
+
+
+def build(path, entries, categories):
+    """Create both tables and fill them with the same deterministic amounts"""
+
+    engine = create_engine(f"sqlite:///{path}")
+    metadata.create_all(engine)
+    engine.dispose()
+
+    rng = random.Random(0)
+    rows = [
+        (entry_id, rng.randrange(1, categories + 1), rng.randrange(1, 50001))
+        for entry_id in range(1, entries + 1)
+    ]
+
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        "INSERT INTO entry_numeric VALUES (?, ?, ?)",
+        ((entry_id, category_id, cents / 100) for entry_id, category_id, cents in rows),
+    )
+    connection.executemany("INSERT INTO entry_cents VALUES (?, ?, ?)", rows)
+    connection.commit()
+    connection.execute("VACUUM")
+    connection.close()
+
+    return sum(cents for _, _, cents in rows)
+
+
+def timed(function, repeat):
+    function()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--categories", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    exact = Decimal(build(path, args.entries, args.categories)).scaleb(-2)
+
+    connection = sqlite3.connect(path)
+    engine = create_engine(f"sqlite:///{path}")
+
+    print(f"{args.entries} entries in {args.categories} categories\n")
+    for name, table in TABLES.items():
+        total = select([func.sum(table.c.amount)])
+        grouped = select([table.c.category_id, func.sum(table.c.amount)]).group_by(
+            table.c.category_id
+        )
+        amounts = select([table.c.amount])
+        raw_total = str(total.compile(engine))
+        raw_grouped = str(grouped.compile(engine))
+
+        sa_connection = engine.connect()
+        runs = {
+            "sqlite3 total": lambda: connection.execute(raw_total).fetchall(),
+            "sqlite3 by category": lambda: connection.execute(raw_grouped).fetchall(),
+            "SQLAlchemy total": lambda: sa_connection.execute(total).fetchall(),
+            "SQLAlchemy by category": lambda: sa_connection.execute(grouped).fetchall(),
+            "SQLAlchemy every amount": lambda: sa_connection.execute(
+                amounts
+            ).fetchall(),
+        }
+
+        print(name)
+        for label, run in runs.items():
+            elapsed = timed(run, args.repeat)
+            rate = args.entries / elapsed / 1e6
+            print(f"    {label:24} {elapsed * 1000:9.3f} ms  {rate:8.1f} M rows/s")
+        raw = connection.execute(raw_total).fetchone()[0]
+        print(f"    SQLite total {raw!r}, exact {exact}")
+        sa_connection.close()
+
+    connection.close()
+    engine.dispose()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Conditional GETs for the pages and long-lived caching for static files
+
+Every user has a data_version that is bumped in the same transaction as any
+change to their accounts, categories or entries. The pages that only show a
+user's own data derive a weak ETag from it, the user and a fingerprint of
+the templates and static files, so a browser revalidating a page it already
+has gets a 304 after one primary key lookup, before the view queries or
+renders anything. The dashboard's ETag also covers the date, as its month
+and forecast move on each day.
+
+Pages that aren't current in the browser are served from the render cache
+when another request has already rendered them, see render_cache.py. Only
+a miss runs the view.
+
+Static files are linked with a hash of their contents in the query string,
+and those URLs are cached for a year; the URL changes with the file. Other
+responses keep the app's default of not being cached at all, unless they set
+their own Cache-Control with set_cache_control(); a Cache-Control header set
+any other way, such as by send_file(), is replaced.
+"""
+import hashlib
+import os
+
+from datetime import date
+from flask import current_app, request, session, url_for
+from functools import wraps
+from werkzeug.security import safe_join
+
+from models import db, User
+from render_cache import RenderCache, page_key
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+_file_fingerprints = {}
+_release_fingerprint = None
+
+
+def bump_data_version(user_ids=None):
+    """
+    Mark users' data as changed, in the current session's transaction; every
+    user when user_ids is None
+    """
+    table = User.__table__
+    statement = table.update().values(data_version=table.c.data_version + 1)
+
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        statement = statement.where(table.c.id.in_(user_ids))
+
+    db.session.execute(statement)
+
+    # the new version already keys them out, this just frees the space
+    render_cache = current_app.extensions.get("render_cache")
+    if render_cache is not None:
+        render_cache.invalidate_users(user_ids)
+
+
+def get_data_version(user_id):
+    return db.session.query(User.data_version).filter(User.id == user_id).scalar()
+
+
+def _hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def file_fingerprint(filename):
+    """A short hash of a static file's contents, None if there is no such file"""
+
+    fingerprint = _file_fingerprints.get(filename)
+    if fingerprint is None or current_app.debug:
+        path = safe_join(current_app.static_folder, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        fingerprint = _file_fingerprints[filename] = _hash_file(path)[:12]
+
+    return fingerprint
+
+
+def release_fingerprint():
+    """A hash over every template and static file, so a deploy changes ETags"""
+
+    global _release_fingerprint
+
+    if _release_fingerprint is None or current_app.debug:
+        digest = hashlib.sha1()
+        for folder in [
+            os.path.join(current_app.root_path, current_app.template_folder),
+            current_app.static_folder,
+        ]:
+            for root, dirs, files in sorted(os.walk(folder)):
+                dirs.sort()
+                for name in sorted(files):
+                    digest.update(name.encode())
+                    digest.update(_hash_file(os.path.join(root, name)).encode())
+        _release_fingerprint = digest.hexdigest()
+
+    return _release_fingerprint
+
+
+def set_cache_control(response, value):
+    """Set how a response may be cached, in place of the app's default"""
+
+    response.headers["Cache-Control"] = value
+    response.cache_control_set = True
+
+    return response
+
+
+def static_url(filename):
+    """The fingerprinted URL of a static file, for templates"""
+
+    return url_for("static", filename=filename, v=file_fingerprint(filename))
+
+
+def _render(view, args, kwargs, user_id, versions):
+    """Serve a page from the render cache, or run the view and cache it"""
+
+    render_cache = current_app.extensions.get("render_cache")
+    if render_cache is None:
+        return current_app.make_response(view(*args, **kwargs))
+
+    key = page_key(user_id, request.endpoint, request.query_string.decode(), *versions)
+    page = render_cache.get(key, user_id)
+    if page is not None:
+        body, mimetype = page
+        return current_app.response_class(body, mimetype=mimetype)
+
+    response = current_app.make_response(view(*args, **kwargs))
+    if response.status_code == 200:
+        render_cache.put(key, user_id, response.get_data(), response.mimetype)
+
+    return response
+
+
+def conditional(daily=False):
+    """
+    Answer GETs of a view with a 304 when the client's copy is current
+
+    The view must only show the logged-in user's data, and only change with
+    it, the URL and, when daily is set, the date.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def conditional_view(*args, **kwargs):
+            # a pending flash message isn't part of the data the ETag covers
+            if request.method != "GET" or session.get("_flashes"):
+                return view(*args, **kwargs)
+
+            user_id = session["user_id"]
+            parts = [
+                str(user_id),
+                str(get_data_version(user_id)),
+                release_fingerprint(),
+            ]
+            if daily:
+                parts.append(date.today().isoformat())
+            etag = hashlib.sha1(":".join(parts).encode()).hexdigest()[:20]
+
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = _render(view, args, kwargs, user_id, parts)
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            # browsers may keep the page, but must check it is current first
+            return set_cache_control(response, "private, no-cache")
+
+        return conditional_view
+
+    return decorator
+
+
+def init_caching(app):
+    """
+    Set up the render cache, provide static_url() to templates and cache
+    fingerprinted static files
+    """
+    app.extensions["render_cache"] = RenderCache(
+        app.config["RENDER_CACHE_MAX_BYTES"],
+        app.config["RENDER_CACHE_TTL"],
+        app.config["RENDER_CACHE_PATH"],
+    )
+    app.jinja_env.globals["static_url"] = static_url
+
+    @app.after_request
+    def cache_static_files(response):
+        if request.endpoint != "static" or response.status_code not in (200, 304):
+            return response
+
+        fingerprint = request.args.get("v")
+        if fingerprint and fingerprint == file_fingerprint(
+            request.view_args["filename"]
+        ):
+            return set_cache_control(
+                response, f"public, max-age={STATIC_MAX_AGE}, immutable"
+            )
+
+        return set_cache_control(response, "no-cache")
@@ -0,0 +1,86 @@
+import os
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_bool(name, default):
+    value = os.environ.get(name)
+    return value.lower() in ("1", "true", "yes") if value else default
+
+
+class Config:
+    """
+    App settings, each overridable from the environment
+
+    DATABASE_URL must be a sqlite:/// URI, as the app only runs on SQLite;
+    the app refuses to start with any other. Relative paths are resolved
+    against the app directory. The SQLITE_* pragmas are applied to every new
+    connection.
+    """
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "sqlite:///budget.db")
+    SQLALCHEMY_TRACK_MODIFICATIONS = True
+
+    # connections kept open per worker process
+    DB_POOL_SIZE = _env_int("DB_POOL_SIZE", 5)
+    DB_MAX_OVERFLOW = _env_int("DB_MAX_OVERFLOW", 10)
+
+    # WAL lets readers run alongside a writer instead of queueing behind it
+    SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+    # NORMAL is durable across app crashes under WAL, and fsyncs far less
+    SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+    # negative values are in KiB, so 64 MiB of page cache per connection
+    SQLITE_CACHE_SIZE = _env_int("SQLITE_CACHE_SIZE", -64000)
+    SQLITE_MMAP_SIZE = _env_int("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)
+    # milliseconds to wait on a lock before failing with "database is locked"
+    SQLITE_BUSY_TIMEOUT = _env_int("SQLITE_BUSY_TIMEOUT", 5000)
+
+    # statements slower than this are logged to the "budget.slow_query" logger,
+    # and appended to SLOW_QUERY_LOG when it names a file
+    SLOW_QUERY_MS = _env_int("SLOW_QUERY_MS", 100)
+    SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG")
+
+    # raise on views over their query budget instead of logging them; always
+    # on when the app is testing
+    QUERY_BUDGET_STRICT = _env_bool("QUERY_BUDGET_STRICT", False)
+
+    # seconds a change is held back from sync, longer than a write can wait on
+    # SQLITE_BUSY_TIMEOUT, and how long delete tombstones are kept for clients
+    SYNC_SETTLE_SECONDS = _env_int("SYNC_SETTLE_SECONDS", 6)
+    SYNC_TOMBSTONE_DAYS = _env_int("SYNC_TOMBSTONE_DAYS", 90)
+
+    # months of daily spending that month-end forecasts are based on
+    FORECAST_HISTORY_MONTHS = _env_int("FORECAST_HISTORY_MONTHS", 6)
+
+    # rendered pages kept in memory per worker process, and for how long; a
+    # RENDER_CACHE_PATH file shares them between the processes on a host
+    RENDER_CACHE_MAX_BYTES = _env_int("RENDER_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+    RENDER_CACHE_TTL = _env_int("RENDER_CACHE_TTL", 300)
+    RENDER_CACHE_PATH = os.environ.get("RENDER_CACHE_PATH")
+
+    # `flask archive-entries` keeps this many years before the current one in
+    # the entry table, and moves older ones to a file per year in ARCHIVE_DIR,
+    # relative to the database's directory
+    ARCHIVE_KEEP_YEARS = _env_int("ARCHIVE_KEEP_YEARS", 2)
+    ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+
+    # seconds between the runs of recurring entries on each serving process's
+    # background thread; 0 turns it off, e.g. to run `flask run-recurring`
+    # from cron instead
+    RECURRING_INTERVAL = _env_int("RECURRING_INTERVAL", 3600)
+
+    # threads running background jobs in each serving process, 0 to leave
+    # them to `flask run-jobs`, and how often idle threads look for new jobs
+    JOB_WORKERS = _env_int("JOB_WORKERS", 2)
+    JOB_POLL_SECONDS = _env_int("JOB_POLL_SECONDS", 2)
+    # a failed job is retried after this many seconds, doubling each time
+    JOB_RETRY_SECONDS = _env_int("JOB_RETRY_SECONDS", 30)
+    # a running job not heard from for this long is assumed lost and requeued
+    JOB_STALE_SECONDS = _env_int("JOB_STALE_SECONDS", 300)
+    # finished jobs, and their files in JOB_DIR, are deleted after this long
+    JOB_KEEP_DAYS = _env_int("JOB_KEEP_DAYS", 7)
+    # uploads and exports, relative to the database's directory
+    JOB_DIR = os.environ.get("JOB_DIR", "jobs")
@@ -1 +0,0 @@
-DB = "budget.db"
\ No newline at end of file
@@ -0,0 +1,49 @@
+from sqlalchemy import case, func
+
+from models import db, Account, Category, MonthlyCategoryTotal
+from reference import category_types
+
+
+def get_dashboard(user_id, year_month):
+    """
+    Summarize a user's entries for a month (YYYY-MM)
+
+    Reads the per-category monthly rollups rather than the raw entries, so the
+    cost is one row per category regardless of how many entries were made. A
+    single grouped query uses conditional aggregation to split the totals into
+    income and expense columns, so the per-category expense rows and both
+    totals come back together.
+    """
+    is_expense = Category.category_type_id == category_types.by_name("Expense").id
+    is_income = Category.category_type_id == category_types.by_name("Income").id
+    amount = MonthlyCategoryTotal.amount
+
+    rows = (
+        db.session.query(
+            (Category.id).label("category_id"),
+            (Category.name).label("category_name"),
+            (Account.name).label("account_name"),
+            (Category.budget_amount).label("budget_amount"),
+            (is_expense).label("is_expense"),
+            func.sum(case([(is_expense, amount)], else_=0)).label("amount"),
+            func.sum(case([(is_income, amount)], else_=0)).label("income_amount"),
+        )
+        .join(MonthlyCategoryTotal.category)
+        .join(Category.account)
+        .filter(MonthlyCategoryTotal.user_id == user_id)
+        .filter(MonthlyCategoryTotal.year_month == year_month)
+        .filter(MonthlyCategoryTotal.entry_count > 0)
+        .group_by(Category.id)
+        .all()
+    )
+
+    expense_entries = [row for row in rows if row.is_expense]
+    expense_amount = sum(row.amount or 0 for row in expense_entries)
+    income_amount = sum(row.income_amount or 0 for row in rows)
+
+    return {
+        "entries": expense_entries,
+        "expense_amount": expense_amount,
+        "income_amount": income_amount,
+        "savings": income_amount - expense_amount,
+    }
@@ -0,0 +1,75 @@
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+# SQLite before 3.32 binds at most 999 variables in a statement
+MAX_VARIABLES = 999
+
+
+def is_sqlite(uri):
+    return make_url(uri).drivername.startswith("sqlite")
+
+
+def chunked(values, size):
+    """
+    Split values into lists of at most size, for statements that bind each
+    of them, like IN lists and multi-row VALUES, to stay within MAX_VARIABLES
+    """
+    values = list(values)
+
+    return [values[start : start + size] for start in range(0, len(values), size)]
+
+
+def engine_options(config):
+    """
+    Build create_engine() keyword arguments from the app config
+
+    SQLAlchemy gives sqlite file databases a NullPool, which opens a new
+    connection, and reruns the pragmas, for every checkout. A QueuePool keeps
+    them open instead; pysqlite connections are only ever used by one thread
+    at a time through the pool, so the same-thread check can be relaxed.
+
+    Raises ValueError for a database other than SQLite, which the app's SQL
+    is written for: INSERT OR IGNORE, strftime(), FTS5, PRAGMAs and the
+    ATTACHed archives have no portable equivalent.
+    """
+    uri = config["SQLALCHEMY_DATABASE_URI"]
+    if not is_sqlite(uri):
+        raise ValueError(
+            f"DATABASE_URL must be a sqlite:/// URI, the app only runs on "
+            f"SQLite, not {make_url(uri).drivername}"
+        )
+
+    # in-memory databases already get a single shared connection
+    if make_url(uri).database in (None, "", ":memory:"):
+        return {}
+
+    return dict(
+        pool_size=config["DB_POOL_SIZE"],
+        max_overflow=config["DB_MAX_OVERFLOW"],
+        poolclass=QueuePool,
+        connect_args={"check_same_thread": False},
+    )
+
+
+def sqlite_pragmas(config):
+    return [
+        f"PRAGMA journal_mode = {config['SQLITE_JOURNAL_MODE']}",
+        f"PRAGMA synchronous = {config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA cache_size = {int(config['SQLITE_CACHE_SIZE'])}",
+        f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])}",
+        f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}",
+    ]
+
+
+def configure_engine(engine, config):
+    """Apply the configured pragmas to each new connection of the engine"""
+
+    pragmas = sqlite_pragmas(config)
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload
+
+from archive import route_entries
+from instrumentation import query_budget
+from models import db, Category, Entry
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(entry):
+    """Return the cursor that continues a listing after the given entry"""
+
+    return f"{entry.effective_date.isoformat()}_{entry.id}"
+
+
+def decode_cursor(cursor):
+    """Split a cursor into its (effective_date, id) pair, None if it is invalid"""
+
+    try:
+        effective_date, entry_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(effective_date), int(entry_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _page_query(
+    entity, user_id, position, start_date, end_date, category_id, account_id
+):
+    query = (
+        db.session.query(entity)
+        .options(joinedload(entity.category))
+        .filter(entity.user_id == user_id)
+        .filter(entity.effective_date.isnot(None))
+    )
+
+    if start_date:
+        query = query.filter(entity.effective_date >= start_date)
+
+    if end_date:
+        query = query.filter(entity.effective_date < end_date)
+
+    if category_id:
+        query = query.filter(entity.category_id == category_id)
+
+    if account_id:
+        query = query.join(entity.category).filter(Category.account_id == account_id)
+
+    if position:
+        effective_date, entry_id = position
+        query = query.filter(entity.effective_date <= effective_date).filter(
+            or_(
+                entity.effective_date < effective_date,
+                and_(entity.effective_date == effective_date, entity.id < entry_id),
+            )
+        )
+
+    return query.order_by(entity.effective_date.desc(), entity.id.desc())
+
+
+def get_entries_page(
+    user_id,
+    cursor=None,
+    page_size=DEFAULT_PAGE_SIZE,
+    start_date=None,
+    end_date=None,
+    category_id=None,
+    account_id=None,
+):
+    """
+    Return a page of a user's entries, newest first, and the next page's cursor
+
+    Pages are keyed on (effective_date, id) rather than an offset, so each one
+    is a range scan of the (user_id, effective_date) index that starts where
+    the previous page stopped, and costs the same however deep it is. The end
+    date is inclusive. The returned cursor is None on the last page.
+
+    The entry table is read first, then the archives from route_entries(),
+    newest first, only while one could still hold entries newer than the
+    last on the page. Entries read from an archive are marked as archived.
+    """
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    position = decode_cursor(cursor) if cursor else None
+
+    if end_date:
+        end_date = end_date + timedelta(days=1)
+
+    # nothing after the cursor is needed, so don't route to it
+    upper = end_date
+    if position:
+        after_cursor = position[0] + timedelta(microseconds=1)
+        upper = min(upper, after_cursor) if upper else after_cursor
+
+    def read(entity):
+        query = _page_query(
+            entity, user_id, position, start_date, end_date, category_id, account_id
+        )
+        return query.limit(page_size + 1).all()
+
+    entries = read(Entry)
+
+    for source in route_entries(start_date, upper, newest_first=True):
+        year_end = datetime(source.year + 1, 1, 1)
+        if len(entries) > page_size and entries[page_size].effective_date >= year_end:
+            break
+
+        with query_budget(1):
+            archived = read(source.entity)
+        for entry in archived:
+            entry.archived = True
+
+        entries = sorted(
+            entries + archived,
+            key=lambda entry: (entry.effective_date, entry.id),
+            reverse=True,
+        )[: page_size + 1]
+
+    next_cursor = None
+    if len(entries) > page_size:
+        entries = entries[:page_size]
+        next_cursor = encode_cursor(entries[-1])
+
+    return entries, next_cursor
@@ -0,0 +1,121 @@
+import csv
+import heapq
+import io
+import json
+
+from datetime import datetime, timedelta
+
+from archive import route_entries
+from models import db, Category, Entry
+
+EXPORT_CHUNK_SIZE = 1000
+
+EXPORT_COLUMNS = ["id", "effective_date", "category", "amount", "description"]
+
+
+def export_rows(user_id, start_date=None, end_date=None):
+    """
+    Yield a user's entries oldest first, EXPORT_CHUNK_SIZE rows per fetch
+
+    Selects plain column tuples rather than entities and streams them with
+    yield_per, so only one chunk of rows is held in memory at a time. The end
+    date is inclusive. The archives from route_entries() each cover a year,
+    so read one after another they are in order, and are merged with the
+    entry table.
+    """
+    if end_date:
+        end_date = end_date + timedelta(days=1)
+
+    archived = (
+        row
+        for source in route_entries(start_date, end_date)
+        for row in _export_query(source.entity, user_id, start_date, end_date)
+    )
+
+    return heapq.merge(
+        _export_query(Entry, user_id, start_date, end_date),
+        archived,
+        key=lambda row: (row.effective_date or datetime.min, row.id),
+    )
+
+
+def _export_query(entity, user_id, start_date, end_date):
+    query = (
+        db.session.query(
+            entity.id,
+            entity.effective_date,
+            (Category.name).label("category"),
+            entity.amount,
+            entity.description,
+        )
+        .join(entity.category)
+        .filter(entity.user_id == user_id)
+    )
+
+    if start_date:
+        query = query.filter(entity.effective_date >= start_date)
+
+    if end_date:
+        query = query.filter(entity.effective_date < end_date)
+
+    return query.order_by(entity.effective_date, entity.id).yield_per(EXPORT_CHUNK_SIZE)
+
+
+def _serializable(row):
+    return {
+        "id": row.id,
+        "effective_date": row.effective_date.isoformat()
+        if row.effective_date
+        else None,
+        "category": row.category,
+        "amount": str(row.amount),
+        "description": row.description,
+    }
+
+
+def generate_csv(rows):
+    """
+    Yield a CSV document, the header first and then a chunk of lines at a time
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+
+    writer.writeheader()
+    yield _drain(buffer)
+
+    for index, row in enumerate(rows, 1):
+        writer.writerow(_serializable(row))
+
+        if index % EXPORT_CHUNK_SIZE == 0:
+            yield _drain(buffer)
+
+    yield _drain(buffer)
+
+
+def generate_ndjson(rows):
+    """Yield one JSON object per line, a chunk of lines at a time"""
+
+    lines = []
+
+    for row in rows:
+        lines.append(json.dumps(_serializable(row)) + "\n")
+
+        if len(lines) == EXPORT_CHUNK_SIZE:
+            yield "".join(lines)
+            lines = []
+
+    yield "".join(lines)
+
+
+def _drain(buffer):
+    value = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+
+    return value
+
+
+FORMATS = {
+    "csv": (generate_csv, "text/csv"),
+    "ndjson": (generate_ndjson, "application/x-ndjson"),
+}
@@ -0,0 +1,199 @@
+"""
+Month-end forecasts of each category's spending, and of savings
+
+A category's projection is what has been entered for it this month, plus
+what it has usually gone on to spend after today's day of the month, less
+anything already entered for later this month. The usual amount comes from
+the category's daily spending curves over the FORECAST_HISTORY_MONTHS before
+this one, counted from the user's first month with any entries. A user with
+no history yet is projected at this month's pace so far.
+
+The history is read in one grouped query over the covering entry index and
+laid out as a categories x months x days NumPy array, so every category is
+projected at once. The results are cached in category_forecast for the rest
+of the day; apply_deltas() clears a user's rows in the same transaction as
+any change to their entries, so the dashboard reads a fresh forecast with
+one query. Budgets and category types are read at that point rather than
+cached, so editing a category doesn't go stale either.
+"""
+import numpy as np
+
+from calendar import monthrange
+from datetime import date, datetime
+from decimal import Decimal
+from flask import current_app
+from sqlalchemy import cast, func, type_coerce
+
+from models import db, Category, CategoryForecast, Entry, from_cents
+from reference import category_types
+from reports import add_months
+
+
+def invalidate_forecasts(user_ids):
+    """Drop the cached forecasts of users whose entries are changing"""
+
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+
+    db.session.execute(
+        CategoryForecast.__table__.delete().where(
+            CategoryForecast.user_id.in_(user_ids)
+        )
+    )
+
+
+def project(daily, today):
+    """
+    Project month-end totals from daily amounts
+
+    daily is a categories x months x 31 array of the amounts per day of the
+    month, with this month last. Returns (spent, projected) arrays with one
+    total per category.
+    """
+    current = daily[:, -1, :]
+    past = daily[:, :-1, :]
+    day = today.day
+    days_in_month = monthrange(today.year, today.month)[1]
+
+    spent = current.sum(axis=1)
+    booked_later = current[:, day:].sum(axis=1)
+
+    # months before the user's first entries would only drag the average down
+    active = np.maximum.accumulate(np.abs(past).sum(axis=(0, 2)) > 0)
+
+    if active.any():
+        history = past[:, active, :]
+        usual_later = history[:, :, day:].sum(axis=2).mean(axis=1)
+    else:
+        usual_later = current[:, :day].sum(axis=1) * (days_in_month - day) / day
+
+    return spent, spent + np.maximum(usual_later - booked_later, 0)
+
+
+def _compute(user_id, today, categories):
+    history_months = current_app.config["FORECAST_HISTORY_MONTHS"]
+    this_month = today.replace(day=1)
+    first_month = add_months(this_month, -history_months)
+    next_month = add_months(this_month, 1)
+    months = [
+        add_months(first_month, i).strftime("%Y-%m") for i in range(history_months + 1)
+    ]
+
+    month = func.strftime("%Y-%m", Entry.effective_date)
+    day = cast(func.strftime("%d", Entry.effective_date), db.Integer)
+    rows = (
+        db.session.query(
+            Entry.category_id,
+            month,
+            day,
+            func.sum(type_coerce(Entry.amount, db.Integer)),
+        )
+        .filter(Entry.user_id == user_id)
+        .filter(
+            Entry.effective_date >= datetime(first_month.year, first_month.month, 1)
+        )
+        .filter(Entry.effective_date < datetime(next_month.year, next_month.month, 1))
+        .group_by(Entry.category_id, month, day)
+        .all()
+    )
+
+    row_of = {category_id: i for i, category_id in enumerate(categories)}
+    column_of = {key: i for i, key in enumerate(months)}
+
+    daily = np.zeros((len(categories), len(months), 31))
+    cells = [
+        (row_of[category_id], column_of[key], entry_day - 1, amount or 0)
+        for category_id, key, entry_day, amount in rows
+        if category_id in row_of
+    ]
+    if cells:
+        category_rows, month_columns, days, amounts = zip(*cells)
+        daily[category_rows, month_columns, days] = amounts
+
+    # the amounts are in whole cents throughout
+    spent, projected = project(daily, today)
+
+    return {
+        category_id: (
+            from_cents(round(float(spent[i]))),
+            from_cents(round(float(projected[i]))),
+        )
+        for category_id, i in row_of.items()
+    }
+
+
+def get_forecast(user_id, today=None):
+    """
+    Return a user's month-end forecast, from the cache when it is current
+
+        {"categories": {category_id: {"name", "spent", "projected",
+                                      "budget", "income", "overspend"}},
+         "income": ..., "expense": ..., "savings": ...}
+
+    A computed forecast is added to the session for the caller to commit.
+    """
+    today = today or date.today()
+    income_type = category_types.by_name("Income").id
+
+    rows = (
+        db.session.query(
+            Category.id,
+            Category.name,
+            Category.category_type_id,
+            Category.budget_amount,
+            CategoryForecast.forecast_date,
+            CategoryForecast.spent,
+            CategoryForecast.projected,
+        )
+        .outerjoin(
+            CategoryForecast,
+            (CategoryForecast.user_id == Category.user_id)
+            & (CategoryForecast.category_id == Category.id),
+        )
+        .filter(Category.user_id == user_id)
+        .all()
+    )
+
+    cached = {row.id: (row.spent, row.projected) for row in rows}
+    if any(row.forecast_date != today for row in rows):
+        # deleting first takes the write lock, so the history is read as of
+        # the latest committed write and later writers wait to invalidate it
+        invalidate_forecasts([user_id])
+        cached = _compute(user_id, today, [row.id for row in rows])
+        db.session.execute(
+            CategoryForecast.__table__.insert(),
+            [
+                {
+                    "user_id": user_id,
+                    "category_id": category_id,
+                    "forecast_date": today,
+                    "spent": spent,
+                    "projected": projected,
+                }
+                for category_id, (spent, projected) in cached.items()
+            ],
+        )
+
+    forecast = {
+        "categories": {},
+        "income": Decimal(0),
+        "expense": Decimal(0),
+    }
+    for row in rows:
+        spent, projected = cached[row.id]
+        income = row.category_type_id == income_type
+        budget = Decimal(row.budget_amount or 0)
+        forecast["categories"][row.id] = {
+            "name": row.name,
+            "spent": spent,
+            "projected": projected,
+            "budget": budget,
+            "income": income,
+            "overspend": not income and budget > 0 and projected > budget,
+        }
+        forecast["income" if income else "expense"] += projected
+
+    forecast["savings"] = forecast["income"] - forecast["expense"]
+
+    return forecast
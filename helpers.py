@@ -1,8 +1,12 @@
 import os
 
-from flask import redirect, render_template, request, session
+from datetime import datetime
+from decimal import InvalidOperation
+from flask import g, redirect, render_template, request, session
 from functools import wraps
 
+from models import User, from_cents, to_cents
+
 
 def apology(message, code=400):
     """Render message as an apology to user."""
@@ -40,6 +44,18 @@ def login_required(f):
     def decorated_function(*args, **kwargs):
         if session.get("user_id") is None:
             return redirect("/login")
+
+        # the username is cached in the session at login, so drawing the navbar
+        # never costs a query; sessions from before that was done load it once
+        if session.get("username") is None:
+            user = User.query.filter_by(id=session["user_id"]).scalar()
+            if user is None:
+                session.clear()
+                return redirect("/login")
+            session["username"] = user.username
+
+        g.username = session["username"]
+
         return f(*args, **kwargs)
 
     return decorated_function
@@ -53,6 +69,33 @@ def touch(filename):
 
 
 def usd(value):
-    """Format value as USD."""
+    """Format value as USD, from its amount in whole cents."""
+
+    cents = to_cents(value)
+    sign = "-" if cents < 0 else ""
+    dollars, cents = divmod(abs(cents), 100)
+
+    return f"${sign}{dollars:,}.{cents:02d}"
+
+
+def parse_amount(value):
+    """
+    Parse an amount of money typed into a form, rounded to the cent; None if
+    it is missing or isn't a number
+    """
+    try:
+        return from_cents(to_cents(value.strip()))
+    except (AttributeError, InvalidOperation, ValueError):
+        return None
+
+
+def parse_date(value):
+    """
+    Parse a YYYY-MM-DD query parameter, None if it is missing
+
+    Raises ValueError if the value is present but malformed.
+    """
+    if not value:
+        return None
 
-    return f"${value:,.2f}"
\ No newline at end of file
+    return datetime.strptime(value, "%Y-%m-%d")
@@ -0,0 +1,278 @@
+import csv
+import re
+
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from caching import bump_data_version
+from models import db, Category, Entry, from_cents, to_cents
+from reference import category_types
+from rollups import apply_deltas, year_month
+
+DEFAULT_CHUNK_SIZE = 5000
+
+DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%Y%m%d"]
+
+# larger amounts are taken for garbage, and could overflow the sums of cents
+MAX_AMOUNT = Decimal("1000000000")
+
+CSV_COLUMNS = {
+    "date": ["date", "posted date", "transaction date", "effective_date"],
+    "description": ["description", "payee", "name", "memo"],
+    "amount": ["amount", "value"],
+}
+
+OFX_TAG = re.compile(r"<(/?\w+)>([^<\r\n]*)")
+
+
+def parse_statement_date(value):
+    """Parse a statement date in any of the supported formats"""
+
+    value = value.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+
+    raise ValueError(f"Unrecognized date {value!r}")
+
+
+def parse_statement_amount(value):
+    """
+    Parse a statement amount, rounded half up to the cent
+
+    Raises ValueError for anything but a finite number smaller than
+    MAX_AMOUNT.
+    """
+    try:
+        amount = Decimal(value.strip().replace(",", ""))
+    except InvalidOperation:
+        raise ValueError(f"Unrecognized amount {value!r}")
+
+    if not amount.is_finite() or abs(amount) >= MAX_AMOUNT:
+        raise ValueError(f"Unrecognized amount {value!r}")
+
+    return from_cents(to_cents(amount))
+
+
+def parse_csv(stream):
+    """
+    Yield a transaction dict for every row of a CSV statement
+
+    The header row is matched case-insensitively against the usual bank export
+    column names. Amounts are taken as they are, positive for money spent and
+    negative for credits and refunds, like a card statement. Rows that can't
+    be parsed, including amounts that aren't finite numbers below MAX_AMOUNT,
+    are yielded as None so the caller can count them.
+    """
+    reader = csv.reader(stream)
+    header = [column.strip().lower() for column in next(reader, [])]
+
+    positions = {}
+    for field, names in CSV_COLUMNS.items():
+        for name in names:
+            if name in header:
+                positions[field] = header.index(name)
+                break
+
+    if "date" not in positions or "amount" not in positions:
+        raise ValueError("CSV statements need a date and an amount column")
+
+    for row in reader:
+        try:
+            yield {
+                "effective_date": parse_statement_date(row[positions["date"]]),
+                "description": row[positions["description"]].strip()
+                if "description" in positions
+                else "",
+                "amount": parse_statement_amount(row[positions["amount"]]),
+            }
+        except (IndexError, ValueError):
+            yield None
+
+
+def parse_ofx(stream):
+    """
+    Yield a transaction dict for every <STMTTRN> block of an OFX statement
+
+    Reads the SGML or XML flavours of OFX a line at a time, so only the
+    transaction being parsed is held in memory. DTPOSTED timestamps are
+    truncated to the date. TRNAMT is negative for money spent, so it is
+    negated to match the CSV statements. Transactions that can't be parsed
+    are yielded as None, as parse_csv() does.
+    """
+    transaction = None
+
+    for line in stream:
+        for tag, value in OFX_TAG.findall(line):
+            tag = tag.upper()
+
+            if tag == "STMTTRN":
+                transaction = {}
+            elif tag == "/STMTTRN" and transaction is not None:
+                try:
+                    yield {
+                        "effective_date": parse_statement_date(
+                            transaction["DTPOSTED"][:8]
+                        ),
+                        "description": transaction.get("NAME")
+                        or transaction.get("MEMO", ""),
+                        "amount": -parse_statement_amount(transaction["TRNAMT"]),
+                    }
+                except (KeyError, ValueError):
+                    yield None
+                transaction = None
+            elif transaction is not None and not tag.startswith("/"):
+                transaction[tag] = value.strip()
+
+
+PARSERS = {"csv": parse_csv, "ofx": parse_ofx}
+
+
+def statement_format_for(filename):
+    """Pick the parser for a statement from its file extension"""
+
+    extension = filename.rsplit(".", 1)[-1].lower()
+    if extension == "qfx":
+        return "ofx"
+
+    return extension if extension in PARSERS else None
+
+
+def parse_rules(user_id, text):
+    """
+    Turn "pattern = Category name" lines into (pattern, category_id) rules
+
+    Patterns are matched case-insensitively against the description, first
+    match wins. Raises ValueError for a category the user doesn't have.
+    """
+    categories = {
+        category.name.lower(): category.id
+        for category in Category.query.filter_by(user_id=user_id)
+    }
+
+    rules = []
+    for line in (text or "").splitlines():
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+
+        pattern, _, category_name = line.rpartition("=")
+        category_id = categories.get(category_name.strip().lower())
+
+        if not pattern.strip() or category_id is None:
+            raise ValueError(f"Invalid rule {line.strip()!r}")
+
+        rules.append((pattern.strip().lower(), category_id))
+
+    return rules
+
+
+def categorize(description, rules, default_category_id):
+    description = (description or "").lower()
+
+    for pattern, category_id in rules:
+        if pattern in description:
+            return category_id
+
+    return default_category_id
+
+
+def import_entries(
+    user_id,
+    transactions,
+    default_category_id,
+    rules=None,
+    credit_category_id=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    on_chunk=None,
+):
+    """
+    Insert the parsed transactions as entries for a user
+
+    Transactions are consumed lazily and written a chunk at a time, each chunk
+    as one executemany INSERT plus its rollup updates in its own transaction,
+    so memory stays bounded by the chunk size however long the statement is.
+
+    Amounts keep their sign: money spent is positive and credits or refunds
+    are negative. Rows no rule matches go to the default category, except
+    negative ones, which go to credit_category_id, an income category, when
+    it is given; without it a refund is a negative expense, taking away from
+    what its category spent. Amounts are negated in income categories, where
+    money coming in counts up.
+
+    on_chunk(imported, skipped) is called with the counts so far in each
+    chunk's transaction, before it commits.
+
+    Returns an (imported, skipped) tuple of row counts.
+    """
+    rules = rules or []
+    imported = 0
+    skipped = 0
+    chunk = []
+
+    income_category_ids = {
+        category_id
+        for (category_id,) in db.session.query(Category.id).filter_by(
+            user_id=user_id, category_type_id=category_types.by_name("Income").id
+        )
+    }
+
+    for transaction in transactions:
+        if transaction is None:
+            skipped += 1
+            continue
+
+        amount = to_cents(transaction["amount"])
+        fallback_category_id = default_category_id
+        if amount < 0 and credit_category_id is not None:
+            fallback_category_id = credit_category_id
+        category_id = categorize(
+            transaction["description"], rules, fallback_category_id
+        )
+        if category_id in income_category_ids:
+            amount = -amount
+
+        now = datetime.utcnow()
+        chunk.append(
+            {
+                "description": transaction["description"][:255],
+                "amount": from_cents(amount),
+                "effective_date": transaction["effective_date"],
+                "created_date": now,
+                "modified_date": now,
+                "user_id": user_id,
+                "category_id": category_id,
+            }
+        )
+
+        if len(chunk) >= chunk_size:
+            imported += len(chunk)
+            _insert_chunk(user_id, chunk, on_chunk, imported, skipped)
+            chunk = []
+
+    if chunk:
+        imported += len(chunk)
+        _insert_chunk(user_id, chunk, on_chunk, imported, skipped)
+
+    return imported, skipped
+
+
+def _insert_chunk(user_id, chunk, on_chunk, imported, skipped):
+    deltas = defaultdict(lambda: [0, 0])
+    for row in chunk:
+        delta = deltas[(user_id, row["category_id"], year_month(row["effective_date"]))]
+        delta[0] += row["amount"]
+        delta[1] += 1
+
+    try:
+        db.session.execute(Entry.__table__.insert(), chunk)
+        apply_deltas({key: tuple(delta) for key, delta in deltas.items()})
+        bump_data_version([user_id])
+        if on_chunk:
+            on_chunk(imported, skipped)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
@@ -0,0 +1,286 @@
+"""
+Per-request timing, SQL statistics and a Prometheus /metrics endpoint
+
+Every request is timed from the moment the WSGI server hands it over until
+its body has been sent, so the session lookup and streamed exports are
+included. SQLAlchemy cursor events count the statements each request runs
+and the time spent in them, and the three measurements go into histograms
+labelled by endpoint. Statements slower than SLOW_QUERY_MS are written to
+the "budget.slow_query" logger, and to SLOW_QUERY_LOG when it is set.
+
+query_budget() caps the statements a view, or any block, may run. Going
+over the budget is logged in production and raises QueryBudgetExceeded in
+testing or with QUERY_BUDGET_STRICT, where a view without a budget is an
+error too, so an N+1 query fails the first request that hits it. A budget
+opened inside another adds its limit to the enclosing ones, so a view can
+allow for statements whose number depends on the data, like one for each
+archive it reads, and still have them capped.
+
+The histograms live in the process, so each worker of a multi-process
+server reports its own; Prometheus sums them across scrape targets.
+"""
+import logging
+import time
+
+from bisect import bisect_left
+from flask import Response, current_app, has_app_context, request
+from functools import wraps
+from sqlalchemy import event
+from threading import Lock, local
+from werkzeug.wsgi import ClosingIterator
+
+from models import db
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+slow_query_log = logging.getLogger("budget.slow_query")
+query_budget_log = logging.getLogger("budget.query_budget")
+
+# the request being served by this thread, None outside of requests, and the
+# query budgets open on it
+_current = local()
+
+
+class RequestStats:
+    __slots__ = ("started", "endpoint", "statements", "sql_seconds")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.endpoint = None
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+
+class Histogram:
+    """A Prometheus histogram with one series per endpoint label"""
+
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, endpoint, value):
+        with self._lock:
+            series = self._series.get(endpoint)
+            if series is None:
+                # one count per bucket plus +Inf, then the running sum
+                series = self._series[endpoint] = [0] * (len(self.buckets) + 1) + [0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def expose(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+
+        with self._lock:
+            series = {
+                endpoint: list(values) for endpoint, values in self._series.items()
+            }
+
+        for endpoint, values in sorted(series.items()):
+            label = f'endpoint="{endpoint}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+
+        return "\n".join(lines)
+
+
+REQUEST_DURATION = Histogram(
+    "budget_request_duration_seconds",
+    "Wall time to serve a request.",
+    DURATION_BUCKETS,
+)
+REQUEST_STATEMENTS = Histogram(
+    "budget_request_sql_statements",
+    "SQL statements executed per request.",
+    STATEMENT_BUCKETS,
+)
+REQUEST_SQL_DURATION = Histogram(
+    "budget_request_sql_duration_seconds",
+    "Time spent executing SQL per request.",
+    DURATION_BUCKETS,
+)
+HISTOGRAMS = [REQUEST_DURATION, REQUEST_STATEMENTS, REQUEST_SQL_DURATION]
+
+
+class InstrumentationMiddleware:
+    """Wrap a WSGI app to record the stats of every request it serves"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        stats = _current.stats = RequestStats()
+
+        try:
+            app_iter = self.wsgi_app(environ, start_response)
+        except:
+            self.finish(stats)
+            raise
+
+        # the body may still be streaming, so finish once the server closes it
+        return ClosingIterator(app_iter, lambda: self.finish(stats))
+
+    @staticmethod
+    def finish(stats):
+        if getattr(_current, "stats", None) is stats:
+            _current.stats = None
+
+        endpoint = stats.endpoint or "unmatched"
+        REQUEST_DURATION.observe(endpoint, time.perf_counter() - stats.started)
+        REQUEST_STATEMENTS.observe(endpoint, stats.statements)
+        REQUEST_SQL_DURATION.observe(endpoint, stats.sql_seconds)
+
+
+def current_stats():
+    """Return the RequestStats of the request on this thread, or None"""
+
+    return getattr(_current, "stats", None)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def strict_query_budgets():
+    if not has_app_context():
+        return False
+
+    return current_app.testing or current_app.config["QUERY_BUDGET_STRICT"]
+
+
+class QueryBudget:
+    """
+    Count the statements run on this thread while open, against a limit
+
+    Use as a context manager, or as a view decorator; each call of the view
+    then gets its own budget, and the view is marked with its limit. Opening
+    a budget raises the limits of the budgets already open by its own.
+    """
+
+    def __init__(self, limit, name=None):
+        self.limit = limit
+        self.name = name
+        self.statements = 0
+
+    def __enter__(self):
+        if not hasattr(_current, "budgets"):
+            _current.budgets = []
+        for budget in _current.budgets:
+            budget.limit += self.limit
+        _current.budgets.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current.budgets.remove(self)
+
+        # don't mask the error the block is already raising
+        if exc_type is not None or self.statements <= self.limit:
+            return
+
+        message = (
+            f"{self.name or 'block'} ran {self.statements} SQL statements, "
+            f"over its budget of {self.limit}"
+        )
+        if strict_query_budgets():
+            raise QueryBudgetExceeded(message)
+        query_budget_log.warning(message)
+
+    def __call__(self, view):
+        @wraps(view)
+        def budgeted_view(*args, **kwargs):
+            with QueryBudget(self.limit, view.__name__):
+                return view(*args, **kwargs)
+
+        budgeted_view.query_budget = self.limit
+        return budgeted_view
+
+
+def query_budget(limit):
+    """Allow at most limit SQL statements in a block or a view"""
+
+    return QueryBudget(limit)
+
+
+def metrics():
+    return Response(
+        "\n".join(histogram.expose() for histogram in HISTOGRAMS) + "\n",
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
+def init_instrumentation(app):
+    """Install the middleware, SQL event listeners and /metrics on an app"""
+
+    threshold = app.config["SLOW_QUERY_MS"] / 1000
+
+    if app.config.get("SLOW_QUERY_LOG"):
+        handler = logging.FileHandler(app.config["SLOW_QUERY_LOG"])
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_query_log.addHandler(handler)
+        slow_query_log.setLevel(logging.INFO)
+
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        stats = current_stats()
+
+        if stats is not None:
+            stats.statements += 1
+            stats.sql_seconds += elapsed
+
+        for budget in getattr(_current, "budgets", ()):
+            budget.statements += 1
+
+        if elapsed >= threshold:
+            # parameters are left out, they hold passwords and session data
+            slow_query_log.warning(
+                "%.1f ms endpoint=%s %s%s",
+                elapsed * 1000,
+                (stats and stats.endpoint) or "-",
+                " ".join(statement.split()),
+                f" ({len(parameters)} rows)" if executemany else "",
+            )
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # a failed statement never reaches after_cursor_execute
+        started = context.connection.info.get("query_started")
+        if started:
+            started.pop()
+
+    @app.before_request
+    def tag_endpoint():
+        stats = current_stats()
+        if stats is not None:
+            stats.endpoint = request.endpoint
+
+        view = app.view_functions.get(request.endpoint)
+        if (
+            view is not None
+            and request.endpoint != "static"
+            and not hasattr(view, "query_budget")
+            and strict_query_budgets()
+        ):
+            raise QueryBudgetExceeded(f"{request.endpoint} has no query budget")
+
+    app.add_url_rule("/metrics", "metrics", query_budget(0)(metrics))
+    app.wsgi_app = InstrumentationMiddleware(app.wsgi_app)
@@ -0,0 +1,454 @@
+"""
+Background jobs
+
+Work too slow for a request, like importing a statement, is queued as a row
+in the job table and run by JOB_WORKERS threads in each serving process, or
+by `flask run-jobs`. The request returns the job's id straight away, and
+GET /api/v1/jobs/<id> reports its status and progress for the job page, or
+any other client, to poll.
+
+A kind of job is a function registered with @job(kind), called with a
+JobContext and the JSON params it was queued with, and returning a JSON
+result. Workers claim a queued job with a compare-and-set UPDATE of its
+status, so each attempt runs on exactly one worker across every process.
+A job that raises is queued again JOB_RETRY_SECONDS later, the delay
+doubling with each attempt, until it has made max_attempts attempts and is
+marked failed; JobError fails it straight away, for errors retrying won't
+fix. A failed job can be retried by hand.
+
+While a job runs, its process bumps its modified_date every so often, and
+queues again any running job that hasn't been bumped for JOB_STALE_SECONDS,
+as it must have been lost with its process. The same pass deletes the jobs
+finished more than JOB_KEEP_DAYS ago. Jobs can therefore run more than
+once, and must either be safe to rerun or record how far they got with
+checkpoint() in the transactions that do the work, as the statement import
+does.
+"""
+import glob
+import json
+import logging
+import os
+import time
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import case, select
+from threading import Condition, Thread
+
+from models import db, Job
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+FINISHED = [SUCCEEDED, FAILED]
+
+log = logging.getLogger("budget.jobs")
+
+JobKind = namedtuple("JobKind", ["function", "max_attempts"])
+
+JOBS = {}
+
+# wakes idle workers of this process when a job is queued
+_queued = Condition()
+
+
+class JobError(Exception):
+    """A job failure that retrying won't fix"""
+
+
+def job(kind, max_attempts=3):
+    """Register a function as the kind of job named kind"""
+
+    def decorator(function):
+        JOBS[kind] = JobKind(function, max_attempts)
+        return function
+
+    return decorator
+
+
+def job_directory():
+    """JOB_DIR, relative paths being taken from the database's directory"""
+
+    directory = current_app.config["JOB_DIR"]
+    if not os.path.isabs(directory):
+        database = db.engine.url.database
+        root = (
+            os.path.dirname(os.path.abspath(database))
+            if database
+            else current_app.root_path
+        )
+        directory = os.path.join(root, directory)
+
+    return directory
+
+
+def job_file(job_id, name):
+    """The path of a file belonging to a job, deleted along with it"""
+
+    directory = job_directory()
+    os.makedirs(directory, exist_ok=True)
+
+    return os.path.join(directory, f"job_{int(job_id)}_{name}")
+
+
+class JobContext:
+    """What a running job gets to know about itself and report back"""
+
+    def __init__(self, job):
+        self.id = job.id
+        self.user_id = job.user_id
+        self.attempt = job.attempts
+        # from the last checkpoint(), where a rerun should carry on from
+        self.done = job.progress_done
+
+    def progress(self, done, total=None):
+        """
+        Report progress, in its own transaction; not for use while the job's
+        session has writes pending, which would hold the lock it needs
+        """
+        with db.engine.begin() as connection:
+            connection.execute(_progress(self.id, done, total))
+
+    def checkpoint(self, done, total=None):
+        """Report progress in the session's transaction, committing with it"""
+
+        db.session.execute(_progress(self.id, done, total))
+
+    def file(self, name):
+        return job_file(self.id, name)
+
+
+def _progress(job_id, done, total):
+    table = Job.__table__
+
+    return (
+        table.update()
+        .where(table.c.id == job_id)
+        .values(
+            progress_done=done, progress_total=total, modified_date=datetime.utcnow()
+        )
+    )
+
+
+def enqueue(kind, params=None, user_id=None, files=None):
+    """
+    Queue a job and commit, returning its id
+
+    files maps names to functions that save a file to the path they're given,
+    such as an upload's save(); they are saved with job_file() before the job
+    is committed, so it never runs without them.
+    """
+    if kind not in JOBS:
+        raise ValueError(f"Unknown kind of job {kind!r}")
+
+    now = datetime.utcnow()
+    job = Job(
+        kind=kind,
+        status=QUEUED,
+        params=json.dumps(params or {}),
+        progress_done=0,
+        attempts=0,
+        max_attempts=JOBS[kind].max_attempts,
+        run_after=now,
+        created_date=now,
+        modified_date=now,
+        user_id=user_id,
+    )
+
+    try:
+        db.session.add(job)
+        db.session.flush()
+        job_id = job.id
+        for name, save in (files or {}).items():
+            save(job_file(job_id, name))
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+    with _queued:
+        _queued.notify()
+
+    return job_id
+
+
+def retry(job_id, user_id):
+    """Queue a user's failed job again, with its attempts reset"""
+
+    table = Job.__table__
+    now = datetime.utcnow()
+    retried = db.session.execute(
+        table.update()
+        .where(table.c.id == job_id)
+        .where(table.c.user_id == user_id)
+        .where(table.c.status == FAILED)
+        .values(
+            status=QUEUED,
+            attempts=0,
+            error=None,
+            run_after=now,
+            finished_date=None,
+            modified_date=now,
+        )
+    ).rowcount
+    db.session.commit()
+
+    if retried:
+        with _queued:
+            _queued.notify()
+
+    return bool(retried)
+
+
+def job_status(job):
+    """A job as the status endpoint returns it"""
+
+    def isoformat(value):
+        return value.isoformat() if value else None
+
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "progress": {"done": job.progress_done, "total": job.progress_total},
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "result": json.loads(job.result) if job.result else None,
+        "error": job.error,
+        "created_date": isoformat(job.created_date),
+        "started_date": isoformat(job.started_date),
+        "finished_date": isoformat(job.finished_date),
+    }
+
+
+def requeue_stale(now=None):
+    """Queue the running jobs whose workers have stopped bumping them again"""
+
+    table = Job.__table__
+    now = now or datetime.utcnow()
+    stale = now - timedelta(seconds=current_app.config["JOB_STALE_SECONDS"])
+    out_of_attempts = table.c.attempts >= table.c.max_attempts
+
+    db.session.execute(
+        table.update()
+        .where(table.c.status == RUNNING)
+        .where(table.c.modified_date < stale)
+        .values(
+            status=case([(out_of_attempts, FAILED)], else_=QUEUED),
+            error="The job's worker stopped while running it",
+            run_after=now,
+            finished_date=case([(out_of_attempts, now)], else_=None),
+            modified_date=now,
+        )
+    )
+    db.session.commit()
+
+
+def purge_jobs(now=None):
+    """Delete the jobs finished over JOB_KEEP_DAYS ago, and their files"""
+
+    table = Job.__table__
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=current_app.config["JOB_KEEP_DAYS"])
+    expired = table.c.status.in_(FINISHED) & (table.c.finished_date < cutoff)
+
+    job_ids = [
+        job_id for (job_id,) in db.session.execute(select([table.c.id]).where(expired))
+    ]
+    if not job_ids:
+        return 0
+
+    db.session.execute(table.delete().where(table.c.id.in_(job_ids)))
+    db.session.commit()
+
+    for job_id in job_ids:
+        for path in glob.glob(job_file(job_id, "*")):
+            os.remove(path)
+
+    return len(job_ids)
+
+
+def _claim():
+    """Claim the next due job for this worker, or return None"""
+
+    table = Job.__table__
+    now = datetime.utcnow()
+
+    while True:
+        job_id = db.session.execute(
+            select([table.c.id])
+            .where(table.c.status == QUEUED)
+            .where(table.c.run_after <= now)
+            .order_by(table.c.run_after, table.c.id)
+            .limit(1)
+        ).scalar()
+        if job_id is None:
+            return None
+
+        claimed = db.session.execute(
+            table.update()
+            .where(table.c.id == job_id)
+            .where(table.c.status == QUEUED)
+            .values(
+                status=RUNNING,
+                attempts=table.c.attempts + 1,
+                started_date=now,
+                modified_date=now,
+            )
+        ).rowcount
+        db.session.commit()
+
+        if claimed:
+            return db.session.query(Job).get(job_id)
+
+        # another worker claimed it first, try the next one
+
+
+def _finish(job_id, values):
+    table = Job.__table__
+    now = datetime.utcnow()
+    db.session.execute(
+        table.update()
+        .where(table.c.id == job_id)
+        .values({"finished_date": now, "modified_date": now, **values})
+    )
+    db.session.commit()
+
+
+def run_next(running=None):
+    """
+    Claim and run the next due job, if there is one; returns whether there
+    was. Call inside an app context. Running job ids are added to running
+    while they run, for the caller to keep them from going stale.
+    """
+    job = _claim()
+    if job is None:
+        return False
+
+    kind = JOBS.get(job.kind)
+    context = JobContext(job)
+    params = json.loads(job.params)
+    attempts, max_attempts = job.attempts, job.max_attempts
+    db.session.expunge(job)
+
+    if running is not None:
+        running.add(job.id)
+
+    try:
+        if kind is None:
+            raise JobError(f"Unknown kind of job {job.kind!r}")
+
+        result = kind.function(context, **params)
+    except Exception as e:
+        db.session.rollback()
+        log.exception("Job %d (%s) failed", job.id, job.kind)
+
+        error = str(e) or type(e).__name__
+        if isinstance(e, JobError) or attempts >= max_attempts:
+            _finish(job.id, {"status": FAILED, "error": error})
+        else:
+            delay = current_app.config["JOB_RETRY_SECONDS"] * 2 ** (attempts - 1)
+            _finish(
+                job.id,
+                {
+                    "status": QUEUED,
+                    "error": error,
+                    "run_after": datetime.utcnow() + timedelta(seconds=delay),
+                    "finished_date": None,
+                },
+            )
+    else:
+        _finish(
+            job.id,
+            {"status": SUCCEEDED, "result": json.dumps(result), "error": None},
+        )
+    finally:
+        if running is not None:
+            running.discard(job.id)
+
+    return True
+
+
+class JobWorkers:
+    """
+    Threads that run queued jobs, plus one that bumps the jobs they are
+    running, requeues lost jobs and purges old ones
+    """
+
+    def __init__(self, app, threads):
+        self.app = app
+        self.threads = threads
+        self.running = set()
+        self._threads = []
+
+    def start(self):
+        self._threads = [
+            Thread(target=self._work, name=f"jobs-{number}", daemon=True)
+            for number in range(self.threads)
+        ]
+        self._threads.append(
+            Thread(target=self._housekeeping, name="jobs-housekeeping", daemon=True)
+        )
+        for thread in self._threads:
+            thread.start()
+
+        return self
+
+    def join(self):
+        """Wait on the threads, which only stop with the process"""
+
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        poll = self.app.config["JOB_POLL_SECONDS"]
+
+        while True:
+            try:
+                with self.app.app_context():
+                    ran = run_next(self.running)
+            except Exception:
+                log.exception("Running a job failed")
+                ran = False
+
+            if not ran:
+                with _queued:
+                    _queued.wait(poll)
+
+    def _housekeeping(self):
+        table = Job.__table__
+
+        while True:
+            try:
+                with self.app.app_context():
+                    job_ids = list(self.running)
+                    if job_ids:
+                        with db.engine.begin() as connection:
+                            connection.execute(
+                                table.update()
+                                .where(table.c.id.in_(job_ids))
+                                .where(table.c.status == RUNNING)
+                                .values(modified_date=datetime.utcnow())
+                            )
+
+                    requeue_stale()
+                    purge_jobs()
+            except Exception:
+                log.exception("Job housekeeping failed")
+
+            time.sleep(self.app.config["JOB_STALE_SECONDS"] / 3)
+
+
+def start_workers(app):
+    """
+    Start JOB_WORKERS threads running jobs; returns them, or None when there
+    are to be none or testing
+    """
+    threads = app.config["JOB_WORKERS"]
+    if not threads or app.testing:
+        return None
+
+    return JobWorkers(app, threads).start()
@@ -0,0 +1,398 @@
+"""
+Schema migrations
+
+initialize_db() builds a fresh database from the models and stamps it with
+the latest version. Existing databases are brought up to date in place with
+`flask upgrade-db`, which applies every migration newer than the version
+recorded in the schema_version table.
+
+Migrations are written against the schema as it was when they were added,
+so they use plain SQL rather than the models. SQLite commits DDL as it goes,
+so every migration must be safe to re-run after a partial failure.
+"""
+from archive import archived_years, attach
+from models import db
+
+schema_version = db.Table(
+    "schema_version", db.Column("version", db.Integer, nullable=False)
+)
+
+
+def _create_monthly_category_total():
+    db.session.execute(
+        """
+        CREATE TABLE IF NOT EXISTS monthly_category_total (
+            user_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            year_month VARCHAR(7) NOT NULL,
+            amount NUMERIC(18, 2) NOT NULL,
+            entry_count INTEGER NOT NULL,
+            modified_date DATETIME NOT NULL,
+            PRIMARY KEY (user_id, category_id, year_month),
+            FOREIGN KEY(user_id) REFERENCES user (id),
+            FOREIGN KEY(category_id) REFERENCES category (id)
+        )
+        """
+    )
+    db.session.execute("DELETE FROM monthly_category_total")
+    db.session.execute(
+        """
+        INSERT INTO monthly_category_total
+        SELECT user_id, category_id, strftime('%Y-%m', effective_date),
+            SUM(amount), COUNT(id), datetime('now')
+        FROM entry
+        WHERE effective_date IS NOT NULL
+        GROUP BY user_id, category_id, strftime('%Y-%m', effective_date)
+        """
+    )
+
+
+def _create_hot_query_indexes():
+    for statement in [
+        "CREATE INDEX IF NOT EXISTS ix_entry_user_id_effective_date "
+        "ON entry (user_id, effective_date, category_id, amount)",
+        "CREATE INDEX IF NOT EXISTS ix_entry_category_id ON entry (category_id)",
+        "CREATE INDEX IF NOT EXISTS ix_category_user_id ON category (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_category_account_id ON category (account_id)",
+        "CREATE INDEX IF NOT EXISTS ix_category_category_type_id "
+        "ON category (category_type_id)",
+        "CREATE INDEX IF NOT EXISTS ix_account_user_id ON account (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_account_account_type_id "
+        "ON account (account_type_id)",
+        "CREATE INDEX IF NOT EXISTS ix_monthly_category_total_user_id_year_month "
+        "ON monthly_category_total (user_id, year_month)",
+        "ANALYZE",
+    ]:
+        db.session.execute(statement)
+
+
+def _create_user_session():
+    db.session.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_session (
+            session_id VARCHAR(64) NOT NULL,
+            data TEXT NOT NULL,
+            expiry DATETIME NOT NULL,
+            PRIMARY KEY (session_id)
+        )
+        """
+    )
+    db.session.execute(
+        "CREATE INDEX IF NOT EXISTS ix_user_session_expiry ON user_session (expiry)"
+    )
+
+
+def _create_sync_tables():
+    db.session.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tombstone (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            table_name VARCHAR(32) NOT NULL,
+            row_id INTEGER NOT NULL,
+            deleted_date DATETIME NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )
+        """
+    )
+    for statement in [
+        "CREATE INDEX IF NOT EXISTS ix_tombstone_user_id_deleted_date "
+        "ON tombstone (user_id, deleted_date)",
+        "CREATE INDEX IF NOT EXISTS ix_entry_user_id_modified_date "
+        "ON entry (user_id, modified_date)",
+        "CREATE INDEX IF NOT EXISTS ix_account_user_id_modified_date "
+        "ON account (user_id, modified_date)",
+        "CREATE INDEX IF NOT EXISTS ix_category_user_id_modified_date "
+        "ON category (user_id, modified_date)",
+    ]:
+        db.session.execute(statement)
+
+
+def _add_account_balance():
+    columns = [row[1] for row in db.session.execute("PRAGMA table_info(account)")]
+    if "balance" not in columns:
+        db.session.execute(
+            "ALTER TABLE account ADD COLUMN balance NUMERIC(18, 2) NOT NULL DEFAULT 0"
+        )
+    db.session.execute(
+        """
+        UPDATE account SET balance = COALESCE(initial_amount, 0) + COALESCE((
+            SELECT SUM(CASE WHEN category_type.name = 'Income'
+                THEN monthly_category_total.amount
+                ELSE -monthly_category_total.amount END)
+            FROM monthly_category_total
+            JOIN category ON category.id = monthly_category_total.category_id
+            JOIN category_type ON category_type.id = category.category_type_id
+            WHERE category.account_id = account.id
+        ), 0)
+        """
+    )
+
+
+def _create_category_forecast():
+    db.session.execute(
+        """
+        CREATE TABLE IF NOT EXISTS category_forecast (
+            user_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            forecast_date DATE NOT NULL,
+            spent NUMERIC(18, 2) NOT NULL,
+            projected NUMERIC(18, 2) NOT NULL,
+            PRIMARY KEY (user_id, category_id),
+            FOREIGN KEY(user_id) REFERENCES user (id),
+            FOREIGN KEY(category_id) REFERENCES category (id)
+        )
+        """
+    )
+
+
+def _create_entry_search():
+    for statement in [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS entry_search USING fts5(
+            description, user_id, content='entry', content_rowid='id'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS entry_search_insert AFTER INSERT ON entry BEGIN
+            INSERT INTO entry_search (rowid, description, user_id)
+            VALUES (new.id, new.description, new.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS entry_search_delete AFTER DELETE ON entry BEGIN
+            INSERT INTO entry_search (entry_search, rowid, description, user_id)
+            VALUES ('delete', old.id, old.description, old.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS entry_search_update
+        AFTER UPDATE OF description, user_id ON entry BEGIN
+            INSERT INTO entry_search (entry_search, rowid, description, user_id)
+            VALUES ('delete', old.id, old.description, old.user_id);
+            INSERT INTO entry_search (rowid, description, user_id)
+            VALUES (new.id, new.description, new.user_id);
+        END
+        """,
+        # index the existing entries, replacing anything a failed run left
+        "INSERT INTO entry_search (entry_search) VALUES ('rebuild')",
+    ]:
+        db.session.execute(statement)
+
+
+def _add_user_data_version():
+    columns = [row[1] for row in db.session.execute("PRAGMA table_info(user)")]
+    if "data_version" not in columns:
+        db.session.execute(
+            "ALTER TABLE user ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0"
+        )
+
+
+def _store_money_in_cents():
+    # the columns keep their NUMERIC affinity, which stores these as integers.
+    # Multiplying isn't safe to re-run, but it is only DML, so it commits
+    # together with the new version or not at all.
+    for table, columns in [
+        ("account", ["initial_amount", "balance"]),
+        ("category", ["budget_amount"]),
+        ("entry", ["amount"]),
+        ("monthly_category_total", ["amount"]),
+    ]:
+        assignments = ", ".join(
+            f"{column} = CAST(ROUND({column} * 100) AS INTEGER)" for column in columns
+        )
+        db.session.execute(f"UPDATE {table} SET {assignments}")
+
+    # cached forecasts are simply recomputed
+    db.session.execute("DELETE FROM category_forecast")
+
+
+def _create_recurring_entry():
+    db.session.execute(
+        """
+        CREATE TABLE IF NOT EXISTS recurring_entry (
+            id INTEGER NOT NULL,
+            description VARCHAR(255),
+            amount INTEGER NOT NULL,
+            frequency VARCHAR(16) NOT NULL,
+            interval INTEGER NOT NULL,
+            start_date DATETIME NOT NULL,
+            next_date DATETIME NOT NULL,
+            created_date DATETIME NOT NULL,
+            modified_date DATETIME NOT NULL,
+            user_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES user (id),
+            FOREIGN KEY(category_id) REFERENCES category (id)
+        )
+        """
+    )
+    for statement in [
+        "CREATE INDEX IF NOT EXISTS ix_recurring_entry_next_date "
+        "ON recurring_entry (next_date)",
+        "CREATE INDEX IF NOT EXISTS ix_recurring_entry_user_id "
+        "ON recurring_entry (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_recurring_entry_category_id "
+        "ON recurring_entry (category_id)",
+    ]:
+        db.session.execute(statement)
+
+
+def _create_job():
+    db.session.execute(
+        """
+        CREATE TABLE IF NOT EXISTS job (
+            id INTEGER NOT NULL,
+            kind VARCHAR(32) NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            params TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            progress_done INTEGER NOT NULL,
+            progress_total INTEGER,
+            attempts INTEGER NOT NULL,
+            max_attempts INTEGER NOT NULL,
+            run_after DATETIME NOT NULL,
+            created_date DATETIME NOT NULL,
+            started_date DATETIME,
+            finished_date DATETIME,
+            modified_date DATETIME NOT NULL,
+            user_id INTEGER,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )
+        """
+    )
+    for statement in [
+        "CREATE INDEX IF NOT EXISTS ix_job_status_run_after "
+        "ON job (status, run_after)",
+        "CREATE INDEX IF NOT EXISTS ix_job_user_id ON job (user_id)",
+    ]:
+        db.session.execute(statement)
+
+
+def _autoincrement_entry_ids():
+    # SQLite can only add AUTOINCREMENT by rebuilding the table. Nothing
+    # before the INSERT opens a transaction, so a failure leaves at most an
+    # empty entry_autoincrement to drop; everything from the INSERT on
+    # commits together with the new version.
+    schema = db.session.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'entry'"
+    ).scalar()
+    if "AUTOINCREMENT" not in schema.upper():
+        columns = (
+            "id, description, amount, effective_date, created_date, "
+            "modified_date, user_id, category_id"
+        )
+        for statement in [
+            "DROP TABLE IF EXISTS entry_autoincrement",
+            """
+            CREATE TABLE entry_autoincrement (
+                id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                description VARCHAR(255),
+                amount INTEGER,
+                effective_date DATETIME,
+                created_date DATETIME NOT NULL,
+                modified_date DATETIME NOT NULL,
+                user_id INTEGER NOT NULL,
+                category_id INTEGER NOT NULL,
+                FOREIGN KEY(user_id) REFERENCES user (id),
+                FOREIGN KEY(category_id) REFERENCES category (id)
+            )
+            """,
+            f"INSERT INTO entry_autoincrement ({columns}) "
+            f"SELECT {columns} FROM entry",
+            "DROP TABLE entry",
+            "ALTER TABLE entry_autoincrement RENAME TO entry",
+            "CREATE INDEX ix_entry_user_id_effective_date "
+            "ON entry (user_id, effective_date, category_id, amount)",
+            "CREATE INDEX ix_entry_user_id_modified_date "
+            "ON entry (user_id, modified_date)",
+            "CREATE INDEX ix_entry_category_id ON entry (category_id)",
+        ]:
+            db.session.execute(statement)
+
+        # dropping the table dropped the search triggers
+        _create_entry_search()
+
+    # ids already moved into an archive must not be handed out again either
+    highest = [db.session.execute("SELECT max(id) FROM entry").scalar() or 0]
+    for year in archived_years():
+        attach(year)
+        highest.append(
+            db.session.execute(f"SELECT max(id) FROM archive_{year}.entry").scalar()
+            or 0
+        )
+    db.session.execute("DELETE FROM sqlite_sequence WHERE name = 'entry'")
+    db.session.execute(
+        "INSERT INTO sqlite_sequence (name, seq) VALUES ('entry', :seq)",
+        {"seq": max(highest)},
+    )
+
+
+# (version, description, migration) in the order they must be applied
+MIGRATIONS = [
+    (1, "Create the monthly category rollup table", _create_monthly_category_total),
+    (2, "Add indexes for the hot query columns", _create_hot_query_indexes),
+    (3, "Create the server-side session table", _create_user_session),
+    (4, "Add tombstones and modified date indexes for sync", _create_sync_tables),
+    (5, "Add and fill in account balances", _add_account_balance),
+    (6, "Create the category forecast cache", _create_category_forecast),
+    (7, "Add full-text search over entry descriptions", _create_entry_search),
+    (8, "Add per-user data versions for conditional GETs", _add_user_data_version),
+    (9, "Store amounts of money as whole cents", _store_money_in_cents),
+    (10, "Create the recurring entry table", _create_recurring_entry),
+    (11, "Create the background job table", _create_job),
+    (12, "Never reuse the ids of entries", _autoincrement_entry_ids),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version():
+    """Return the schema version of the database, 0 if it was never stamped"""
+
+    schema_version.create(db.engine, checkfirst=True)
+    version = db.session.query(schema_version.c.version).scalar()
+
+    return version or 0
+
+
+def stamp(version=LATEST_VERSION):
+    """Record the schema version without running any migrations"""
+
+    schema_version.create(db.engine, checkfirst=True)
+    db.session.execute(schema_version.delete())
+    db.session.execute(schema_version.insert().values(version=version))
+    db.session.commit()
+
+
+def upgrade():
+    """
+    Apply the pending migrations
+
+    Returns the list of (version, description) tuples that were applied.
+    """
+    version = current_version()
+    applied = []
+
+    for migration_version, description, migrate in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        try:
+            migrate()
+            db.session.execute(schema_version.delete())
+            db.session.execute(
+                schema_version.insert().values(version=migration_version)
+            )
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+        applied.append((migration_version, description))
+
+    return applied
@@ -1,9 +1,46 @@
 # apps.members.models
 from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
+CENT = Decimal("0.01")
+
+
+def to_cents(value):
+    """
+    A whole number of cents from a Decimal, number or numeric string, rounded
+    half up
+
+    Raises decimal.InvalidOperation or ValueError if value isn't a number.
+    """
+    return int(Decimal(str(value)).quantize(CENT, ROUND_HALF_UP).scaleb(2))
+
+
+def from_cents(cents):
+    """A whole number of cents as a Decimal amount with two places"""
+
+    return Decimal(int(cents)).scaleb(-2)
+
+
+class Money(db.TypeDecorator):
+    """
+    An amount of money, stored as a whole number of cents
+
+    Python sees Decimals with two places, and takes anything to_cents() does,
+    while SUMs in the database are exact integer arithmetic with no
+    conversion of each row.
+    """
+
+    impl = db.Integer
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else to_cents(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else from_cents(value)
+
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -12,6 +49,8 @@ class User(db.Model):
     password = db.Column(db.String(255), unique=False, nullable=False)
     created_date = db.Column(db.DateTime, nullable=False)
     modified_date = db.Column(db.DateTime, nullable=False)
+    # bumped by every change to the user's data, see caching.py
+    data_version = db.Column(db.Integer, nullable=False, default=0)
 
     def __repr__(self):
         return "<User %r>" % self.username
@@ -28,18 +67,27 @@ class AccountType(db.Model):
 
 
 class Account(db.Model):
+    # changes since a sync cursor
+    __table_args__ = (
+        db.Index("ix_account_user_id_modified_date", "user_id", "modified_date"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), unique=False, nullable=False)
     description = db.Column(db.String(255), unique=False, nullable=True)
-    initial_amount = db.Column(db.Numeric(18, 2), unique=False, nullable=True)
+    initial_amount = db.Column(Money, unique=False, nullable=True)
+    # the initial amount plus income less expenses, kept up to date by balances
+    balance = db.Column(Money, nullable=False, default=0)
     created_date = db.Column(db.DateTime, nullable=False)
     modified_date = db.Column(db.DateTime, nullable=False)
 
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
     user = db.relationship("User", backref=db.backref("accounts", lazy=True))
 
     account_type_id = db.Column(
-        db.Integer, db.ForeignKey("account_type.id"), nullable=False
+        db.Integer, db.ForeignKey("account_type.id"), nullable=False, index=True
     )
     account_type = db.relationship(
         "AccountType", backref=db.backref("accounts", lazy=True)
@@ -60,24 +108,33 @@ class CategoryType(db.Model):
 
 
 class Category(db.Model):
+    # changes since a sync cursor
+    __table_args__ = (
+        db.Index("ix_category_user_id_modified_date", "user_id", "modified_date"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), unique=False, nullable=False)
     description = db.Column(db.String(255), unique=False, nullable=True)
-    budget_amount = db.Column(db.Numeric(18, 2), unique=False, nullable=True)
+    budget_amount = db.Column(Money, unique=False, nullable=True)
     created_date = db.Column(db.DateTime, nullable=False)
     modified_date = db.Column(db.DateTime, nullable=False)
 
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
     user = db.relationship("User", backref=db.backref("categories", lazy=True))
 
     category_type_id = db.Column(
-        db.Integer, db.ForeignKey("category_type.id"), nullable=False
+        db.Integer, db.ForeignKey("category_type.id"), nullable=False, index=True
     )
     category_type = db.relationship(
         "CategoryType", backref=db.backref("categories", lazy=True)
     )
 
-    account_id = db.Column(db.Integer, db.ForeignKey("account.id"), nullable=False)
+    account_id = db.Column(
+        db.Integer, db.ForeignKey("account.id"), nullable=False, index=True
+    )
     account = db.relationship("Account", backref=db.backref("categories", lazy=True))
 
     def __repr__(self):
@@ -85,9 +142,25 @@ class Category(db.Model):
 
 
 class Entry(db.Model):
+    # covers the per-user date range scans, including the grouped sums by
+    # category, without touching the table rows
+    __table_args__ = (
+        db.Index(
+            "ix_entry_user_id_effective_date",
+            "user_id",
+            "effective_date",
+            "category_id",
+            "amount",
+        ),
+        # changes since a sync cursor
+        db.Index("ix_entry_user_id_modified_date", "user_id", "modified_date"),
+        # never reuse the id of a deleted or archived entry, see archive.py
+        {"sqlite_autoincrement": True},
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String(255), unique=False, nullable=True)
-    amount = db.Column(db.Numeric(18, 2), unique=False, nullable=True)
+    amount = db.Column(Money, unique=False, nullable=True)
     effective_date = db.Column(db.DateTime, nullable=True)
     created_date = db.Column(db.DateTime, nullable=False)
     modified_date = db.Column(db.DateTime, nullable=False)
@@ -95,8 +168,137 @@ class Entry(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     user = db.relationship("User", backref=db.backref("entries", lazy=True))
 
-    category_id = db.Column(db.Integer, db.ForeignKey("category.id"), nullable=False)
+    category_id = db.Column(
+        db.Integer, db.ForeignKey("category.id"), nullable=False, index=True
+    )
     category = db.relationship("Category", backref=db.backref("entries", lazy=True))
 
+    # set on entries read from an archive, which are read-only, see archive.py
+    archived = False
+
     def __repr__(self):
         return "<Entry %r - %r>" % self.description, self.effective_date
+
+
+class RecurringEntry(db.Model):
+    """
+    An entry that repeats every `interval` days, weeks, months or years from
+    its start date; next_date is when it is next due, see recurring.py
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(255), unique=False, nullable=True)
+    amount = db.Column(Money, unique=False, nullable=False)
+    frequency = db.Column(db.String(16), nullable=False)
+    interval = db.Column(db.Integer, nullable=False, default=1)
+    start_date = db.Column(db.DateTime, nullable=False)
+    # due entries are found by this
+    next_date = db.Column(db.DateTime, nullable=False, index=True)
+    created_date = db.Column(db.DateTime, nullable=False)
+    modified_date = db.Column(db.DateTime, nullable=False)
+
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+    user = db.relationship("User", backref=db.backref("recurring_entries", lazy=True))
+
+    category_id = db.Column(
+        db.Integer, db.ForeignKey("category.id"), nullable=False, index=True
+    )
+    category = db.relationship("Category")
+
+    def __repr__(self):
+        return "<RecurringEntry %r - %r>" % (self.description, self.frequency)
+
+
+class MonthlyCategoryTotal(db.Model):
+    __table_args__ = (
+        db.Index(
+            "ix_monthly_category_total_user_id_year_month", "user_id", "year_month"
+        ),
+    )
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey("category.id"), primary_key=True)
+    year_month = db.Column(db.String(7), primary_key=True)
+    amount = db.Column(Money, unique=False, nullable=False, default=0)
+    entry_count = db.Column(db.Integer, nullable=False, default=0)
+    modified_date = db.Column(db.DateTime, nullable=False)
+
+    category = db.relationship("Category")
+
+    def __repr__(self):
+        return "<MonthlyCategoryTotal %r - %r>" % (self.category_id, self.year_month)
+
+
+class CategoryForecast(db.Model):
+    """
+    A cached month-end projection for a category, good for the day it was
+    made on; deleted whenever the user's entries or categories change
+    """
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey("category.id"), primary_key=True)
+    forecast_date = db.Column(db.Date, nullable=False)
+    spent = db.Column(Money, nullable=False, default=0)
+    projected = db.Column(Money, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<CategoryForecast %r - %r>" % (self.category_id, self.forecast_date)
+
+
+class Job(db.Model):
+    """A unit of background work, with its state and outcome, see jobs.py"""
+
+    __table_args__ = (
+        # workers look for the queued jobs that are due
+        db.Index("ix_job_status_run_after", "status", "run_after"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default="queued")
+    params = db.Column(db.Text, nullable=False)
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    progress_done = db.Column(db.Integer, nullable=False, default=0)
+    progress_total = db.Column(db.Integer, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    run_after = db.Column(db.DateTime, nullable=False)
+    created_date = db.Column(db.DateTime, nullable=False)
+    started_date = db.Column(db.DateTime, nullable=True)
+    finished_date = db.Column(db.DateTime, nullable=True)
+    # bumped while the job runs, so a job lost with its process can be found
+    modified_date = db.Column(db.DateTime, nullable=False)
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True, index=True)
+
+    def __repr__(self):
+        return "<Job %r - %r>" % (self.kind, self.status)
+
+
+class UserSession(db.Model):
+    session_id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expiry = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<UserSession %r>" % self.session_id
+
+
+class Tombstone(db.Model):
+    """A hard-deleted row, kept so syncing clients learn of the delete"""
+
+    __table_args__ = (
+        db.Index("ix_tombstone_user_id_deleted_date", "user_id", "deleted_date"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    table_name = db.Column(db.String(32), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    deleted_date = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<Tombstone %r %r>" % (self.table_name, self.row_id)
@@ -0,0 +1,210 @@
+"""
+Recurring entries
+
+A RecurringEntry repeats every `interval` days, weeks, months or years from
+its start date. Monthly and yearly schedules keep the start date's day of
+the month, falling back to the last day of shorter months. next_date is the
+date of the next entry it is due to add.
+
+run_recurring() adds every entry that has come due, for every user, in one
+transaction: a single executemany INSERT of the entries, however long the
+app was down for, plus the rollup, balance, forecast and data version
+updates that add_entry makes for one entry. The schedules are claimed by
+moving their next_date on with a compare-and-set UPDATE that runs first, so
+the transaction holds SQLite's write lock from the claim until the commit;
+when another run got to any of them first the whole run is rolled back and
+the due schedules read again, so an entry is never added twice.
+
+Runs come from `flask run-recurring`, e.g. from cron, and from a background
+thread that each serving process starts on its first request and that runs
+every RECURRING_INTERVAL seconds.
+"""
+import calendar
+import logging
+import time
+
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam
+from threading import Thread
+
+from caching import bump_data_version
+from models import db, Category, Entry, RecurringEntry
+from rollups import add_delta, apply_deltas
+
+FREQUENCIES = ["daily", "weekly", "monthly", "yearly"]
+
+# times a run reads the due schedules again after losing some of them
+MAX_ATTEMPTS = 3
+
+log = logging.getLogger("budget.recurring")
+
+
+def _add_months(start_date, when, months):
+    index = when.year * 12 + when.month - 1 + months
+    year, month = index // 12, index % 12 + 1
+    day = min(start_date.day, calendar.monthrange(year, month)[1])
+
+    return when.replace(year=year, month=month, day=day)
+
+
+def next_occurrence(frequency, interval, start_date, when):
+    """The date a schedule is due next after it was due on `when`"""
+
+    if frequency == "daily":
+        return when + timedelta(days=interval)
+    if frequency == "weekly":
+        return when + timedelta(weeks=interval)
+    if frequency == "monthly":
+        return _add_months(start_date, when, interval)
+    if frequency == "yearly":
+        return _add_months(start_date, when, 12 * interval)
+
+    raise ValueError(f"Unknown frequency {frequency!r}")
+
+
+def schedule(entry, frequency, interval):
+    """
+    A RecurringEntry that repeats an entry, which is its first occurrence,
+    for the caller to add to the session
+    """
+    if frequency not in FREQUENCIES:
+        raise ValueError(f"Unknown frequency {frequency!r}")
+    if interval < 1:
+        raise ValueError("Recurring entries repeat at least once per period")
+
+    now = datetime.utcnow()
+
+    return RecurringEntry(
+        description=entry.description,
+        amount=entry.amount,
+        frequency=frequency,
+        interval=interval,
+        start_date=entry.effective_date,
+        next_date=next_occurrence(
+            frequency, interval, entry.effective_date, entry.effective_date
+        ),
+        created_date=now,
+        modified_date=now,
+        user_id=entry.user_id,
+        category=entry.category,
+    )
+
+
+def _due(until):
+    """Read the schedules due by a date, skipping any of deleted categories"""
+
+    table = RecurringEntry.__table__
+
+    return db.session.execute(
+        table.select()
+        .select_from(table.join(Category.__table__))
+        .where(table.c.next_date <= until)
+        .order_by(table.c.next_date, table.c.id)
+    ).fetchall()
+
+
+def run_recurring(until=None):
+    """
+    Add the entries of every schedule due by a date, now by default
+
+    Returns the number of entries added.
+    """
+    table = RecurringEntry.__table__
+
+    for _ in range(MAX_ATTEMPTS):
+        now = datetime.utcnow()
+        until = until or now
+        entries = []
+        claims = []
+        deltas = {}
+
+        for recurring in _due(until):
+            when = recurring.next_date
+            while when <= until:
+                entries.append(
+                    {
+                        "description": recurring.description,
+                        "amount": recurring.amount,
+                        "effective_date": when,
+                        "created_date": now,
+                        "modified_date": now,
+                        "user_id": recurring.user_id,
+                        "category_id": recurring.category_id,
+                    }
+                )
+                add_delta(
+                    deltas,
+                    recurring.user_id,
+                    recurring.category_id,
+                    when,
+                    recurring.amount,
+                )
+                when = next_occurrence(
+                    recurring.frequency,
+                    recurring.interval,
+                    recurring.start_date,
+                    when,
+                )
+
+            claims.append(
+                {
+                    "key_id": recurring.id,
+                    "key_next_date": recurring.next_date,
+                    "new_next_date": when,
+                }
+            )
+
+        if not claims:
+            return 0
+
+        try:
+            claimed = db.session.execute(
+                table.update()
+                .where(table.c.id == bindparam("key_id"))
+                .where(table.c.next_date == bindparam("key_next_date"))
+                .values(next_date=bindparam("new_next_date"), modified_date=now),
+                claims,
+            ).rowcount
+            if claimed != len(claims):
+                # another run added some of these first
+                db.session.rollback()
+                continue
+
+            db.session.execute(Entry.__table__.insert(), entries)
+            apply_deltas(deltas)
+            bump_data_version({entry["user_id"] for entry in entries})
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+        return len(entries)
+
+    raise RuntimeError("Recurring entries kept being claimed by another run")
+
+
+def start_scheduler(app):
+    """
+    Run recurring entries every RECURRING_INTERVAL seconds on a daemon
+    thread; returns the thread, or None when the interval is 0 or testing
+    """
+    interval = app.config["RECURRING_INTERVAL"]
+    if not interval or app.testing:
+        return None
+
+    def run():
+        while True:
+            try:
+                with app.app_context():
+                    added = run_recurring()
+                if added:
+                    log.info("Added %d recurring entries", added)
+            except Exception:
+                log.exception("Adding recurring entries failed")
+
+            time.sleep(interval)
+
+    thread = Thread(target=run, name="recurring-entries", daemon=True)
+    thread.start()
+
+    return thread
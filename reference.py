@@ -0,0 +1,74 @@
+"""
+Process-wide cache of the AccountType and CategoryType lookup tables
+
+These are tiny tables seeded by initialize_db() and never edited by the app,
+so each process loads them once and serves every lookup from memory. Rows are
+cached as plain (id, name) tuples rather than model instances, so they can be
+shared between requests without being attached to any one session; assign
+them to models through the *_type_id columns.
+
+Anything that changes the tables must call invalidate_reference_types().
+"""
+from collections import namedtuple
+from threading import Lock
+
+from models import AccountType, CategoryType
+
+ReferenceType = namedtuple("ReferenceType", ["id", "name"])
+
+
+class ReferenceTypeCache:
+    def __init__(self, model):
+        self.model = model
+        self._lock = Lock()
+        # (by_id, by_name), swapped as a pair so readers never see a mix
+        self._lookups = None
+
+    def _get_lookups(self):
+        lookups = self._lookups
+        if lookups is not None:
+            return lookups
+
+        with self._lock:
+            if self._lookups is None:
+                rows = [
+                    ReferenceType(row.id, row.name)
+                    for row in self.model.query.order_by(self.model.id)
+                ]
+                self._lookups = (
+                    {row.id: row for row in rows},
+                    {row.name: row for row in rows},
+                )
+
+            return self._lookups
+
+    def all(self):
+        return list(self._get_lookups()[0].values())
+
+    def by_id(self, type_id):
+        """Look a type up by id, accepting form strings; None if it is unknown"""
+
+        try:
+            return self._get_lookups()[0].get(int(type_id))
+        except (TypeError, ValueError):
+            return None
+
+    def by_name(self, name):
+        return self._get_lookups()[1].get(name)
+
+    def invalidate(self):
+        self._lookups = None
+
+
+account_types = ReferenceTypeCache(AccountType)
+category_types = ReferenceTypeCache(CategoryType)
+
+
+def load_reference_types():
+    account_types.all()
+    category_types.all()
+
+
+def invalidate_reference_types():
+    account_types.invalidate()
+    category_types.invalidate()
@@ -0,0 +1,203 @@
+"""
+Cache of rendered pages
+
+Pages using @conditional (see caching.py) are stored once rendered, keyed on
+the user, the endpoint, the query string and the user's data version, along
+with the release fingerprint and, for the dashboard, the date. Any write
+bumps the data version, so a page is never served once its data has
+changed, from this process or any other. Writes also drop the user's pages
+straight away rather than leaving them to age out.
+
+The pages are held in an in-process LRU of at most RENDER_CACHE_MAX_BYTES,
+and when RENDER_CACHE_PATH names a file, in a SQLite database there as well,
+which every worker process on the host shares. Entries expire after
+RENDER_CACHE_TTL seconds in both.
+"""
+import hashlib
+import logging
+import random
+import sqlite3
+import time
+
+from collections import OrderedDict
+from threading import Lock, local
+
+log = logging.getLogger("budget.render_cache")
+
+# chance that storing a page also purges the expired ones on disk
+PURGE_PROBABILITY = 0.01
+
+
+def page_key(user_id, endpoint, query_string, *versions):
+    """The cache key of a page; versions are whatever else it depends on"""
+
+    parts = [str(user_id), endpoint, query_string] + [str(v) for v in versions]
+    return hashlib.sha1("\0".join(parts).encode()).hexdigest()
+
+
+class MemoryRenderCache:
+    """Pages in a process-local LRU, dropping the oldest past max_bytes"""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        # key -> (user_id, body, mimetype, expires)
+        self._pages = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is None:
+                return None
+
+            if page[3] <= time.monotonic():
+                self._remove(key)
+                return None
+
+            self._pages.move_to_end(key)
+            return page[1], page[2]
+
+    def put(self, key, user_id, body, mimetype):
+        if len(body) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._pages:
+                self._remove(key)
+
+            self._pages[key] = (user_id, body, mimetype, time.monotonic() + self.ttl)
+            self.size += len(body)
+
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._pages)))
+
+    def invalidate_users(self, user_ids=None):
+        with self._lock:
+            if user_ids is None:
+                self._pages.clear()
+                self.size = 0
+                return
+
+            user_ids = set(user_ids)
+            for key in [
+                key for key, page in self._pages.items() if page[0] in user_ids
+            ]:
+                self._remove(key)
+
+    def _remove(self, key):
+        self.size -= len(self._pages.pop(key)[1])
+
+
+class SqliteRenderStore:
+    """
+    Pages in a SQLite file shared by the worker processes on a host
+
+    Each thread keeps its own connection. The file only holds copies, so it
+    is written without syncing, and any error reading or writing it is
+    logged and treated as a miss.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._local = local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS rendered_page (
+                    key TEXT PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    body BLOB NOT NULL,
+                    mimetype TEXT NOT NULL,
+                    expires REAL NOT NULL
+                )
+                """
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_rendered_page_user_id "
+                "ON rendered_page (user_id)"
+            )
+            self._local.connection = connection
+
+        return connection
+
+    def get(self, key):
+        try:
+            row = (
+                self._connection()
+                .execute(
+                    "SELECT body, mimetype FROM rendered_page "
+                    "WHERE key = ? AND expires > ?",
+                    (key, time.time()),
+                )
+                .fetchone()
+            )
+        except sqlite3.Error:
+            log.exception("Reading the render cache failed")
+            return None
+
+        return (bytes(row[0]), row[1]) if row else None
+
+    def put(self, key, user_id, body, mimetype):
+        try:
+            connection = self._connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO rendered_page VALUES (?, ?, ?, ?, ?)",
+                (key, user_id, body, mimetype, time.time() + self.ttl),
+            )
+            if random.random() < PURGE_PROBABILITY:
+                connection.execute(
+                    "DELETE FROM rendered_page WHERE expires <= ?", (time.time(),)
+                )
+        except sqlite3.Error:
+            log.exception("Writing the render cache failed")
+
+    def invalidate_users(self, user_ids=None):
+        try:
+            connection = self._connection()
+            if user_ids is None:
+                connection.execute("DELETE FROM rendered_page")
+            else:
+                connection.executemany(
+                    "DELETE FROM rendered_page WHERE user_id = ?",
+                    [(user_id,) for user_id in user_ids],
+                )
+        except sqlite3.Error:
+            log.exception("Invalidating the render cache failed")
+
+
+class RenderCache:
+    """The in-process LRU, backed by a shared SQLite store when there is one"""
+
+    def __init__(self, max_bytes, ttl, path=None):
+        self.memory = MemoryRenderCache(max_bytes, ttl) if max_bytes > 0 else None
+        self.disk = SqliteRenderStore(path, ttl) if path else None
+
+    def get(self, key, user_id):
+        page = self.memory.get(key) if self.memory else None
+        if page is None and self.disk:
+            page = self.disk.get(key)
+            if page is not None and self.memory:
+                self.memory.put(key, user_id, *page)
+
+        return page
+
+    def put(self, key, user_id, body, mimetype):
+        for store in (self.memory, self.disk):
+            if store:
+                store.put(key, user_id, body, mimetype)
+
+    def invalidate_users(self, user_ids=None):
+        """Drop the pages of some users, or of everyone when user_ids is None"""
+
+        for store in (self.memory, self.disk):
+            if store:
+                store.invalidate_users(user_ids)
@@ -0,0 +1,241 @@
+"""
+Budget vs. actual trends over a range of months
+
+The monthly sums come from the per-category rollups in a single grouped
+query, whatever the length of the range. They are laid out as a categories
+by months NumPy array of whole cents, so the deltas against budget, rolling
+averages and variances are whole-array operations rather than a loop per
+month, and sums and deltas are exact. Averages are rounded half up to the
+cent. Amounts come back as Decimals; trends_json() turns them into strings
+for JSON, as the API sends money.
+
+Categories only have their current budget amount, so every month in the
+range is compared against it.
+"""
+import numpy as np
+
+from datetime import date
+from decimal import Decimal
+from sqlalchemy import Integer, and_, func, select, type_coerce
+
+from models import db, Account, Category, MonthlyCategoryTotal, from_cents, to_cents
+from reference import category_types
+
+DEFAULT_MONTHS = 12
+MAX_MONTHS = 120
+DEFAULT_WINDOW = 3
+MAX_WINDOW = 24
+
+
+def parse_month(value):
+    """Parse a month formatted as YYYY-MM into a date, None if empty"""
+
+    if not value:
+        return None
+
+    year, month = value.split("-")
+    return date(int(year), int(month), 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def month_range(start, end):
+    """Return the YYYY-MM keys from start to end inclusive"""
+
+    count = (end.year - start.year) * 12 + end.month - start.month + 1
+    return [add_months(start, i).strftime("%Y-%m") for i in range(count)]
+
+
+def default_range(today=None):
+    """The DEFAULT_MONTHS up to and including the current month"""
+
+    end = (today or date.today()).replace(day=1)
+    return add_months(end, 1 - DEFAULT_MONTHS), end
+
+
+def parse_trend_args(args):
+    """
+    Read the start and end months (YYYY-MM) and the rolling window from a
+    request's query string, defaulting to the last DEFAULT_MONTHS
+
+    Raises ValueError, with a message for the user, for malformed values.
+    """
+    default_start, default_end = default_range()
+    try:
+        start = parse_month(args.get("start")) or default_start
+        end = parse_month(args.get("end")) or default_end
+    except ValueError:
+        raise ValueError("Months must be formatted as YYYY-MM")
+
+    try:
+        window = int(args.get("window") or DEFAULT_WINDOW)
+    except ValueError:
+        raise ValueError("The window must be a whole number of months")
+
+    return start, end, window
+
+
+def divide_cents(cents, divisor):
+    """Divide whole cents, rounding half up (away from zero) to whole cents"""
+
+    cents = np.asarray(cents, dtype=np.int64)
+
+    return np.sign(cents) * ((2 * np.abs(cents) + divisor) // (2 * divisor))
+
+
+def rolling_mean(values, window):
+    """
+    Average each month of whole cents with up to window - 1 months before
+    it, along the last axis; the first months average over as many as there
+    are
+    """
+    months = values.shape[-1]
+    totals = np.cumsum(values, axis=-1)
+    leading = np.zeros_like(totals)
+    leading[..., window:] = totals[..., :-window]
+    sizes = np.minimum(np.arange(1, months + 1), window)
+
+    return divide_cents(totals - leading, sizes)
+
+
+def _money(values):
+    return [from_cents(value) for value in values]
+
+
+def trends_json(value):
+    """A report from get_trends() with its Decimal amounts as strings"""
+
+    if isinstance(value, dict):
+        return {key: trends_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [trends_json(item) for item in value]
+    if isinstance(value, Decimal):
+        return str(value)
+
+    return value
+
+
+def get_trends(user_id, start, end, window=DEFAULT_WINDOW):
+    """
+    Compare budget and actual amounts per category, month by month
+
+    start and end are dates in the first and last months of the range.
+    Raises ValueError for a backwards range or one over MAX_MONTHS long.
+    """
+    months = month_range(start.replace(day=1), end.replace(day=1))
+    if not months:
+        raise ValueError("The start month must not be after the end month")
+    if len(months) > MAX_MONTHS:
+        raise ValueError(f"Reports cover at most {MAX_MONTHS} months")
+
+    window = max(1, min(window, MAX_WINDOW))
+    income_type = category_types.by_name("Income").id
+
+    # the range goes in the join, so categories with nothing in it still get
+    # a row, with a NULL month; the user keeps it a range scan of the key.
+    # Sums come back as whole cents, they only feed the arrays.
+    totals = MonthlyCategoryTotal.__table__
+    category = Category.__table__
+    query = (
+        select(
+            [
+                category.c.id,
+                category.c.name,
+                Account.__table__.c.name,
+                category.c.category_type_id == income_type,
+                category.c.budget_amount,
+                totals.c.year_month,
+                func.sum(type_coerce(totals.c.amount, Integer)),
+            ]
+        )
+        .select_from(
+            category.join(Account.__table__).outerjoin(
+                totals,
+                and_(
+                    totals.c.user_id == category.c.user_id,
+                    totals.c.category_id == category.c.id,
+                    totals.c.year_month >= months[0],
+                    totals.c.year_month <= months[-1],
+                ),
+            )
+        )
+        .where(category.c.user_id == user_id)
+        .group_by(category.c.id, totals.c.year_month)
+        .order_by(category.c.name, category.c.id)
+    )
+
+    categories = {}
+    cells = []
+    for row in db.session.execute(query):
+        category_id, name, account, income, budget, month, amount = row
+        if category_id not in categories:
+            categories[category_id] = {
+                "id": category_id,
+                "name": name,
+                "account": account,
+                "type": "Income" if income else "Expense",
+                "budget": budget or from_cents(0),
+            }
+        if month is not None:
+            cells.append((category_id, month, amount or 0))
+
+    row_of = {category_id: i for i, category_id in enumerate(categories)}
+    column_of = {month: i for i, month in enumerate(months)}
+
+    actual = np.zeros((len(categories), len(months)), dtype=np.int64)
+    if cells:
+        category_ids, cell_months, amounts = zip(*cells)
+        actual[
+            [row_of[category_id] for category_id in category_ids],
+            [column_of[month] for month in cell_months],
+        ] = amounts
+
+    budget = np.array(
+        [to_cents(category["budget"]) for category in categories.values()],
+        dtype=np.int64,
+    )
+    income = np.array(
+        [category["type"] == "Income" for category in categories.values()],
+        dtype=bool,
+    )
+    expense = ~income
+
+    delta = budget[:, None] - actual
+    rolling = rolling_mean(actual, window)
+    total = actual.sum(axis=1)
+    mean = divide_cents(total, len(months))
+    # in square cents; only the standard deviation is an amount of money
+    variance = actual.var(axis=1)
+
+    for i, category in enumerate(categories.values()):
+        category.update(
+            actual=_money(actual[i]),
+            delta=_money(delta[i]),
+            rolling_average=_money(rolling[i]),
+            total=from_cents(total[i]),
+            mean=from_cents(mean[i]),
+            variance=round(Decimal(variance[i]).scaleb(-4), 2),
+            std_dev=from_cents(round(np.sqrt(variance[i]))),
+            months_over_budget=int((delta[i] < 0).sum()) if expense[i] else 0,
+        )
+
+    income_totals = actual[income].sum(axis=0)
+    expense_totals = actual[expense].sum(axis=0)
+    expense_budget = np.full(len(months), budget[expense].sum(), dtype=np.int64)
+
+    return {
+        "months": months,
+        "window": window,
+        "categories": list(categories.values()),
+        "totals": {
+            "income": _money(income_totals),
+            "expense": _money(expense_totals),
+            "budget": _money(expense_budget),
+            "delta": _money(expense_budget - expense_totals),
+            "savings": _money(income_totals - expense_totals),
+            "expense_rolling_average": _money(rolling_mean(expense_totals, window)),
+        },
+    }
@@ -0,0 +1,178 @@
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import bindparam, func
+
+from archive import entry_sources
+from balances import apply_balance_deltas, refresh_balances
+from caching import bump_data_version
+from forecast import invalidate_forecasts
+from models import db, MonthlyCategoryTotal
+
+
+def year_month(effective_date):
+    """Return the rollup month key (YYYY-MM) for a date"""
+
+    return effective_date.strftime("%Y-%m")
+
+
+def add_delta(deltas, user_id, category_id, effective_date, amount, count=1):
+    """Accumulate an entry's change into a mapping for apply_deltas()"""
+
+    if effective_date is None:
+        return
+
+    key = (user_id, category_id, year_month(effective_date))
+    total, entry_count = deltas.get(key, (Decimal(0), 0))
+    deltas[key] = (total + Decimal(str(amount or 0)), entry_count + count)
+
+
+def apply_entry_delta(user_id, category_id, effective_date, amount, count=1):
+    """
+    Add an entry's amount to its category/month rollup
+
+    Pass a negative amount and count to back an entry out. The change is made
+    in the current session's transaction, so it commits with the entry itself.
+    """
+    deltas = {}
+    add_delta(deltas, user_id, category_id, effective_date, amount, count)
+    apply_deltas(deltas)
+
+
+def apply_deltas(deltas):
+    """
+    Apply a mapping of (user_id, category_id, year_month) -> (amount, count)
+
+    Missing rows are created first with INSERT OR IGNORE, then every key is
+    bumped with an atomic UPDATE ... SET amount = amount + delta. Both are
+    single executemany statements however many keys there are, and neither
+    races with a concurrent writer creating the same row. The same amounts
+    are then added to the balances of the categories' accounts, and the
+    users' cached forecasts are dropped.
+    """
+    table = MonthlyCategoryTotal.__table__
+    now = datetime.utcnow()
+
+    params = [
+        {
+            "key_user_id": user_id,
+            "key_category_id": category_id,
+            "key_year_month": month,
+            "delta_amount": amount,
+            "delta_count": count,
+        }
+        for (user_id, category_id, month), (amount, count) in deltas.items()
+        if amount or count
+    ]
+
+    if not params:
+        return
+
+    db.session.execute(
+        table.insert()
+        .prefix_with("OR IGNORE")
+        .values(
+            user_id=bindparam("key_user_id"),
+            category_id=bindparam("key_category_id"),
+            year_month=bindparam("key_year_month"),
+            amount=0,
+            entry_count=0,
+            modified_date=now,
+        ),
+        params,
+    )
+    db.session.execute(
+        table.update()
+        .where(table.c.user_id == bindparam("key_user_id"))
+        .where(table.c.category_id == bindparam("key_category_id"))
+        .where(table.c.year_month == bindparam("key_year_month"))
+        .values(
+            amount=table.c.amount
+            + bindparam("delta_amount", type_=table.c.amount.type),
+            entry_count=table.c.entry_count + bindparam("delta_count"),
+            modified_date=now,
+        ),
+        params,
+    )
+
+    category_amounts = defaultdict(Decimal)
+    for param in params:
+        category_amounts[param["key_category_id"]] += Decimal(
+            str(param["delta_amount"])
+        )
+    apply_balance_deltas(category_amounts)
+    invalidate_forecasts({param["key_user_id"] for param in params})
+
+
+def _entry_totals():
+    """
+    Group the raw entries the same way the rollup table is keyed, as a mapping
+    of (user_id, category_id, year_month) -> (amount, entry_count), including
+    the archived entries
+    """
+    totals = {}
+    for source in entry_sources():
+        entity = source.entity
+        month = func.strftime("%Y-%m", entity.effective_date)
+        query = (
+            db.session.query(
+                entity.user_id,
+                entity.category_id,
+                month,
+                func.sum(entity.amount),
+                func.count(entity.id),
+            )
+            .filter(entity.effective_date.isnot(None))
+            .group_by(entity.user_id, entity.category_id, month)
+        )
+        for user_id, category_id, year_month, amount, entry_count in query:
+            total, count = totals.get((user_id, category_id, year_month), (0, 0))
+            totals[(user_id, category_id, year_month)] = (
+                total + (amount or 0),
+                count + entry_count,
+            )
+
+    return totals
+
+
+def rebuild():
+    """Recompute the whole rollup table, and the balances, from the raw entries"""
+
+    deltas = _entry_totals()
+
+    db.session.query(MonthlyCategoryTotal).delete()
+    apply_deltas(deltas)
+    refresh_balances()
+    bump_data_version()
+    db.session.commit()
+
+    return len(deltas)
+
+
+def verify():
+    """
+    Compare the rollup table against the raw entries
+
+    Returns a list of (key, expected, actual) tuples for every mismatch, where
+    expected and actual are (amount, entry_count) pairs.
+    """
+    expected = {
+        key: (round(Decimal(amount), 2), entry_count)
+        for key, (amount, entry_count) in _entry_totals().items()
+    }
+
+    actual = {
+        (total.user_id, total.category_id, total.year_month): (
+            round(Decimal(total.amount or 0), 2),
+            total.entry_count,
+        )
+        for total in MonthlyCategoryTotal.query.filter(
+            MonthlyCategoryTotal.entry_count != 0
+        )
+    }
+
+    return [
+        (key, expected.get(key), actual.get(key))
+        for key in sorted(set(expected) | set(actual))
+        if expected.get(key) != actual.get(key)
+    ]
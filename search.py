@@ -0,0 +1,123 @@
+"""
+Full-text search over entry descriptions
+
+entry_search is an FTS5 index over entry's description and user_id columns.
+It stores no copy of the text (content='entry'), and triggers on entry keep
+it in step with every insert, update and delete, however they are made.
+Indexing the user as well lets a search intersect the user's postings with
+the words' postings inside the index, rather than finding every user's
+matches and filtering them afterwards. The date and category filters are
+then applied to the matching entries, which are ranked with bm25.
+
+The index is created with the entry table, and by migration 7 for older
+databases. `INSERT INTO entry_search(entry_search) VALUES ('rebuild')`
+regenerates it from the entry table.
+"""
+import re
+
+from datetime import timedelta
+from sqlalchemy import DDL, column, event, func, table
+from sqlalchemy.orm import joinedload
+
+from models import Entry
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+SEARCH_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS entry_search USING fts5(
+        description, user_id, content='entry', content_rowid='id'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entry_search_insert AFTER INSERT ON entry BEGIN
+        INSERT INTO entry_search (rowid, description, user_id)
+        VALUES (new.id, new.description, new.user_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entry_search_delete AFTER DELETE ON entry BEGIN
+        INSERT INTO entry_search (entry_search, rowid, description, user_id)
+        VALUES ('delete', old.id, old.description, old.user_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entry_search_update
+    AFTER UPDATE OF description, user_id ON entry BEGIN
+        INSERT INTO entry_search (entry_search, rowid, description, user_id)
+        VALUES ('delete', old.id, old.description, old.user_id);
+        INSERT INTO entry_search (rowid, description, user_id)
+        VALUES (new.id, new.description, new.user_id);
+    END
+    """,
+]
+
+for statement in SEARCH_DDL:
+    event.listen(
+        Entry.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite")
+    )
+
+entry_search = table("entry_search", column("rowid"), column("entry_search"))
+
+
+def match_expression(user_id, text):
+    """
+    Turn what was typed into an FTS5 query for the user's entries with a word
+    starting with each of the words typed; None if nothing was
+
+    Each word is quoted, so nothing typed is read as FTS5 syntax.
+    """
+    words = re.findall(r"\w+", text or "")
+    if not words:
+        return None
+
+    phrases = " AND ".join(f'"{word}"*' for word in words)
+
+    return f'user_id : "{int(user_id)}" AND description : ({phrases})'
+
+
+def search_entries(
+    user_id,
+    text,
+    start_date=None,
+    end_date=None,
+    category_id=None,
+    limit=DEFAULT_LIMIT,
+):
+    """
+    Return a user's entries matching the words of text, best match first, as
+    (entry, score) pairs where a lower score is a better match
+
+    The end date is inclusive.
+    """
+    expression = match_expression(user_id, text)
+    if expression is None:
+        return []
+
+    limit = max(1, min(limit, MAX_LIMIT))
+    # the user_id column only narrows the search, it shouldn't add to the rank
+    score = func.bm25(entry_search.c.entry_search, 1.0, 0.0).label("score")
+
+    query = (
+        Entry.query.with_entities(Entry, score)
+        .options(joinedload(Entry.category))
+        .join(entry_search, entry_search.c.rowid == Entry.id)
+        .filter(entry_search.c.entry_search.match(expression))
+        .filter(Entry.user_id == user_id)
+    )
+
+    if start_date:
+        query = query.filter(Entry.effective_date >= start_date)
+
+    if end_date:
+        query = query.filter(Entry.effective_date < end_date + timedelta(days=1))
+
+    if category_id:
+        query = query.filter(Entry.category_id == category_id)
+
+    return (
+        query.order_by(score, Entry.effective_date.desc(), Entry.id.desc())
+        .limit(limit)
+        .all()
+    )
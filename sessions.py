@@ -0,0 +1,188 @@
+"""
+Server-side session stores
+
+SESSION_TYPE picks the backend:
+
+    sqlite  a table in the app database, shared by every worker process
+    memory  an in-process LRU, for single-process development servers
+
+Any other value is handed to Flask-Session (e.g. redis or filesystem).
+
+Only the session id goes in the cookie. Opening a session is one primary key
+lookup, and the session is written back only when it changes or when it is
+past half of its PERMANENT_SESSION_LIFETIME, so the expiry slides forward
+without a write on every request.
+"""
+import random
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface
+from flask_session import Session
+from flask_session.sessions import ServerSideSession
+from secrets import token_urlsafe
+from sqlalchemy import select
+from threading import Lock
+
+from models import db, UserSession
+
+# chance that writing a session also purges the expired ones
+PURGE_PROBABILITY = 0.01
+
+
+class ServerSideSessionInterface(SessionInterface, ABC):
+    """Sessions kept server side, in whatever store a subclass loads them from"""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, permanent=False):
+        self.permanent = permanent
+
+    @abstractmethod
+    def load(self, session_id):
+        """Return the (data, expiry) stored for a session, None if it expired"""
+
+    @abstractmethod
+    def store(self, session_id, data, expiry):
+        """Save a session's serialized data, replacing what was stored"""
+
+    @abstractmethod
+    def delete(self, session_id):
+        """Forget a session"""
+
+    def open_session(self, app, request):
+        session_id = request.cookies.get(app.session_cookie_name)
+
+        if session_id:
+            record = self.load(session_id)
+            if record is not None:
+                data, expiry = record
+                session = ServerSideSession(self.serializer.loads(data), sid=session_id)
+                session.expiry = expiry
+                return session
+
+        return ServerSideSession(sid=token_urlsafe(32), permanent=self.permanent)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                self.delete(session.sid)
+                response.delete_cookie(
+                    app.session_cookie_name, domain=domain, path=path
+                )
+            return
+
+        now = datetime.utcnow()
+        lifetime = app.permanent_session_lifetime
+        expiry = getattr(session, "expiry", None)
+
+        if not session.modified and expiry and expiry - now > lifetime / 2:
+            return
+
+        self.store(session.sid, self.serializer.dumps(dict(session)), now + lifetime)
+        response.set_cookie(
+            app.session_cookie_name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+class SqliteSessionInterface(ServerSideSessionInterface):
+    """
+    Sessions in the user_session table
+
+    Runs on its own connection from the engine rather than db.session, so
+    saving a session never commits or rolls back the request's own work.
+    """
+
+    table = UserSession.__table__
+
+    def load(self, session_id):
+        with db.engine.connect() as connection:
+            return connection.execute(
+                select([self.table.c.data, self.table.c.expiry])
+                .where(self.table.c.session_id == session_id)
+                .where(self.table.c.expiry > datetime.utcnow())
+            ).first()
+
+    def store(self, session_id, data, expiry):
+        with db.engine.begin() as connection:
+            connection.execute(
+                self.table.insert().prefix_with("OR REPLACE"),
+                session_id=session_id,
+                data=data,
+                expiry=expiry,
+            )
+
+            if random.random() < PURGE_PROBABILITY:
+                connection.execute(
+                    self.table.delete().where(self.table.c.expiry <= datetime.utcnow())
+                )
+
+    def delete(self, session_id):
+        with db.engine.begin() as connection:
+            connection.execute(
+                self.table.delete().where(self.table.c.session_id == session_id)
+            )
+
+
+class MemorySessionInterface(ServerSideSessionInterface):
+    """Sessions in a process-local LRU, dropping the oldest past max_entries"""
+
+    def __init__(self, permanent=False, max_entries=10000):
+        super().__init__(permanent)
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+        self._lock = Lock()
+
+    def load(self, session_id):
+        with self._lock:
+            record = self._sessions.get(session_id)
+
+            if record is None:
+                return None
+
+            if record[1] <= datetime.utcnow():
+                del self._sessions[session_id]
+                return None
+
+            self._sessions.move_to_end(session_id)
+            return record
+
+    def store(self, session_id, data, expiry):
+        with self._lock:
+            self._sessions[session_id] = (data, expiry)
+            self._sessions.move_to_end(session_id)
+
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+def init_session(app):
+    """Install the session backend chosen by SESSION_TYPE"""
+
+    session_type = app.config.setdefault("SESSION_TYPE", "sqlite")
+    permanent = app.config.setdefault("SESSION_PERMANENT", False)
+
+    if session_type == "sqlite":
+        app.session_interface = SqliteSessionInterface(permanent)
+    elif session_type == "memory":
+        app.session_interface = MemorySessionInterface(
+            permanent, app.config.get("SESSION_MEMORY_MAX_ENTRIES", 10000)
+        )
+    else:
+        Session(app)
@@ -0,0 +1,199 @@
+"""
+Changes since a sync cursor
+
+Clients keep a copy of a user's accounts, categories and entries up to date
+by asking for the rows modified after the cursor they were last given, plus
+a tombstone for every row deleted since then. The changes form a single
+stream ordered by (modified_date, kind, id), and each kind is read with a
+range scan of its (user_id, modified_date) index starting at the cursor, so
+a sync costs in proportion to what changed rather than to the history.
+
+Rows are stamped with their modified_date before their transaction commits,
+so a row can become visible with a timestamp older than one a client has
+already synced past. Changes are therefore only handed out once they are
+SYNC_SETTLE_SECONDS old, long enough for any write waiting on the database
+lock to have committed or failed.
+
+Tombstones are purged after SYNC_TOMBSTONE_DAYS, so a client coming back
+with a cursor issued longer ago than that may have missed deletes. Such a
+cursor can't be continued; the response says "reset" and starts over from
+the beginning, and the client should replace its copy with what it is sent.
+"""
+import heapq
+import random
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+from flask import current_app
+from itertools import islice
+from sqlalchemy import and_, or_, select
+
+from archive import archived_years, route_entries
+from instrumentation import query_budget
+from models import db, Account, Category, Entry, Tombstone
+
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 5000
+
+# chance that recording a delete also purges the expired tombstones
+PURGE_PROBABILITY = 0.01
+
+# (response key, table, date column) in stream order for equal timestamps, so
+# clients see an account before the categories that point at it
+KINDS = [
+    ("accounts", Account.__table__, "modified_date"),
+    ("categories", Category.__table__, "modified_date"),
+    ("entries", Entry.__table__, "modified_date"),
+    ("deleted", Tombstone.__table__, "deleted_date"),
+]
+
+
+def encode_cursor(changed, kind, row_id, issued):
+    return f"{changed.isoformat()}_{kind}_{row_id}_{issued.isoformat()}"
+
+
+def decode_cursor(cursor):
+    """
+    Split a cursor into its position, a (date, kind, id) tuple, and the time
+    it was issued; None if it is invalid
+    """
+    try:
+        changed, kind, row_id, issued = cursor.split("_")
+        return (
+            (datetime.fromisoformat(changed), int(kind), int(row_id)),
+            datetime.fromisoformat(issued),
+        )
+    except (AttributeError, ValueError):
+        return None
+
+
+def _serialize(row):
+    values = {}
+    for key, value in row.items():
+        if key == "user_id":
+            continue
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, Decimal):
+            value = str(value)
+        values[key] = value
+
+    return values
+
+
+def _since(table, column, kind, position):
+    """The condition for rows of one kind that come after a cursor position"""
+
+    changed, cursor_kind, row_id = position
+
+    if kind > cursor_kind:
+        return column >= changed
+    if kind < cursor_kind:
+        return column > changed
+
+    return or_(column > changed, and_(column == changed, table.c.id > row_id))
+
+
+def get_changes(user_id, cursor=None, limit=DEFAULT_LIMIT):
+    """
+    Return the changes after a cursor as a dict ready to be sent as JSON
+
+    Raises ValueError for a cursor that can't be decoded.
+    """
+    limit = max(1, min(limit, MAX_LIMIT))
+    now = datetime.utcnow()
+    horizon = now - timedelta(seconds=current_app.config["SYNC_SETTLE_SECONDS"])
+    retained = now - timedelta(days=current_app.config["SYNC_TOMBSTONE_DAYS"])
+
+    position = None
+    reset = False
+    if cursor:
+        decoded = decode_cursor(cursor)
+        if decoded is None:
+            raise ValueError("Invalid sync cursor")
+
+        position, issued = decoded
+        if issued < retained:
+            position = None
+            reset = True
+
+    def stream(kind, table, date_column):
+        column = table.c[date_column]
+        query = (
+            select([table])
+            .where(table.c.user_id == user_id)
+            .where(column <= horizon)
+            .order_by(column, table.c.id)
+            .limit(limit + 1)
+        )
+        if position:
+            query = query.where(_since(table, column, kind, position))
+
+        return [
+            (row[date_column], kind, row.id, row) for row in db.session.execute(query)
+        ]
+
+    streams = []
+    for kind, (key, table, date_column) in enumerate(KINDS):
+        streams.append(stream(kind, table, date_column))
+
+        # archived entries are still part of a client's copy
+        if key == "entries":
+            # each archive is read as it's attached, as attaching more than
+            # ATTACHED_ARCHIVES detaches the ones attached first
+            with query_budget(len(archived_years())):
+                for source in route_entries():
+                    streams.append(stream(kind, source.table, date_column))
+
+    # each stream is already sorted, and (date, kind, id) is unique
+    changes = list(
+        islice(heapq.merge(*streams, key=lambda change: change[:3]), limit + 1)
+    )
+    more = len(changes) > limit
+    changes = changes[:limit]
+
+    response = {key: [] for key, _, _ in KINDS}
+    for changed, kind, row_id, row in changes:
+        key = KINDS[kind][0]
+        response[key].append(_serialize(row))
+
+    if more:
+        next_cursor = encode_cursor(*changes[-1][:3], now)
+    else:
+        # everything up to the horizon has been sent
+        next_cursor = encode_cursor(horizon, len(KINDS), 0, now)
+
+    response.update(cursor=next_cursor, more=more, reset=reset)
+
+    return response
+
+
+def record_deletes(user_id, table_name, row_ids):
+    """
+    Leave tombstones for rows about to be hard-deleted
+
+    They are written in the current session's transaction, so they commit
+    with the delete itself.
+    """
+    if not row_ids:
+        return
+
+    table = Tombstone.__table__
+    now = datetime.utcnow()
+
+    db.session.execute(
+        table.insert(),
+        [
+            {
+                "user_id": user_id,
+                "table_name": table_name,
+                "row_id": row_id,
+                "deleted_date": now,
+            }
+            for row_id in row_ids
+        ],
+    )
+
+    if random.random() < PURGE_PROBABILITY:
+        retained = now - timedelta(days=current_app.config["SYNC_TOMBSTONE_DAYS"])
+        db.session.execute(table.delete().where(table.c.deleted_date < retained))
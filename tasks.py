@@ -0,0 +1,111 @@
+"""
+The kinds of background job, see jobs.py
+
+Each wraps work that the matching route or command used to do inside the
+request: importing a statement, exporting entries, rebuilding the rollups
+and balances, and building a trends report over a long range.
+"""
+import os
+
+from itertools import islice
+
+from balances import verify_balances
+from exporter import EXPORT_CHUNK_SIZE, FORMATS, export_rows
+from helpers import parse_date
+from importer import PARSERS, import_entries, parse_rules
+from jobs import JobError, job
+from reports import get_trends, parse_month, trends_json
+from rollups import rebuild, verify
+
+
+@job("import_statement")
+def import_statement(
+    context, statement_format, category_id, rules="", credit_category_id=None
+):
+    """
+    Import the statement saved as the job's "statement" file
+
+    Each chunk's transaction checkpoints the rows read so far, so a retry
+    carries on after the last chunk that was committed.
+    """
+    path = context.file("statement")
+    done = context.done
+
+    try:
+        with open(path, newline="", encoding="utf-8-sig") as statement:
+            transactions = PARSERS[statement_format](statement)
+            skipped_before = sum(
+                1 for transaction in islice(transactions, done) if transaction is None
+            )
+            imported, skipped = import_entries(
+                context.user_id,
+                transactions,
+                category_id,
+                rules=parse_rules(context.user_id, rules),
+                credit_category_id=credit_category_id,
+                on_chunk=lambda imported, skipped: context.checkpoint(
+                    done + imported + skipped
+                ),
+            )
+    except ValueError as e:
+        raise JobError(str(e))
+
+    os.remove(path)
+
+    return {
+        "imported": done - skipped_before + imported,
+        "skipped": skipped_before + skipped,
+    }
+
+
+@job("export_entries")
+def export_entries(context, export_format, start=None, end=None):
+    """Write a user's entries to the job's "entries.<format>" file"""
+
+    generate, mimetype = FORMATS[export_format]
+    filename = f"entries.{export_format}"
+    rows = export_rows(
+        context.user_id, start_date=parse_date(start), end_date=parse_date(end)
+    )
+
+    exported = 0
+
+    def counted(rows):
+        nonlocal exported
+        for exported, row in enumerate(rows, 1):
+            if exported % EXPORT_CHUNK_SIZE == 0:
+                context.progress(exported)
+            yield row
+
+    with open(context.file(filename), "w", newline="") as export:
+        for chunk in generate(counted(rows)):
+            export.write(chunk)
+
+    return {"rows": exported, "filename": filename, "mimetype": mimetype}
+
+
+@job("rebuild_rollups")
+def rebuild_rollups(context):
+    """Rebuild the rollups and balances, and count what doesn't verify"""
+
+    rollup_count = rebuild()
+
+    return {
+        "rollups": rollup_count,
+        "mismatches": len(verify()),
+        "balance_mismatches": len(verify_balances()),
+    }
+
+
+@job("trends_report")
+def trends_report(context, start, end, window):
+    """The trends report of get_trends(), for months given as YYYY-MM"""
+
+    try:
+        trends = get_trends(
+            context.user_id, parse_month(start), parse_month(end), window
+        )
+    except ValueError as e:
+        raise JobError(str(e))
+
+    return trends_json(trends)
@@ -0,0 +1,51 @@
+"""
+Run the app against a throwaway database
+
+The app is configured when application is imported, so DATABASE_URL is set
+before any test imports it. Testing mode makes query budgets strict and
+keeps the recurring entry and job threads from starting.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(
+    tempfile.mkdtemp(), "budget.db"
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def app():
+    from application import app, create_db
+    from reference import load_reference_types
+
+    app.testing = True
+    create_db()
+
+    # as warm_caches() does before the first request, which only runs once
+    with app.app_context():
+        load_reference_types()
+
+    return app
+
+
+@pytest.fixture
+def client(app):
+    """A client logged in as a newly registered user"""
+
+    client = app.test_client()
+    client.post(
+        "/register",
+        data=dict(
+            username="user",
+            email="user@example.com",
+            password="password",
+            confirm_password="password",
+        ),
+    )
+    client.post("/login", data=dict(username="user", password="password"))
+
+    return client
@@ -0,0 +1,67 @@
+"""
+Reads that cover every archive, with more archives than stay attached
+"""
+from datetime import datetime
+
+import pytest
+
+YEARS = list(range(2006, 2020))
+
+
+@pytest.fixture
+def archived(app, client, tmp_path, monkeypatch):
+    """An entry of the logged-in user in each of YEARS, all archived"""
+
+    import archive
+    from models import db, Category, Entry
+
+    assert len(YEARS) > archive.ATTACHED_ARCHIVES
+    monkeypatch.setitem(app.config, "ARCHIVE_DIR", str(tmp_path))
+
+    with app.app_context():
+        category = Category.query.first()
+        for year in YEARS:
+            date = datetime(year, 6, 1)
+            db.session.add(
+                Entry(
+                    description=f"entry of {year}",
+                    amount=100,
+                    effective_date=date,
+                    created_date=date,
+                    modified_date=date,
+                    user_id=category.user_id,
+                    category_id=category.id,
+                )
+            )
+        db.session.commit()
+
+        moved = archive.archive_entries(datetime(YEARS[-1] + 1, 1, 1))
+        assert moved == {year: 1 for year in YEARS}
+        assert Entry.query.count() == 0
+
+        return category.id
+
+
+def test_changes_include_every_archive(client, archived):
+    response = client.get("/api/v1/changes?limit=1000")
+
+    assert response.status_code == 200
+    assert sorted(entry["description"] for entry in response.get_json()["entries"]) == [
+        f"entry of {year}" for year in YEARS
+    ]
+
+
+def test_delete_category_with_archived_entries(client, archived):
+    response = client.post(
+        "/api/v1/categories/batch",
+        json={"operations": [{"op": "delete", "id": archived}]},
+    )
+
+    assert response.status_code == 200
+    assert response.get_json()["results"] == [
+        {
+            "index": 0,
+            "status": "error",
+            "error": f"category {archived} still has entries",
+        }
+    ]
@@ -0,0 +1,117 @@
+"""
+Batch creates report the ids of the rows they inserted, and full batches run
+on SQLite builds that bind at most 999 variables a statement
+"""
+import sqlite3
+
+from api import Batch, MAX_OPERATIONS
+from sqlalchemy import event
+
+import pytest
+
+
+@pytest.fixture
+def old_sqlite(app):
+    """Connections limited to 999 variables a statement, as before SQLite 3.32"""
+
+    from models import db
+
+    def limit(connection, record):
+        connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+
+    with app.app_context():
+        engine = db.engine
+    engine.dispose()
+    event.listen(engine, "connect", limit)
+    yield
+    event.remove(engine, "connect", limit)
+    engine.dispose()
+
+
+def test_created_ids_match_their_rows(app, client):
+    from models import Category, Entry
+
+    with app.app_context():
+        category_id = Category.query.first().id
+
+    # an entry created outside the batch, after which its ids carry on
+    client.post("/add_entry", data=dict(category=category_id, amount="1.00"))
+
+    operations = [
+        {
+            "op": "create",
+            "category_id": category_id,
+            "amount": f"{number}.00",
+            "description": f"entry {number}",
+        }
+        for number in range(250)
+    ]
+    response = client.post("/api/v1/entries/batch", json={"operations": operations})
+
+    results = response.get_json()["results"]
+    assert [result["status"] for result in results] == ["created"] * 250
+
+    with app.app_context():
+        descriptions = dict(Entry.query.with_entities(Entry.id, Entry.description))
+    assert [descriptions[result["id"]] for result in results] == [
+        operation["description"] for operation in operations
+    ]
+
+
+def test_batches_must_validate():
+    class Unvalidated(Batch):
+        pass
+
+    with pytest.raises(TypeError):
+        Unvalidated(None)
+
+
+def test_full_batches_within_999_variables(app, client, old_sqlite):
+    from models import Account, Category, Entry
+
+    with app.app_context():
+        category_id = Category.query.first().id
+        account_id = Account.query.first().id
+
+    def batch(kind, operations):
+        response = client.post(f"/api/v1/{kind}/batch", json={"operations": operations})
+        assert response.status_code == 200
+        results = response.get_json()["results"]
+        assert [result for result in results if result["status"] == "error"] == []
+        return [result["id"] for result in results]
+
+    entry_ids = batch(
+        "entries",
+        [
+            {"op": "create", "category_id": category_id, "amount": "1.00"}
+            for _ in range(MAX_OPERATIONS)
+        ],
+    )
+    batch("entries", [{"op": "update", "id": id, "amount": "2.00"} for id in entry_ids])
+    batch("entries", [{"op": "delete", "id": id} for id in entry_ids])
+
+    category_ids = batch(
+        "categories",
+        [
+            {
+                "op": "create",
+                "name": f"category {number}",
+                "category_type_id": 1,
+                "account_id": account_id,
+            }
+            for number in range(MAX_OPERATIONS)
+        ],
+    )
+    batch("categories", [{"op": "delete", "id": id} for id in category_ids])
+
+    account_ids = batch(
+        "accounts",
+        [
+            {"op": "create", "name": f"account {number}", "account_type_id": 1}
+            for number in range(MAX_OPERATIONS)
+        ],
+    )
+    batch("accounts", [{"op": "delete", "id": id} for id in account_ids])
+
+    with app.app_context():
+        assert Entry.query.count() == 0
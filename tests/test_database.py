@@ -0,0 +1,20 @@
+"""
+The app only runs on SQLite
+"""
+import pytest
+
+from database import engine_options
+
+CONFIG = {"DB_POOL_SIZE": 5, "DB_MAX_OVERFLOW": 10}
+
+
+def test_other_databases_are_rejected():
+    with pytest.raises(ValueError, match="sqlite"):
+        engine_options(dict(CONFIG, SQLALCHEMY_DATABASE_URI="postgresql://db/budget"))
+
+
+def test_sqlite_files_are_pooled():
+    options = engine_options(dict(CONFIG, SQLALCHEMY_DATABASE_URI="sqlite:///b.db"))
+
+    assert options["pool_size"] == 5
+    assert options["connect_args"] == {"check_same_thread": False}
@@ -0,0 +1,76 @@
+"""
+Statement rows that can't be imported are skipped, not fatal
+"""
+import io
+
+from decimal import Decimal
+
+import pytest
+
+BAD_AMOUNTS = ["NaN", "sNaN", "Infinity", "-inf", "1e30", "1000000000", "twelve", ""]
+
+OFX_TRANSACTION = """<STMTTRN>
+<TRNTYPE>DEBIT
+<DTPOSTED>20200105
+<TRNAMT>{}
+<NAME>Coffee
+</STMTTRN>
+"""
+
+
+def _csv(amounts):
+    rows = [f'2020-01-05,Coffee,"{amount}"' for amount in amounts]
+    return io.StringIO("\n".join(["date,description,amount"] + rows))
+
+
+def _ofx(amounts):
+    return io.StringIO("".join(OFX_TRANSACTION.format(amount) for amount in amounts))
+
+
+@pytest.mark.parametrize("amount", BAD_AMOUNTS)
+def test_csv_bad_amount(amount):
+    from importer import parse_csv
+
+    assert list(parse_csv(_csv([amount]))) == [None]
+
+
+@pytest.mark.parametrize("amount", BAD_AMOUNTS)
+def test_ofx_bad_amount(amount):
+    from importer import parse_ofx
+
+    assert list(parse_ofx(_ofx([amount]))) == [None]
+
+
+def test_amounts_are_rounded_to_the_cent():
+    from importer import parse_csv, parse_ofx
+
+    assert [row["amount"] for row in parse_csv(_csv(["1,234.565", "-0.004"]))] == [
+        Decimal("1234.57"),
+        Decimal("0.00"),
+    ]
+    assert [row["amount"] for row in parse_ofx(_ofx(["-12.5"]))] == [Decimal("12.50")]
+
+
+def test_import_skips_bad_amounts(app, client):
+    from importer import import_entries, parse_csv
+    from models import Category, Entry
+    from reference import category_types
+    from rollups import verify
+
+    with app.app_context():
+        category = Category.query.filter_by(
+            category_type_id=category_types.by_name("Expense").id
+        ).first()
+        imported, skipped = import_entries(
+            category.user_id,
+            parse_csv(_csv(["12.50"] + BAD_AMOUNTS + ["-2.00"])),
+            category.id,
+            chunk_size=2,
+        )
+
+        assert (imported, skipped) == (2, len(BAD_AMOUNTS))
+        assert sorted(entry.amount for entry in Entry.query) == [
+            Decimal("-2.00"),
+            Decimal("12.50"),
+        ]
+        assert verify() == []
@@ -0,0 +1,293 @@
+"""
+Users can only file entries under their own categories
+"""
+import pytest
+
+
+@pytest.fixture
+def other_category_id(app):
+    """A category of a second user"""
+
+    from models import Category, User
+
+    other = app.test_client()
+    other.post(
+        "/register",
+        data=dict(
+            username="other",
+            email="other@example.com",
+            password="password",
+            confirm_password="password",
+        ),
+    )
+
+    with app.app_context():
+        user = User.query.filter_by(username="other").one()
+        return Category.query.filter_by(user_id=user.id).first().id
+
+
+@pytest.fixture
+def entry(app, client):
+    """An entry of the logged-in user, as (id, category_id)"""
+
+    from models import Category, Entry
+
+    with app.app_context():
+        category_id = Category.query.first().id
+
+    client.post(
+        "/add_entry", data=dict(category=category_id, amount="12.50", description="")
+    )
+
+    with app.app_context():
+        entry = Entry.query.one()
+        return entry.id, entry.category_id
+
+
+def _other_users_totals(app, category_id):
+    from models import MonthlyCategoryTotal
+
+    with app.app_context():
+        return MonthlyCategoryTotal.query.filter_by(category_id=category_id).count()
+
+
+def test_add_entry_to_another_users_category(app, client, other_category_id):
+    from models import Entry
+
+    response = client.post(
+        "/add_entry",
+        data=dict(category=other_category_id, amount="12.50", description=""),
+    )
+
+    assert response.status_code == 404
+    with app.app_context():
+        assert Entry.query.count() == 0
+    assert _other_users_totals(app, other_category_id) == 0
+
+
+def test_edit_entry_into_another_users_category(app, client, entry, other_category_id):
+    from models import Entry
+    from rollups import verify
+
+    entry_id, category_id = entry
+    response = client.post(
+        "/edit_entry",
+        data=dict(
+            edit=entry_id,
+            category=other_category_id,
+            amount="99.00",
+            description="moved",
+            effective_date="2020-01-01 00:00:00.000000",
+        ),
+    )
+
+    assert response.status_code == 404
+    with app.app_context():
+        assert Entry.query.get(entry_id).category_id == category_id
+        assert verify() == []
+    assert _other_users_totals(app, other_category_id) == 0
+
+
+def test_batch_create_in_another_users_category(app, client, other_category_id):
+    from models import Entry
+
+    response = client.post(
+        "/api/v1/entries/batch",
+        json={
+            "operations": [
+                {"op": "create", "category_id": other_category_id, "amount": "5.00"}
+            ]
+        },
+    )
+
+    assert response.get_json()["results"] == [
+        {
+            "index": 0,
+            "status": "error",
+            "error": f"category {other_category_id} not found",
+        }
+    ]
+    with app.app_context():
+        assert Entry.query.count() == 0
+    assert _other_users_totals(app, other_category_id) == 0
+
+
+def test_batch_update_into_another_users_category(
+    app, client, entry, other_category_id
+):
+    from models import Entry
+
+    entry_id, category_id = entry
+    response = client.post(
+        "/api/v1/entries/batch",
+        json={
+            "operations": [
+                {"op": "update", "id": entry_id, "category_id": other_category_id}
+            ]
+        },
+    )
+
+    assert response.get_json()["errors"] == 1
+    with app.app_context():
+        assert Entry.query.get(entry_id).category_id == category_id
+    assert _other_users_totals(app, other_category_id) == 0
+
+
+def test_batch_category_in_another_users_account(app, client):
+    from models import Account, Category, User
+    from reference import category_types
+
+    app.test_client().post(
+        "/register",
+        data=dict(
+            username="other",
+            email="other@example.com",
+            password="password",
+            confirm_password="password",
+        ),
+    )
+    with app.app_context():
+        other = User.query.filter_by(username="other").one()
+        other_account_id = Account.query.filter_by(user_id=other.id).first().id
+        category_count = Category.query.count()
+
+    response = client.post(
+        "/api/v1/categories/batch",
+        json={
+            "operations": [
+                {
+                    "op": "create",
+                    "name": "Theirs",
+                    "category_type_id": category_types.by_name("Expense").id,
+                    "account_id": other_account_id,
+                }
+            ]
+        },
+    )
+
+    assert response.get_json()["results"][0]["error"] == (
+        f"account {other_account_id} not found"
+    )
+    with app.app_context():
+        assert Category.query.count() == category_count
+
+
+@pytest.fixture
+def other_user(app):
+    """A second user with an entry, as (user, account, category, entry) ids"""
+
+    from models import Account, Category, Entry, User
+
+    other = app.test_client()
+    other.post(
+        "/register",
+        data=dict(
+            username="other",
+            email="other@example.com",
+            password="password",
+            confirm_password="password",
+        ),
+    )
+    other.post("/login", data=dict(username="other", password="password"))
+
+    with app.app_context():
+        user_id = User.query.filter_by(username="other").one().id
+        category = Category.query.filter_by(user_id=user_id).first()
+        category_id, account_id = category.id, category.account_id
+
+    other.post(
+        "/add_entry", data=dict(category=category_id, amount="12.50", description="")
+    )
+
+    with app.app_context():
+        entry_id = Entry.query.filter_by(user_id=user_id).one().id
+        return user_id, account_id, category_id, entry_id
+
+
+def _snapshot(app, user_id):
+    """What another user's requests must not change of a user's data"""
+
+    from models import Account, Category, Entry, User
+
+    with app.app_context():
+        return (
+            User.query.get(user_id).data_version,
+            [
+                (account.id, account.balance)
+                for account in Account.query.filter_by(user_id=user_id)
+            ],
+            [
+                (category.id, category.account_id)
+                for category in Category.query.filter_by(user_id=user_id)
+            ],
+            [entry.id for entry in Entry.query.filter_by(user_id=user_id)],
+        )
+
+
+def _category_form(category_types, account_id, **values):
+    return dict(
+        name="Theirs",
+        description="",
+        budget_amount="",
+        category_type=category_types.by_name("Expense").id,
+        account=account_id,
+        **values,
+    )
+
+
+def test_add_category_in_another_users_account(app, client, other_user):
+    from models import Category
+    from reference import category_types
+
+    user_id, account_id, _, _ = other_user
+    before = _snapshot(app, user_id)
+    with app.app_context():
+        category_count = Category.query.count()
+
+    response = client.post(
+        "/add_category", data=_category_form(category_types, account_id)
+    )
+
+    assert response.status_code == 404
+    with app.app_context():
+        assert Category.query.count() == category_count
+    assert _snapshot(app, user_id) == before
+
+
+def test_edit_category_into_another_users_account(app, client, other_user):
+    from models import Category
+    from reference import category_types
+
+    user_id, account_id, _, _ = other_user
+    before = _snapshot(app, user_id)
+    with app.app_context():
+        category = Category.query.filter(Category.user_id != user_id).first()
+        category_id, own_account_id = category.id, category.account_id
+
+    response = client.post(
+        "/edit_category",
+        data=_category_form(category_types, account_id, edit=category_id),
+    )
+
+    assert response.status_code == 404
+    with app.app_context():
+        assert Category.query.get(category_id).account_id == own_account_id
+    assert _snapshot(app, user_id) == before
+
+
+@pytest.mark.parametrize(
+    "url, index",
+    [("/delete_account", 1), ("/delete_category", 2), ("/delete_entry", 3)],
+)
+def test_delete_another_users_rows(app, client, other_user, url, index):
+    from rollups import verify
+
+    user_id = other_user[0]
+    before = _snapshot(app, user_id)
+
+    response = client.post(url, data=dict(delete=other_user[index]))
+
+    assert response.status_code == 404
+    assert _snapshot(app, user_id) == before
+    with app.app_context():
+        assert verify() == []
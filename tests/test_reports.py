@@ -0,0 +1,41 @@
+"""
+Trends reports work in whole cents and send amounts as strings
+"""
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from reports import divide_cents, parse_trend_args, rolling_mean, trends_json
+
+
+def test_averages_round_half_up_to_the_cent():
+    assert divide_cents(np.array([5, 15, -5, 4]), 2).tolist() == [3, 8, -3, 2]
+    assert rolling_mean(np.array([100, 101, 103]), 2).tolist() == [100, 101, 102]
+
+
+def test_amounts_are_sent_as_strings():
+    report = {"total": Decimal("1.50"), "actual": [Decimal("0.10")], "window": 3}
+
+    assert trends_json(report) == {"total": "1.50", "actual": ["0.10"], "window": 3}
+
+
+@pytest.mark.parametrize(
+    "args, message",
+    [({"start": "2020-13-01"}, "Months"), ({"window": "three"}, "window")],
+)
+def test_malformed_arguments_say_what_is_wrong(args, message):
+    with pytest.raises(ValueError, match=message):
+        parse_trend_args(args)
+
+
+def test_trends_api(app, client):
+    response = client.get("/api/v1/reports/trends?start=2020-01&end=2020-03")
+
+    category = response.get_json()["categories"][0]
+    assert category["budget"] == "100.00"
+    assert category["actual"] == ["0.00", "0.00", "0.00"]
+
+    response = client.get("/api/v1/reports/trends?window=x")
+    assert response.status_code == 400
+    assert "window" in response.get_json()["error"]
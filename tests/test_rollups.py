@@ -0,0 +1,181 @@
+"""
+The monthly category rollups against the per-entry sums they replaced
+
+Entries are added, moved between months and categories, and deleted
+through the app, which keeps the rollups up to date as it goes. The
+dashboard and the rollups must then agree with summing the entries.
+"""
+import random
+
+from datetime import datetime
+from sqlalchemy import func
+
+import pytest
+
+MONTHS = ["2020-01", "2020-02", "2020-03", "2020-04", "2020-05", "2020-06"]
+
+
+@pytest.fixture
+def entries(app, client):
+    """Spread entries over several months and categories of one user"""
+
+    from models import db, Account, Category, Entry
+    from reference import category_types
+
+    with app.app_context():
+        account_id = Account.query.first().id
+        for name, category_type in [
+            ("Groceries", "Expense"),
+            ("Rent", "Expense"),
+            ("Bonus", "Income"),
+        ]:
+            client.post(
+                "/add_category",
+                data=dict(
+                    name=name,
+                    budget_amount="500.00",
+                    category_type=category_types.by_name(category_type).id,
+                    account=account_id,
+                ),
+            )
+        category_ids = [category.id for category in Category.query]
+
+    generator = random.Random(2020)
+    for number in range(60):
+        client.post(
+            "/add_entry",
+            data=dict(
+                category=generator.choice(category_ids),
+                amount=f"{generator.randint(1, 50000) / 100:.2f}",
+                description=f"entry {number}",
+            ),
+        )
+
+    with app.app_context():
+        entry_ids = [entry.id for entry in Entry.query.order_by(Entry.id)]
+
+    # moving entries to other months and categories backs them out of one
+    # rollup and into another
+    for entry_id in entry_ids:
+        month = generator.choice(MONTHS)
+        effective_date = datetime.strptime(
+            f"{month}-{generator.randint(1, 28):02d}", "%Y-%m-%d"
+        )
+        client.post(
+            "/edit_entry",
+            data=dict(
+                edit=entry_id,
+                category=generator.choice(category_ids),
+                amount=f"{generator.randint(1, 50000) / 100:.2f}",
+                description=f"entry {entry_id}",
+                effective_date=effective_date.strftime("%Y-%m-%d %H:%M:%S.%f"),
+            ),
+        )
+
+    for entry_id in entry_ids[::7]:
+        client.post("/delete_entry", data=dict(delete=entry_id))
+
+    with app.app_context():
+        assert Entry.query.count() == len(entry_ids) - len(entry_ids[::7])
+        user_id = Account.query.first().user_id
+        db.session.remove()
+
+    return user_id
+
+
+def _summed_dashboard(user_id, year_month):
+    """The dashboard as it was summed from the entries, before the rollups"""
+
+    from models import db, Account, Category, Entry
+    from reference import category_types
+
+    lower = datetime.strptime(year_month, "%Y-%m")
+    upper = datetime(lower.year + lower.month // 12, lower.month % 12 + 1, 1)
+
+    def in_month(query, category_type):
+        return (
+            query.join(Entry.category)
+            .join(Category.account)
+            .filter(Account.user_id == user_id)
+            .filter(
+                Category.category_type_id == category_types.by_name(category_type).id
+            )
+            .filter(Entry.effective_date >= lower)
+            .filter(Entry.effective_date < upper)
+        )
+
+    expense_entries = in_month(
+        db.session.query(
+            Category.name, Account.name, Category.budget_amount, func.sum(Entry.amount)
+        ),
+        "Expense",
+    ).group_by(Category.id)
+    expense_amount = in_month(db.session.query(func.sum(Entry.amount)), "Expense")
+    income_amount = in_month(db.session.query(func.sum(Entry.amount)), "Income")
+
+    return {
+        "entries": sorted(expense_entries.all()),
+        "expense_amount": expense_amount.scalar() or 0,
+        "income_amount": income_amount.scalar() or 0,
+    }
+
+
+@pytest.mark.parametrize("year_month", MONTHS)
+def test_dashboard_matches_entry_sums(app, entries, year_month):
+    from dashboard import get_dashboard
+
+    with app.app_context():
+        dashboard = get_dashboard(entries, year_month)
+        expected = _summed_dashboard(entries, year_month)
+
+    assert expected["entries"]
+    assert (
+        sorted(
+            (row.category_name, row.account_name, row.budget_amount, row.amount)
+            for row in dashboard["entries"]
+        )
+        == expected["entries"]
+    )
+    assert dashboard["expense_amount"] == expected["expense_amount"]
+    assert dashboard["income_amount"] == expected["income_amount"]
+    assert dashboard["savings"] == (
+        expected["income_amount"] - expected["expense_amount"]
+    )
+
+
+def test_monthly_totals_match_entry_sums(app, entries):
+    from models import db, Entry, MonthlyCategoryTotal
+
+    month = func.strftime("%Y-%m", Entry.effective_date)
+
+    with app.app_context():
+        expected = {
+            (category_id, year_month): (amount, count)
+            for category_id, year_month, amount, count in db.session.query(
+                Entry.category_id, month, func.sum(Entry.amount), func.count(Entry.id)
+            )
+            .filter(Entry.user_id == entries)
+            .group_by(Entry.category_id, month)
+        }
+        totals = {
+            (total.category_id, total.year_month): (total.amount, total.entry_count)
+            for total in MonthlyCategoryTotal.query.filter_by(user_id=entries)
+            # deleting a month's last entry leaves its total at zero
+            if total.entry_count
+        }
+
+    assert len(expected) > len(MONTHS)
+    assert totals == expected
+
+
+def test_rebuild_rollups_finds_no_mismatch(app, entries):
+    from rollups import verify
+
+    with app.app_context():
+        assert verify() == []
+
+    result = app.test_cli_runner().invoke(args=["rebuild-rollups"])
+
+    assert result.exit_code == 0, result.output
+    assert "Mismatch" not in result.output
+    assert "mismatch" not in result.output